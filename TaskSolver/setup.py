@@ -15,7 +15,7 @@ setup(
         "flask_cors==4.0.1",
         "ollama",
         "anthropic==0.34.0",
-        "google-generativeai",
+        "google-generativeai==0.8.3",   # clients.get_gemini_model() relies on its internals
         "transformers==4.46.1",
         "tqdm==4.66.5",
         "shortuuid==1.0.11",
@@ -0,0 +1,126 @@
+"""
+Asyncio surface of the API model interfaces.
+
+GPTModel, ClaudeModel, GeminiModel and OllamaModel have async counterparts of their query methods
+(aask, arough_guess, arun_once), so that many requests can be in flight from one event loop
+instead of one OS thread each. Every request holds a slot of its provider (e.g. "openai"):
+    TASKSOLVER_MAX_<NAME>: max concurrent requests of the provider. Within an event loop this is an
+        asyncio semaphore; when TASKSOLVER_LIMITS_DIR is set, the slot is also shared with the
+        threads and other processes of the run, as in limits.py.
+Requests per minute and tokens per minute are throttled and errors retried as for the synchronous
+requests, see ratelimit.py.
+
+Limits and async clients (clients.py) belong to the event loop they are used from, and are dropped
+once it is closed. clients.aclose_async_clients() closes the connections of the running loop.
+"""
+
+import os
+import random
+import weakref
+import asyncio
+import threading
+import contextlib
+from loguru import logger
+
+from .limits import MAX_ENV_VAR_PREFIX, ConcurrencyLimit, get_limit
+from .exceptions import GPTOutputParseException, GPTMaxTriesExceededException
+
+
+async def acquire_process_slot(process_limit:ConcurrencyLimit) -> int:
+    '''
+    Async ConcurrencyLimit.acquire(). The slot is polled without blocking from the event loop rather
+    than waited for in a worker thread, so a task cancelled while waiting never ends up holding a slot.
+    '''
+    interval = process_limit.poll_interval
+    while True:
+        fd = process_limit.try_acquire()
+        if fd is not None:
+            return fd
+        await asyncio.sleep(interval * (0.5 + random.random()))
+        interval = min(interval * 2, process_limit.max_poll_interval)
+
+
+class AsyncProviderLimit(object):
+    def __init__(self, name:str, max_concurrent:int=None):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self._semaphore = asyncio.Semaphore(max_concurrent) if max_concurrent else None
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        if self._semaphore is not None:
+            await self._semaphore.acquire()
+        try:
+            # Slot shared with the threads and processes of the run
+            process_limit = get_limit(self.name)
+            fd = await acquire_process_slot(process_limit) if process_limit is not None else None
+            try:
+                yield
+            finally:
+                if fd is not None:
+                    process_limit.release(fd)
+        finally:
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+
+_async_limits = weakref.WeakKeyDictionary()     # event loop -> {name: AsyncProviderLimit}
+_async_limits_lock = threading.Lock()
+
+
+def get_async_limit(name:str) -> AsyncProviderLimit:
+    '''
+    The AsyncProviderLimit of provider `name` in the running event loop.
+    '''
+    loop = asyncio.get_running_loop()
+    with _async_limits_lock:
+        # The semaphores of closed loops hold on to them, drop them
+        for closed_loop in [other for other in _async_limits if other.is_closed()]:
+            del _async_limits[closed_loop]
+        limits = _async_limits.setdefault(loop, {})
+        if name not in limits:
+            max_concurrent = os.environ.get(MAX_ENV_VAR_PREFIX + name.upper())
+            limits[name] = AsyncProviderLimit(name, max_concurrent=int(max_concurrent) if max_concurrent else None)
+        return limits[name]
+
+
+def async_limit_slot(name:str):
+    '''
+    Async context manager holding one request slot of provider `name`.
+    '''
+    return get_async_limit(name).slot()
+
+
+class AsyncInterfaceMixin(object):
+    '''
+    arough_guess and arun_once of the API interfaces, which implement `aask` and `prepare_payload`.
+    '''
+
+    async def arough_guess(self, question, max_tokens=1000, max_tries=10, verbose=False, **kwargs):
+        """
+        Async `rough_guess()`, same arguments and return values.
+        """
+        p = self.prepare_payload(question, max_tokens=max_tokens, verbose=verbose, prepend=None,
+                                    model=self.model)
+
+        reattempt = 0
+        while True:
+            response, meta_data = await self.aask(p)
+            response = response[0]
+            try:
+                parsed_response = self.task.answer_type.parser(response["content"])
+            except GPTOutputParseException as e:
+                logger.warning(f"The following was not parseable:\n\n{response}\n\nBecause\n\n{e}")
+
+                reattempt += 1
+                if reattempt > max_tries:
+                    logger.error(f"max tries ({max_tries}) exceeded.")
+                    raise GPTMaxTriesExceededException
+
+                logger.warning(f"Reattempt #{reattempt} querying LLM")
+                continue
+            return parsed_response, response, meta_data, p
+
+    async def arun_once(self, question, max_tokens=1000, **kwargs):
+        q = self.task.first_question(question)
+        return await self.arough_guess(q, max_tokens=max_tokens, **kwargs)
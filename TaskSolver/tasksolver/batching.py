@@ -0,0 +1,128 @@
+"""
+Batched generation for the local model interfaces.
+
+The agents query a local model from many threads at once (tree_branch runs `breadth` think()
+calls in parallel, get_top_candidate runs all the comparisons of a round in parallel). Instead of
+each thread calling generate on the shared weights, the requests are queued on the GenerationBatcher
+of the model: the first waiting thread collects the requests that arrive within max_wait, runs them
+as a single padded generate call, and hands every thread its own outputs.
+
+A request is (payload, n_choices, temperature) and takes n_choices rows of the batch. Requests are
+only batched with requests of the same group (e.g. same max_tokens and sampling settings), since
+those are arguments of the whole generate call.
+"""
+
+import time
+import threading
+
+
+class _Slot(object):
+    def __init__(self, request, size:int, group, run_batch):
+        self.request = request
+        self.size = size
+        self.group = group
+        self.run_batch = run_batch
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class GenerationBatcher(object):
+    def __init__(self, max_batch_size:int=8, max_wait:float=0.05):
+        '''
+        Inputs:
+            max_batch_size: max number of rows (sum of the n_choices) of one generate call
+            max_wait: seconds the leading request waits for others to join its batch
+        '''
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._pending = []
+        self._running = False
+
+    def _take_batch(self) -> list:
+        # The oldest pending request and the ones of its group that fit with it
+        group = self._pending[0].group
+        batch, rows = [], 0
+        for slot in list(self._pending):
+            if slot.group != group:
+                continue
+            if batch and rows + slot.size > self.max_batch_size:
+                break
+            batch.append(slot)
+            rows += slot.size
+        for slot in batch:
+            self._pending.remove(slot)
+        return batch
+
+    def submit_many(self, requests:list, run_batch, sizes:list=None, groups:list=None) -> list:
+        '''
+        Run requests, batched with each other and with the ones submitted by other threads, and return their results.
+
+        Inputs:
+            requests: list of requests
+            run_batch: function taking a list of requests of one group and returning their results
+            sizes[optional]: number of batch rows of each request, 1 by default
+            groups[optional]: group of each request, requests are only batched with requests of the same group
+        '''
+        sizes = sizes or [1] * len(requests)
+        groups = groups or [None] * len(requests)
+        slots = [_Slot(request, size, group, run_batch) for request, size, group in zip(requests, sizes, groups)]
+        with self._cond:
+            self._pending.extend(slots)
+            self._cond.notify_all()
+
+        while True:
+            with self._cond:
+                if all(slot.done for slot in slots):
+                    break
+                if self._running:
+                    self._cond.wait()
+                    continue
+
+                # Lead the next batch: give the other threads a chance to join it
+                self._running = True
+                deadline = time.monotonic() + self.max_wait
+                while sum(slot.size for slot in self._pending) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._take_batch()
+
+            try:
+                results = batch[0].run_batch([slot.request for slot in batch])
+                for slot, result in zip(batch, results):
+                    slot.result = result
+            except Exception as e:
+                for slot in batch:
+                    slot.error = e
+            finally:
+                with self._cond:
+                    for slot in batch:
+                        slot.done = True
+                    self._running = False
+                    self._cond.notify_all()
+
+        for slot in slots:
+            if slot.error is not None:
+                raise slot.error
+        return [slot.result for slot in slots]
+
+    def submit(self, request, run_batch, size:int=1, group=None):
+        return self.submit_many([request], run_batch, sizes=[size], groups=[group])[0]
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def get_batcher(key, max_batch_size:int=8, max_wait:float=0.05) -> GenerationBatcher:
+    '''
+    The GenerationBatcher of the model registered under key (see model_registry), shared by all
+    the interfaces of that model.
+    '''
+    with _batchers_lock:
+        if key not in _batchers:
+            _batchers[key] = GenerationBatcher(max_batch_size=max_batch_size, max_wait=max_wait)
+        return _batchers[key]
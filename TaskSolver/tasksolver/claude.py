@@ -1,6 +1,13 @@
 import anthropic
 from .common import TaskSpec, ParsedAnswer, Question
 from .exceptions import GPTOutputParseException, GPTMaxTriesExceededException
+from .limits import limit_slot
+from .response_cache import cached_ask
+from .ratelimit import call_with_retries, acall_with_retries, estimate_tokens
+from .clients import get_anthropic_client, get_async_anthropic_client
+from .aio import AsyncInterfaceMixin, async_limit_slot
+from .image_budget import get_image_budget
+import asyncio
 import threading
 from typing import List, Tuple, Union
 from loguru import logger
@@ -8,15 +15,22 @@ from copy import deepcopy
 import time
 import os
 
-class ClaudeModel(object):
+class ClaudeModel(AsyncInterfaceMixin):
     def __init__(self, api_key:str,
                  task:TaskSpec,
-                 model:str = "claude-3-haiku-20240307"):
+                 model:str = "claude-3-haiku-20240307",
+                 base_url:str=None):
 
         self.claude_key:str = api_key
         self.task:TaskSpec = task
         self.model:str = model
 
+        self.base_url = base_url
+
+        # Long-lived client, shared by the threads (and the other interfaces) using this key
+        self.client = get_anthropic_client(api_key, base_url=base_url)
+
+    @cached_ask
     def ask(self,  payload:dict, n_choices=1) -> Tuple[List[dict], List[dict]]:
         """
         args: 
@@ -28,15 +42,17 @@ class ClaudeModel(object):
             # creation of payload
             mod_payload = deepcopy(payload)
 
-            try:
-                raw_response = client.messages.create(
-                    model="claude-3-haiku-20240307",
-                    #messages=[{"role": "user", "content": "Hello, Claude, tell me a number between 1 to 10000 please."}],
-                    messages = [mod_payload["messages"]],
-                    max_tokens=mod_payload["max_tokens"],
-                )
-            except Exception as e:
-                raise e
+            def request():
+                with limit_slot("anthropic"):     # shared with the other processes of the run, see limits.py
+                    return client.messages.create(
+                        model="claude-3-haiku-20240307",
+                        #messages=[{"role": "user", "content": "Hello, Claude, tell me a number between 1 to 10000 please."}],
+                        messages = [mod_payload["messages"]],
+                        max_tokens=mod_payload["max_tokens"],
+                    )
+
+            # Throttled to the anthropic rate limits, transient errors retried with backoff (see ratelimit.py)
+            raw_response = call_with_retries(request, "anthropic", tokens=estimate_tokens(mod_payload))
 
             response = raw_response.dict()
             response['content'] = response['content'][0]['text']
@@ -46,7 +62,7 @@ class ClaudeModel(object):
             results[idx] = {"message": message, "metadata": metadata} 
             return
 
-        client = anthropic.Anthropic(api_key = self.claude_key)
+        client = self.client
 
         assert n_choices >= 1
         results = [None]  * n_choices 
@@ -64,6 +80,36 @@ class ClaudeModel(object):
         metadata:List[dict] = [ res["metadata"] for res in results]
         return messages, metadata 
 
+    @cached_ask
+    async def aask(self,  payload:dict, n_choices=1) -> Tuple[List[dict], List[dict]]:
+        """
+        Async `ask()`, the n_choices are concurrent requests.
+        """
+        client = get_async_anthropic_client(self.claude_key, base_url=self.base_url)
+
+        async def claude_request():
+            mod_payload = deepcopy(payload)
+            async def request():
+                async with async_limit_slot("anthropic"):     # see aio.py
+                    return await client.messages.create(
+                        model="claude-3-haiku-20240307",
+                        messages = [mod_payload["messages"]],
+                        max_tokens=mod_payload["max_tokens"],
+                    )
+            raw_response = await acall_with_retries(request, "anthropic", tokens=estimate_tokens(mod_payload))
+            response = raw_response.dict()
+            response['content'] = response['content'][0]['text']
+            message = {key: response[key] for key in ['role', 'content']}
+            metadata = response.copy()
+            del metadata["content"]
+            return message, metadata
+
+        assert n_choices >= 1
+        results = await asyncio.gather(*[claude_request() for _ in range(n_choices)])
+        messages:List[dict] = [message for message, _ in results]
+        metadata:List[dict] = [metadata for _, metadata in results]
+        return messages, metadata
+
 
     @staticmethod
     def prepare_payload(question:Question,
@@ -74,7 +120,9 @@ class ClaudeModel(object):
             ) -> dict:
 
         content = []
-        dic_list = question.get_json()
+        image_tokens = 0
+        # Images downscaled to what the model works at, see image_budget.py
+        dic_list = question.get_json(image_budget=get_image_budget(kwargs.get("model")))
         for dic in dic_list:
             # The case of text
             if dic['type'] == 'text':
@@ -104,6 +152,7 @@ class ClaudeModel(object):
                 }
 
                 content.append(modified_dic)
+                image_tokens += dic.get("image_tokens", 0)
 
         payload = {
             "messages": {
@@ -112,6 +161,9 @@ class ClaudeModel(object):
             },
             "max_tokens": max_tokens,
         }
+        if image_tokens:
+            payload["image_tokens"] = image_tokens
+            logger.debug(f"{kwargs.get('model')} payload images: ~{image_tokens} tokens.")
 
 
         return payload
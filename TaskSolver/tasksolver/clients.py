@@ -0,0 +1,165 @@
+"""
+Long-lived API clients of the VLM providers.
+
+Creating an SDK client per request sets up a new connection pool, so every request pays a TCP and
+TLS handshake. The interfaces (GPTModel, ClaudeModel, GeminiModel, OllamaModel) instead get their
+client from here when they are created. Clients are cached per (api key, base url), so all the
+interfaces of a process, and all the threads of tree_branch and get_top_candidate, share the same
+keep-alive connections. The openai, anthropic and ollama clients are thread-safe httpx clients.
+
+Configuration, through the environment:
+    TASKSOLVER_HTTP_MAX_CONNECTIONS: size of the connection pool of each client (default 64)
+    TASKSOLVER_HTTP_TIMEOUT: request timeout in seconds (default 600)
+    OPENAI_BASE_URL, ANTHROPIC_BASE_URL, GEMINI_BASE_URL, OLLAMA_HOST: endpoints of the providers,
+        e.g. a local mock server in tests. base_url arguments take precedence.
+
+Gemini goes through google-generativeai, pinned in setup.py because get_gemini_model() relies on
+its internals (see there). Its default gRPC transport multiplexes concurrent requests over one
+HTTP/2 channel, so there is no connection pool to size; with a base_url it uses the REST transport.
+"""
+
+import os
+import weakref
+import threading
+import httpx
+
+MAX_CONNECTIONS_ENV_VAR = "TASKSOLVER_HTTP_MAX_CONNECTIONS"
+TIMEOUT_ENV_VAR = "TASKSOLVER_HTTP_TIMEOUT"
+
+_clients = {}
+_async_clients = weakref.WeakKeyDictionary()     # event loop -> {key: async client}
+_clients_lock = threading.Lock()
+
+
+def http_pool_limits(max_connections:int=None) -> httpx.Limits:
+    if max_connections is None:
+        max_connections = int(os.environ.get(MAX_CONNECTIONS_ENV_VAR, 64))
+    return httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+
+
+def http_timeout() -> float:
+    return float(os.environ.get(TIMEOUT_ENV_VAR, 600))
+
+
+def _get_client(key:tuple, create):
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = create()
+        return _clients[key]
+
+
+def get_openai_client(api_key:str, base_url:str=None, max_connections:int=None):
+    '''
+    The shared openai.OpenAI client of api_key.
+    '''
+    from openai import OpenAI, DefaultHttpxClient
+    base_url = base_url or os.environ.get("OPENAI_BASE_URL")
+    return _get_client(("openai", api_key, base_url, max_connections), lambda: OpenAI(
+        api_key=api_key, base_url=base_url, timeout=http_timeout(),
+        http_client=DefaultHttpxClient(limits=http_pool_limits(max_connections))))
+
+
+def get_anthropic_client(api_key:str, base_url:str=None, max_connections:int=None):
+    '''
+    The shared anthropic.Anthropic client of api_key.
+    '''
+    import anthropic
+    base_url = base_url or os.environ.get("ANTHROPIC_BASE_URL")
+    return _get_client(("anthropic", api_key, base_url, max_connections), lambda: anthropic.Anthropic(
+        api_key=api_key, base_url=base_url, timeout=http_timeout(),
+        http_client=anthropic.DefaultHttpxClient(limits=http_pool_limits(max_connections))))
+
+
+def _get_async_client(key:tuple, create):
+    # Async clients pool their connections on the event loop they are used from, so they are cached
+    # per loop. The clients of closed loops are dropped, as their connections can't be used anymore.
+    import asyncio
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        for closed_loop in [other for other in _async_clients if other.is_closed()]:
+            del _async_clients[closed_loop]
+        clients = _async_clients.setdefault(loop, {})
+        if key not in clients:
+            clients[key] = create()
+        return clients[key]
+
+
+async def aclose_async_clients():
+    '''
+    Close the async clients of the running event loop, e.g. at the end of the coroutine given to asyncio.run().
+    '''
+    import asyncio
+    with _clients_lock:
+        clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        if hasattr(client, "close"):       # openai, anthropic
+            await client.close()
+        else:                               # ollama
+            await client._client.aclose()
+
+
+def get_async_openai_client(api_key:str, base_url:str=None, max_connections:int=None):
+    '''
+    The shared openai.AsyncOpenAI client of api_key in the running event loop.
+    '''
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+    base_url = base_url or os.environ.get("OPENAI_BASE_URL")
+    return _get_async_client(("async-openai", api_key, base_url, max_connections), lambda: AsyncOpenAI(
+        api_key=api_key, base_url=base_url, timeout=http_timeout(),
+        http_client=DefaultAsyncHttpxClient(limits=http_pool_limits(max_connections))))
+
+
+def get_async_anthropic_client(api_key:str, base_url:str=None, max_connections:int=None):
+    '''
+    The shared anthropic.AsyncAnthropic client of api_key in the running event loop.
+    '''
+    import anthropic
+    base_url = base_url or os.environ.get("ANTHROPIC_BASE_URL")
+    return _get_async_client(("async-anthropic", api_key, base_url, max_connections), lambda: anthropic.AsyncAnthropic(
+        api_key=api_key, base_url=base_url, timeout=http_timeout(),
+        http_client=anthropic.DefaultAsyncHttpxClient(limits=http_pool_limits(max_connections))))
+
+
+def get_ollama_client(host:str=None, max_connections:int=None):
+    '''
+    The shared ollama.Client of host (OLLAMA_HOST, or the local server, by default).
+    '''
+    import ollama
+    host = host or os.environ.get("OLLAMA_HOST")
+    return _get_client(("ollama", host, max_connections), lambda: ollama.Client(
+        host=host, timeout=http_timeout(), limits=http_pool_limits(max_connections)))
+
+
+def get_gemini_model(api_key:str, model:str, base_url:str=None):
+    '''
+    The shared genai.GenerativeModel of (api_key, model).
+
+    genai.configure() sets process-wide state, so it is called once per key, and the model is bound
+    to the client it creates right away, rather than to whichever key is configured at its first request.
+    The SDK has no public way to do so: this sets GenerativeModel._client, which google-generativeai
+    0.8 creates lazily from the configured key. Check it when upgrading the pinned version in setup.py.
+    '''
+    import google.generativeai as genai
+    from google.generativeai import client as genai_client
+    base_url = base_url or os.environ.get("GEMINI_BASE_URL")
+
+    def create():
+        client_options = {"api_endpoint": base_url} if base_url else None
+        genai.configure(api_key=api_key, transport="rest" if base_url else None, client_options=client_options)
+        generative_model = genai.GenerativeModel(model_name=model,
+            safety_settings= None,
+            generation_config = None
+        )
+        generative_model._client = genai_client.get_default_generative_client()
+        return generative_model
+    return _get_client(("gemini", api_key, base_url, model), create)
+
+
+def get_async_ollama_client(host:str=None, max_connections:int=None):
+    '''
+    The shared ollama.AsyncClient of host in the running event loop.
+    '''
+    import ollama
+    host = host or os.environ.get("OLLAMA_HOST")
+    return _get_async_client(("async-ollama", host, max_connections), lambda: ollama.AsyncClient(
+        host=host, timeout=http_timeout(), limits=http_pool_limits(max_connections)))
@@ -10,11 +10,10 @@ import io
 import threading
 from bson import ObjectId
 from .utils import URL
+from .image_encoding import encode_image, mime_type_of
 import os
 from typing import Union, Dict
 
-io_semaphore = threading.Semaphore(1)
-
 T = TypeVar('T', bound="ParsedAnswer")
 class ParsedAnswer(object):
     """ Base class to specify parsing output types
@@ -80,32 +79,37 @@ class Question(object):
 
 
     @staticmethod
-    def get_pil_image_content(image:Image.Image):
-        with io_semaphore:
-            img_byte_array = io.BytesIO()
-            image.save(img_byte_array, format='PNG')  # Save the PIL image to the in-memory stream as PNG
-            img_byte_array.seek(0) 
-            base64enc_image = base64.b64encode(img_byte_array.read()).decode('utf-8') 
-            pack = {"type": "image_url",
-                "image_url": {
-                    "url": f"data:image/jpeg;base64,{base64enc_image}"
-                    },
-                "image": image
-                }
+    def get_pil_image_content(image:Image.Image, image_budget=None):
+        # Fit to the working size of the model (see image_budget.py), then encoded in the configured 
+        # format (PNG by default) and cached by content, see image_encoding.py
+        if image_budget is not None:
+            image = image_budget.fit(image)
+        mime_type, base64enc_image = encode_image(image)
+        pack = {"type": "image_url",
+            "image_url": {
+                "url": f"data:{mime_type};base64,{base64enc_image}"
+                },
+            "image": image
+            }
+        if image_budget is not None:
+            pack["image_tokens"] = image_budget.estimate_tokens(image.size)
         return pack
 
     @staticmethod
     def get_local_image_content(image_path:Union[Path, str]):
         base64enc_image = Question.encode_image(image_path)
+        mime_type = mime_type_of(base64.b64decode(base64enc_image[:16]))
         return {"type": "image_url", 
                 "image_url": {
-                    "url": f"data:image/jpeg;base64,{base64enc_image}"
+                    "url": f"data:{mime_type};base64,{base64enc_image}"
                     },
                 "image": Image.open(image_path)
                 }
       
     @staticmethod     
-    def get_pil_image_content_savecopy(image:Image.Image):
+    def get_pil_image_content_savecopy(image:Image.Image, image_budget=None):
+        if image_budget is not None:
+            image = image_budget.fit(image)
         
         directory = "temporary/"
         if not os.path.exists(directory):
@@ -122,6 +126,8 @@ class Question(object):
         image.save(filepath)
         ret = Question.get_local_image_content(filepath)
         ret["local_path"] = filepath
+        if image_budget is not None:
+            ret["image_tokens"] = image_budget.estimate_tokens(image.size)
         return ret
 
     @staticmethod
@@ -194,16 +200,21 @@ class Question(object):
                     continue
         return imgs                
 
-    def get_json(self, **kwargs): 
+    def get_json(self, image_budget=None, **kwargs): 
+        """
+        Args:
+            image_budget (optional): ImageBudget of the model the question is for, images are
+                downscaled to it and their parts get an "image_tokens" estimate. See image_budget.py.
+        """
         payload = []
         for el in self.question_components:
             if isinstance(el, str):
                 payload.append(self.get_text_content(el))
             elif isinstance(el, Image.Image):
                 if "save_local" in kwargs and kwargs["save_local"] is True:
-                    payload.append(self.get_pil_image_content_savecopy(el))
+                    payload.append(self.get_pil_image_content_savecopy(el, image_budget=image_budget))
                 else:
-                    payload.append(self.get_pil_image_content(el))
+                    payload.append(self.get_pil_image_content(el, image_budget=image_budget))
             elif isinstance(el, Path):
                 payload.append(self.get_local_image_content(el))
             elif isinstance(el, URL):
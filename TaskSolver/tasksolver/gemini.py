@@ -1,6 +1,13 @@
 import os
 from .common import TaskSpec, ParsedAnswer, Question
 from .exceptions import GPTOutputParseException, GPTMaxTriesExceededException
+from .limits import limit_slot
+from .response_cache import cached_ask
+from .ratelimit import call_with_retries, acall_with_retries
+from .clients import get_gemini_model
+from .aio import AsyncInterfaceMixin, async_limit_slot
+from .image_budget import get_image_budget
+import asyncio
 import threading
 import base64
 import io
@@ -12,15 +19,29 @@ import google.generativeai as genai
 import time
 import PIL
 
-class GeminiModel(object):
+def gemini_tokens(payload:dict) -> int:
+    # Token estimate of a request, for the token bucket: the text messages, ~4 characters per token, 
+    # and the image estimate of prepare_payload (258 tokens per image without one)
+    num_chars = sum(len(message) for message in payload["messages"] if isinstance(message, str))
+    num_images = sum(1 for message in payload["messages"] if not isinstance(message, str))
+    image_tokens = payload.get("image_tokens", 258 * num_images)
+    return num_chars // 4 + image_tokens + payload["max_tokens"]
+
+
+class GeminiModel(AsyncInterfaceMixin):
     def __init__(self, api_key:str,
                  task:TaskSpec,
-                 model:str="gemini-pro-vision"):
+                 model:str="gemini-pro-vision",
+                 base_url:str=None):
         self.gemini_key:str = api_key
         self.task:TaskSpec = task
         self.model:str = model
 
+        # Long-lived client, shared by the threads (and the other interfaces) using this key and model
+        self.client = get_gemini_model(api_key, model, base_url=base_url)
 
+
+    @cached_ask
     def ask(self,  payload:dict, n_choices=1) -> Tuple[List[dict], List[dict]]:
         """
         args: 
@@ -35,23 +56,21 @@ class GeminiModel(object):
                 max_output_tokens=payload["max_tokens"], 
             )
 
-            try:
-                raw_response = client.generate_content(
-                    contents=payload["messages"],
-                    generation_config=config_instance
-                )
-            except Exception as e:
-                raise e
+            def request():
+                with limit_slot("gemini"):     # shared with the other processes of the run, see limits.py
+                    return client.generate_content(
+                        contents=payload["messages"],
+                        generation_config=config_instance
+                    )
+
+            # Throttled to the gemini rate limits, transient errors retried with backoff (see ratelimit.py)
+            raw_response = call_with_retries(request, "gemini", tokens=gemini_tokens(payload))
 
             response = {'content' : raw_response.text}
             results[idx] = {"message": response, "metadata": raw_response} 
             return
 
-        genai.configure(api_key=self.gemini_key)
-        client = genai.GenerativeModel(model_name=self.model,
-            safety_settings= None,
-            generation_config = None
-        )
+        client = self.client
         
         assert n_choices >= 1
         results = [None]  * n_choices 
@@ -69,6 +88,30 @@ class GeminiModel(object):
         metadata:List[dict] = [ res["metadata"] for res in results]
         return messages, metadata 
 
+    @cached_ask
+    async def aask(self,  payload:dict, n_choices=1) -> Tuple[List[dict], List[dict]]:
+        """
+        Async `ask()`, the n_choices are concurrent requests.
+        """
+        async def gemini_request():
+            config_instance = generation_types.GenerationConfig(
+                max_output_tokens=payload["max_tokens"], 
+            )
+            async def request():
+                async with async_limit_slot("gemini"):     # see aio.py
+                    return await self.client.generate_content_async(
+                        contents=payload["messages"],
+                        generation_config=config_instance
+                    )
+            raw_response = await acall_with_retries(request, "gemini", tokens=gemini_tokens(payload))
+            return {'content' : raw_response.text}, raw_response
+
+        assert n_choices >= 1
+        results = await asyncio.gather(*[gemini_request() for _ in range(n_choices)])
+        messages:List[dict] = [message for message, _ in results]
+        metadata:List[dict] = [metadata for _, metadata in results]
+        return messages, metadata
+
 
     @staticmethod
     def prepare_payload(question:Question,
@@ -80,10 +123,13 @@ class GeminiModel(object):
 
         strings = []
         images = []
-        for el in question.get_json(save_local=True):
+        image_tokens = 0
+        # Images downscaled to what the model works at, see image_budget.py
+        for el in question.get_json(save_local=True, image_budget=get_image_budget(kwargs.get("model"))):
             if 'text' in el:
                 strings.append(el['text'])
             elif 'image_url' in el:
+                image_tokens += el.get("image_tokens", 0)
                 #Convert the binary encoded version to PIL.image
                 base64enc_image = el['image_url']['url'].split(',', 1)[1]
                 base64_image_str = base64enc_image  # the Base64-encoded string
@@ -105,6 +151,9 @@ class GeminiModel(object):
             "messages": messages,
             "max_tokens": max_tokens,
         }
+        if image_tokens:
+            payload["image_tokens"] = image_tokens
+            logger.debug(f"{kwargs.get('model')} payload images: ~{image_tokens} tokens.")
         
         return payload
 
@@ -1,50 +1,46 @@
 from typing import List, Union, Tuple
 from loguru import logger
 import io
-from openai import OpenAI
 from .common import TaskSpec, ParsedAnswer, Question
 from .exceptions import GPTOutputParseException, GPTMaxTriesExceededException
+from .limits import limit_slot
+from .response_cache import cached_ask
+from .ratelimit import call_with_retries, acall_with_retries, estimate_tokens
+from .clients import get_openai_client, get_async_openai_client
+from .aio import AsyncInterfaceMixin, async_limit_slot
+from .image_budget import get_image_budget
 
 
-class GPTModel(object):
+class GPTModel(AsyncInterfaceMixin):
     def __init__(self, api_key:str,
                  task:TaskSpec, 
                  model:str="gpt-4o",
+                 base_url:str=None,
                  ):
         self.open_ai_key:str = api_key
         
         self.task:TaskSpec = task
         self.model:str = model
+
+        self.base_url = base_url
+
+        # Long-lived client, shared by the threads (and the other interfaces) using this key
+        self.client = get_openai_client(api_key, base_url=base_url)
  
+    @cached_ask
     def ask(self, payload: dict, n_choices=1) -> Tuple[dict, dict]:
         """
         args:
             payload: json dictionary, prepared by `prepare_payload`
         """
-        client = OpenAI(api_key=self.open_ai_key) 
-
-        try:
-            if self.model in ("gpt-4o", 'gpt-4o-mini', 'gpt-4-turbo'):
-                response = client.chat.completions.create(
-                    model=self.model, #"gpt-4-vision-preview",
-                    messages=payload["messages"],
-                    max_tokens=payload["max_tokens"],
-                    n=n_choices
-                )
-            elif self.model in ('o1-mini', 'o1', 'o3-mini', 'o3'):
-                response = client.chat.completions.create(
-                    model=self.model, #"gpt-4-vision-preview",
-                    messages=payload["messages"],
-                    max_completion_tokens=payload["max_tokens"],
-                    n=n_choices
-                )
+        client = self.client
 
-            
-            
-        except Exception as e:
-            # err = e
-            raise e 
-            
+        def request():
+            with limit_slot("openai"):     # shared with the other processes of the run, see limits.py
+                return client.chat.completions.create(**self._create_args(payload, n_choices))
+
+        # Throttled to the openai rate limits, transient errors retried with backoff (see ratelimit.py)
+        response = call_with_retries(request, "openai", tokens=estimate_tokens(payload) * n_choices)
 
         response = response.dict()
         messages = [choice["message"] for choice in response["choices"]]        
@@ -53,6 +49,29 @@ class GPTModel(object):
 
         return messages, metadata
 
+    def _create_args(self, payload:dict, n_choices:int) -> dict:
+        # Arguments of chat.completions.create, shared by ask and aask. The reasoning models take
+        # max_completion_tokens, every other model max_tokens
+        if self.model in ('o1-mini', 'o1', 'o3-mini', 'o3'):
+            return dict(model=self.model, messages=payload["messages"], max_completion_tokens=payload["max_tokens"], n=n_choices)
+        return dict(model=self.model, messages=payload["messages"], max_tokens=payload["max_tokens"], n=n_choices)
+
+    @cached_ask
+    async def aask(self, payload: dict, n_choices=1) -> Tuple[dict, dict]:
+        """
+        Async `ask()`, the n_choices come from a single request.
+        """
+        client = get_async_openai_client(self.open_ai_key, base_url=self.base_url)
+        async def request():
+            async with async_limit_slot("openai"):     # see aio.py
+                return await client.chat.completions.create(**self._create_args(payload, n_choices))
+        response = await acall_with_retries(request, "openai", tokens=estimate_tokens(payload) * n_choices)
+
+        response = response.dict()
+        messages = [choice["message"] for choice in response["choices"]]
+        metadata = response["usage"]
+        return messages, metadata
+
     @staticmethod
     def prepare_payload(question:Question,
             verbose:bool=False,
@@ -70,12 +89,15 @@ class GPTModel(object):
             payload (dict) containing the json to be sent to GPT's API.
 
         """
-        question_dicts = question.get_json()
+        # Images downscaled to what the model works at, see image_budget.py
+        question_dicts = question.get_json(image_budget=get_image_budget(model))
         print('Getting question_dicts fine.')
 
+        image_tokens = 0
         for part in question_dicts:
             if part["type"]=="image_url":
                 del part["image"] # remove the PIL.Image
+                image_tokens += part.pop("image_tokens", 0)
              
         payload = [{"role": "user",
                     "content": question_dicts
@@ -92,6 +114,9 @@ class GPTModel(object):
             "model": model,
             "messages": payload,
             "max_tokens": max_tokens}
+        if image_tokens:
+            payload["image_tokens"] = image_tokens
+            logger.debug(f"{model} payload images: ~{image_tokens} tokens.")
         return payload
 
     def run_once(self, question:Question, max_tokens=1000):
@@ -0,0 +1,103 @@
+"""
+Per-model image budgets of the VLM payloads.
+
+OpenAI and Anthropic downscale every image to their own working size, and bill it by tile (OpenAI)
+or by pixel area (Anthropic). Images larger than that, like the 2-view render composites of the
+BlenderGym questions, are uploaded and decoded for nothing. An ImageBudget downscales images to the
+provider's working size before they are encoded, and estimates how many input tokens they cost, so
+the payload is smaller and faster without changing what the model sees. Gemini cuts large images
+into tiles rather than shrinking them, so its images are only downscaled under TASKSOLVER_IMAGE_MAX_TOKENS.
+
+    TASKSOLVER_IMAGE_MAX_TOKENS: optional cap of the tokens of one image. Images over it are
+        further downscaled until their estimate fits, trading detail for cost and latency.
+"""
+
+import os
+import math
+from PIL import Image
+
+MAX_TOKENS_ENV_VAR = "TASKSOLVER_IMAGE_MAX_TOKENS"
+
+
+class ImageBudget(object):
+    def __init__(self, name:str, max_long_side:int=None, max_short_side:int=None, max_pixels:int=None,
+                 tile_size:int=None, tokens_per_tile:int=0, base_tokens:int=0, pixels_per_token:float=None):
+        '''
+        Inputs:
+            max_long_side, max_short_side, max_pixels[optional]: working size of the provider, images
+                are downscaled (never upscaled) to fit all of them
+            tile_size, tokens_per_tile, base_tokens[optional]: cost of tile-billed images,
+                base_tokens + tokens_per_tile * number of tile_size x tile_size tiles
+            pixels_per_token[optional]: cost of area-billed images, used instead of tiles when set
+        '''
+        self.name = name
+        self.max_long_side = max_long_side
+        self.max_short_side = max_short_side
+        self.max_pixels = max_pixels
+        self.tile_size = tile_size
+        self.tokens_per_tile = tokens_per_tile
+        self.base_tokens = base_tokens
+        self.pixels_per_token = pixels_per_token
+
+    def fit_size(self, size:tuple) -> tuple:
+        width, height = size
+        scale = 1.0
+        if self.max_long_side:
+            scale = min(scale, self.max_long_side / max(width, height))
+        if self.max_short_side:
+            scale = min(scale, self.max_short_side / min(width, height))
+        if self.max_pixels:
+            scale = min(scale, math.sqrt(self.max_pixels / (width * height)))
+        return max(1, int(width * scale)), max(1, int(height * scale))
+
+    def estimate_tokens(self, size:tuple) -> int:
+        '''
+        Input tokens of an image of size (width, height) once fit to the budget.
+        '''
+        width, height = self.fit_size(size)
+        if self.pixels_per_token:
+            return math.ceil(width * height / self.pixels_per_token)
+        if self.tile_size:
+            tiles = math.ceil(width / self.tile_size) * math.ceil(height / self.tile_size)
+            return self.base_tokens + self.tokens_per_tile * tiles
+        return self.base_tokens
+
+    def fit(self, image:Image.Image) -> Image.Image:
+        '''
+        image downscaled to the working size of the provider, and to TASKSOLVER_IMAGE_MAX_TOKENS if set.
+        '''
+        size = self.fit_size(image.size)
+        max_tokens = os.environ.get(MAX_TOKENS_ENV_VAR)
+        if max_tokens:
+            while self.estimate_tokens(size) > int(max_tokens) and min(size) > 64:
+                size = (max(1, int(size[0] * 0.9)), max(1, int(size[1] * 0.9)))
+        if size == image.size:
+            return image
+        return image.resize(size, Image.LANCZOS)
+
+
+# OpenAI high detail: within 2048x2048, then shortest side 768, 512px tiles
+OPENAI_BUDGET = ImageBudget("openai", max_long_side=2048, max_short_side=768, tile_size=512, tokens_per_tile=170, base_tokens=85)
+OPENAI_MINI_BUDGET = ImageBudget("openai-mini", max_long_side=2048, max_short_side=768, tile_size=512, tokens_per_tile=5667, base_tokens=2833)
+# Anthropic: long side 1568 and ~1.15 megapixels, (width * height) / 750 tokens
+ANTHROPIC_BUDGET = ImageBudget("anthropic", max_long_side=1568, max_pixels=1092 * 1092, pixels_per_token=750)
+# Gemini: 768px tiles of 258 tokens each, at any size
+GEMINI_BUDGET = ImageBudget("gemini", tile_size=768, tokens_per_tile=258)
+
+
+def get_image_budget(model:str):
+    '''
+    The ImageBudget of the model id (e.g. "gpt-4o"), None for models that take images as they are
+    (the local models resize in their own processors).
+    '''
+    if not isinstance(model, str):
+        return None
+    if model.startswith("gpt-4o-mini"):
+        return OPENAI_MINI_BUDGET
+    if model.startswith(("gpt-4", "o1", "o3")):
+        return OPENAI_BUDGET
+    if model.startswith("claude"):
+        return ANTHROPIC_BUDGET
+    if model.startswith("gemini"):
+        return GEMINI_BUDGET
+    return None
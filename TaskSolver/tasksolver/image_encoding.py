@@ -0,0 +1,114 @@
+"""
+Encoding of the images of Questions into base64 data for the VLM payloads.
+
+The same images (the target renders, the current best render) go into many questions, built
+concurrently by the branch and judge threads. Encoded images are cached by pixel content, and
+encoding runs without any global lock, so threads only wait on each other for the cache lookup.
+
+Configuration, through the environment:
+    TASKSOLVER_IMAGE_FORMAT: png (default, lossless), jpeg or webp
+    TASKSOLVER_IMAGE_QUALITY: quality of the jpeg and webp encodings (default 90)
+    TASKSOLVER_IMAGE_CACHE_SIZE: number of encoded images kept (default 256)
+"""
+
+import io
+import os
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+FORMAT_ENV_VAR = "TASKSOLVER_IMAGE_FORMAT"
+QUALITY_ENV_VAR = "TASKSOLVER_IMAGE_QUALITY"
+CACHE_SIZE_ENV_VAR = "TASKSOLVER_IMAGE_CACHE_SIZE"
+
+MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp", "gif": "image/gif"}
+
+
+def image_content_hash(image:Image.Image) -> str:
+    sha = hashlib.sha256()
+    sha.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    sha.update(image.tobytes())
+    return sha.hexdigest()
+
+
+def mime_type_of(data:bytes) -> str:
+    '''
+    Mime type of encoded image data, from its magic bytes.
+    '''
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if data.startswith(b"GIF8"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
+
+
+class ImageEncodingCache(object):
+    def __init__(self, max_entries:int=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # (content hash, format, quality) -> (mime type, base64 string)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, image:Image.Image, format:str=None, quality:int=None):
+        '''
+        Inputs:
+            image: PIL image
+            format[optional]: png, jpeg or webp, TASKSOLVER_IMAGE_FORMAT by default
+            quality[optional]: jpeg/webp quality, TASKSOLVER_IMAGE_QUALITY by default
+        Outputs:
+            mime type, base64 string of the encoded image
+        '''
+        format = (format or os.environ.get(FORMAT_ENV_VAR, "png")).lower().replace("jpg", "jpeg")
+        if format not in ("png", "jpeg", "webp"):
+            raise ValueError(f"Unsupported image payload format {format}.")
+        quality = int(quality or os.environ.get(QUALITY_ENV_VAR, 90))
+        key = (image_content_hash(image), format, quality if format != "png" else None)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        # Encoding runs outside the lock; two threads may encode the same new image, both get the same result
+        if format == "jpeg" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        if format == "png":
+            image.save(buffer, format="PNG")
+        else:
+            image.save(buffer, format=format.upper(), quality=quality)
+        encoded = (MIME_TYPES[format], base64.b64encode(buffer.getvalue()).decode('utf-8'))
+
+        with self._lock:
+            self._entries[key] = encoded
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return encoded
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+_cache = ImageEncodingCache(int(os.environ.get(CACHE_SIZE_ENV_VAR, 256)))
+
+
+def encode_image(image:Image.Image, format:str=None, quality:int=None):
+    '''
+    (mime type, base64 string) of image, from the process-wide encoding cache.
+    '''
+    return _cache.encode(image, format=format, quality=quality)
+
+
+def get_image_encoding_cache() -> ImageEncodingCache:
+    return _cache
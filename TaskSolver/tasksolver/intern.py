@@ -26,6 +26,7 @@ import math
 
 from .gpt4v import TaskSpec, ParsedAnswer, Question
 from .exceptions import GPTOutputParseException, GPTMaxTriesExceededException
+from .model_registry import SharedModelMixin
 import threading
 from typing import List, Tuple, Union
 from loguru import logger
@@ -109,14 +110,16 @@ def load_image(image, input_size=448, max_num=12):
     pixel_values = torch.stack(pixel_values)
     return pixel_values
 
-class InternModel(object):
+class InternModel(SharedModelMixin):
     def __init__(self, task:TaskSpec,
                  model:str="OpenGVLab/InternVL2-8B"):
 
         self.task:TaskSpec = task
-        self.model = self.get_model(model)
 
-        self.tokenizer = AutoTokenizer.from_pretrained(model, trust_remote_code=True, use_fast=False)
+        # Weights and tokenizer are shared by all the InternModel of the process
+        self.model, self.tokenizer = self._acquire_model(model, 
+            lambda: (self.get_model(model), AutoTokenizer.from_pretrained(model, trust_remote_code=True, use_fast=False)),
+            dtype="float16-4bit", device="auto")
 
     
     def get_model(self, model):
@@ -139,48 +142,21 @@ class InternModel(object):
         args: 
             payload: json dictionary, prepared by `prepare_payload`
         """
-
-        def intern_thread(self, idx, payload, results, temperature):
-
-            # creation of payload
-            mod_payload = deepcopy(payload)
-            question = payload['question']
-            pixel_values = payload['pixel_values']
-            num_patches_list = payload['num_patches_list']
-            max_tokens = payload['max_tokens']
-
-            generation_config = dict(max_new_tokens=max_tokens, do_sample=True)
-
-            try:
-                # Preparation for inference
-                output_text = self.model.chat(self.tokenizer, pixel_values, question, generation_config, num_patches_list=num_patches_list, history=None, return_history=None)
-            
-            except Exception as e:
-                raise e
-            
-            print('outputs: ', output_text)
-            message = {'content' : output_text}
-
-            results[idx] = {"metadata": output_text, "message": message} 
-
-            return
-
-        assert n_choices >= 1
-        results = [None]  * n_choices 
-        if n_choices > 1:
-            intern_jobs = [threading.Thread(target=intern_thread,
-                            args=(self, idx, payload, results, temperature))
-                                for idx in range(n_choices)]
-            for job in intern_jobs:
-                job.start()
-            for job in intern_jobs:
-                job.join()
-        else:
-            intern_thread(self, 0, payload, results, temperature)
-
-        messages:List[dict] = [ res["message"] for res in results]
-        metadata:List[dict] = [ res["metadata"] for res in results]
-        return messages, metadata
+        return self.ask_many([payload], n_choices=n_choices, temperature=temperature)[0]
+
+    def _generate_batch(self, requests:list) -> list:
+        # InternVL's chat() decodes a single answer and its batch_chat() a single image per question,
+        # so the rows are generated one after the other (still one request at a time on the weights)
+        rows = []
+        for payload, n_choices, temperature in requests:
+            generation_config = dict(max_new_tokens=payload['max_tokens'], do_sample=True)
+            for _ in range(n_choices):
+                output_text = self.model.chat(self.tokenizer, payload['pixel_values'], payload['question'], generation_config, 
+                                              num_patches_list=payload['num_patches_list'], history=None, return_history=None)
+                print('outputs: ', output_text)
+                rows.append(({'content' : output_text}, output_text))
+
+        return self._split_rows(requests, rows)
 
 
     @staticmethod
@@ -0,0 +1,126 @@
+"""
+Concurrency limits shared by every process of a run.
+
+A limit of N is a set of N lock files under a shared directory. A slot is held with an exclusive flock
+on one of them, so a limit holds across processes (e.g. the BlenderGym instances that inference.py runs
+in parallel) as well as across threads, and a slot is given back by the OS if its holder dies.
+
+Limits are configured through the environment, so that they are inherited by subprocesses:
+    TASKSOLVER_LIMITS_DIR: directory of the lock files. Nothing is limited when it is not set.
+    TASKSOLVER_MAX_<NAME>: number of slots of the limit <name>, e.g. TASKSOLVER_MAX_BLENDER=4,
+        TASKSOLVER_MAX_OPENAI=8. Names without a value are not limited.
+"""
+
+import os
+import time
+import random
+import threading
+import contextlib
+from loguru import logger
+
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+
+LIMITS_DIR_ENV_VAR = "TASKSOLVER_LIMITS_DIR"
+MAX_ENV_VAR_PREFIX = "TASKSOLVER_MAX_"
+
+
+class ConcurrencyLimit(object):
+    def __init__(self, name:str, num_slots:int, lock_dir:str, poll_interval:float=0.05, max_poll_interval:float=1.0):
+        assert num_slots >= 1
+        self.name = name
+        self.num_slots = num_slots
+        self.lock_dir = lock_dir
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        os.makedirs(lock_dir, exist_ok=True)
+
+    def try_acquire(self):
+        '''
+        Take a free slot without waiting. Returns the file descriptor holding it, or None if all are taken.
+        '''
+        # Start at a random slot, so that waiters don't all contend for slot 0
+        first = random.randrange(self.num_slots)
+        for offset in range(self.num_slots):
+            slot_path = os.path.join(self.lock_dir, f"{self.name}.{(first + offset) % self.num_slots}.lock")
+            fd = os.open(slot_path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    def acquire(self) -> int:
+        '''
+        Block until a slot is free. Returns the file descriptor holding it, to be passed to release().
+        '''
+        interval = self.poll_interval
+        waited = False
+        while True:
+            fd = self.try_acquire()
+            if fd is not None:
+                return fd
+            if not waited:
+                logger.debug(f"All {self.num_slots} slots of {self.name} are taken, waiting.")
+                waited = True
+            time.sleep(interval * (0.5 + random.random()))
+            interval = min(interval * 2, self.max_poll_interval)
+
+    def release(self, fd:int):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    @contextlib.contextmanager
+    def slot(self):
+        fd = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(fd)
+
+
+_limits = {}
+_limits_lock = threading.Lock()
+
+
+def get_limit(name:str):
+    '''
+    The ConcurrencyLimit configured for name in the environment, or None if name is not limited.
+    '''
+    lock_dir = os.environ.get(LIMITS_DIR_ENV_VAR)
+    num_slots = os.environ.get(MAX_ENV_VAR_PREFIX + name.upper())
+    if not lock_dir or not num_slots or int(num_slots) <= 0:
+        return None
+    if fcntl is None:
+        logger.warning(f"Concurrency limits are not supported on this platform, {name} is not limited.")
+        return None
+
+    key = (name, lock_dir, int(num_slots))
+    with _limits_lock:
+        if key not in _limits:
+            _limits[key] = ConcurrencyLimit(name, int(num_slots), lock_dir)
+        return _limits[key]
+
+
+def limit_slot(name:str):
+    '''
+    Context manager holding one slot of the limit `name` (e.g. "blender", "openai"), a no-op when
+    that limit isn't configured.
+    '''
+    limit = get_limit(name)
+    return limit.slot() if limit is not None else contextlib.nullcontext()
+
+
+def limits_env(lock_dir:str, max_slots:dict) -> dict:
+    '''
+    Environment variables configuring the limits in max_slots (name -> number of slots),
+    to be set in os.environ or passed to subprocesses.
+    '''
+    env = {LIMITS_DIR_ENV_VAR: os.path.abspath(lock_dir)}
+    for name, num_slots in max_slots.items():
+        if num_slots:
+            env[MAX_ENV_VAR_PREFIX + name.upper()] = str(int(num_slots))
+    return env
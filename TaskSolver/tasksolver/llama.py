@@ -19,6 +19,8 @@ import math
 
 from .gpt4v import TaskSpec, ParsedAnswer, Question
 from .exceptions import GPTOutputParseException, GPTMaxTriesExceededException
+from .model_registry import SharedModelMixin
+from .prefix_cache import get_prefix_cache
 import threading
 from typing import List, Tuple, Union
 from loguru import logger
@@ -34,7 +36,10 @@ torch.backends.cudnn.benchmark = False
 
 
 
-class LlamaModel(object):
+class LlamaModel(SharedModelMixin):
+    # Max number of prompt tokens whose KV states are kept for reuse by later prompts, 0 disables the prefix cache
+    prefix_cache_tokens = 16384
+
     def __init__(self, task:TaskSpec,
                  model:str = "meta-llama/Meta-Llama-3.1-8B-Instruct"):
 
@@ -49,12 +54,15 @@ class LlamaModel(object):
         if num_gpus == 1:            
             self.device_map = "cuda:0"
     
-        self.pipeline = transformers.pipeline(
-            "text-generation",
-            model=self.model_id,
-            model_kwargs={"attn_implementation":"flash_attention_2", "torch_dtype": torch.float16},
-            device_map=self.device_map,  # Map the model to GPU 2 (index 1)
-        )
+        # The pipeline (weights and tokenizer) is shared by all the LlamaModel of the process
+        self.pipeline = self._acquire_model(self.model_id, 
+            lambda: transformers.pipeline(
+                "text-generation",
+                model=self.model_id,
+                model_kwargs={"attn_implementation":"flash_attention_2", "torch_dtype": torch.float16},
+                device_map=self.device_map,  # Map the model to GPU 2 (index 1)
+            ),
+            dtype="float16", device=self.device_map)
         
         # self.pipeline = transformers.pipeline(
         #     "text-generation",
@@ -68,48 +76,73 @@ class LlamaModel(object):
         args: 
             payload: json dictionary, prepared by `prepare_payload`
         """
-
-        def llama_thread(self, idx, payload, results, temperature):
-
-            # creation of payload
-            mod_payload = deepcopy(payload)
-            messages = payload['messages']
-            max_tokens = payload['max_tokens']
-
-
-            try:
-                with torch.autocast(device_type='cuda'):
-                    output_text = self.pipeline(
-                        messages,
-                        max_new_tokens=max_tokens,
-                    )
-
-            except Exception as e:
-                raise e
-            
-            print('outputs: ', output_text)
-            message = output_text[0]["generated_text"][-1]
-
-            results[idx] = {"metadata": output_text, "message": message} 
-
-            return
-
-        assert n_choices >= 1
-        results = [None]  * n_choices 
-        if n_choices > 1:
-            llama_jobs = [threading.Thread(target=llama_thread,
-                            args=(self, idx, payload, results, temperature))
-                                for idx in range(n_choices)]
-            for job in llama_jobs:
-                job.start()
-            for job in llama_jobs:
-                job.join()
-        else:
-            llama_thread(self, 0, payload, results, temperature)
-
-        messages:List[dict] = [ res["message"] for res in results]
-        metadata:List[dict] = [ res["metadata"] for res in results]
-        return messages, metadata
+        return self.ask_many([payload], n_choices=n_choices, temperature=temperature)[0]
+
+    def _generate_batch(self, requests:list) -> list:
+        # One row per choice, the pipeline pads all the conversations into a single batch
+        rows = [payload['messages'] for payload, n_choices, _ in requests for _ in range(n_choices)]
+        payload, n_choices, temperature = requests[0]
+        generation_args = {"do_sample": True, "temperature": temperature} if n_choices > 1 else {}
+
+        # Rows of a single prompt are decoded from its cached prefix instead
+        if self.prefix_cache_tokens and all(row == rows[0] for row in rows):
+            output_text = self._generate_from_prefix_cache(rows[0], len(rows), payload['max_tokens'], generation_args)
+            return self._split_rows(requests, [(output[0]["generated_text"][-1], output) for output in output_text])
+
+        tokenizer = self.pipeline.tokenizer
+        if tokenizer.pad_token_id is None:
+            tokenizer.pad_token_id = tokenizer.eos_token_id
+        tokenizer.padding_side = "left"
+
+        with torch.autocast(device_type='cuda'):
+            output_text = self.pipeline(
+                rows,
+                max_new_tokens=payload['max_tokens'],
+                batch_size=len(rows),
+                **generation_args
+            )
+        print('outputs: ', output_text)
+
+        return self._split_rows(requests, [(output[0]["generated_text"][-1], output) for output in output_text])
+
+    def _generate_from_prefix_cache(self, messages:list, num_rows:int, max_tokens:int, generation_args:dict) -> list:
+        '''
+        Generate num_rows answers to messages, resuming from the longest prefix of the prompt in the prefix cache.
+        Returns the outputs in the format of the text-generation pipeline.
+        '''
+        tokenizer = self.pipeline.tokenizer
+        model = self.pipeline.model
+        prefix_cache = get_prefix_cache(self._model_key, max_tokens=self.prefix_cache_tokens)
+
+        input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt").to(model.device)
+        tokens = input_ids[0].tolist()
+
+        # Encode the prompt but its last token on top of the cached prefix, and cache it for the next prompts
+        prefix_length, cache = prefix_cache.lookup(tokens[:-1])
+        if cache is None:
+            cache = transformers.DynamicCache()
+        with torch.no_grad(), torch.autocast(device_type='cuda'):
+            if prefix_length < len(tokens) - 1:
+                model(input_ids=input_ids[:, prefix_length:-1], past_key_values=cache, use_cache=True,
+                      cache_position=torch.arange(prefix_length, len(tokens) - 1, device=model.device))
+        prefix_cache.store(tokens[:-1], cache)
+
+        # Generation only has the last prompt token to encode
+        if num_rows > 1:
+            cache.batch_repeat_interleave(num_rows)
+        with torch.autocast(device_type='cuda'):
+            generated_ids = model.generate(
+                input_ids=input_ids.repeat(num_rows, 1),
+                attention_mask=torch.ones((num_rows, len(tokens)), dtype=torch.long, device=model.device),
+                past_key_values=cache,
+                max_new_tokens=max_tokens,
+                pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+                **generation_args
+            )
+        output_text = tokenizer.batch_decode(generated_ids[:, len(tokens):], skip_special_tokens=True)
+        print('outputs: ', output_text)
+
+        return [[{"generated_text": messages + [{"role": "assistant", "content": text}]}] for text in output_text]
 
 
     @staticmethod
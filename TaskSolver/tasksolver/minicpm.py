@@ -20,6 +20,7 @@ import math
 
 from .gpt4v import TaskSpec, ParsedAnswer, Question
 from .exceptions import GPTOutputParseException, GPTMaxTriesExceededException
+from .model_registry import SharedModelMixin
 import threading
 from typing import List, Tuple, Union
 from loguru import logger
@@ -36,14 +37,16 @@ torch.backends.cudnn.benchmark = False
 
 
 
-class MiniCPMModel(object):
+class MiniCPMModel(SharedModelMixin):
     def __init__(self, task:TaskSpec,
                  model:str = "openbmb/MiniCPM-V-2_6-int4"):
 
         self.task:TaskSpec = task
-        self.model = self.get_model(model)
 
-        self.tokenizer = AutoTokenizer.from_pretrained('openbmb/MiniCPM-V-2_6-int4', trust_remote_code=True)
+        # Weights and tokenizer are shared by all the MiniCPMModel of the process
+        self.model, self.tokenizer = self._acquire_model(model, 
+            lambda: (self.get_model(model), AutoTokenizer.from_pretrained('openbmb/MiniCPM-V-2_6-int4', trust_remote_code=True)),
+            dtype="float16", device="auto")
 
     
     def get_model(self, model):
@@ -64,48 +67,19 @@ class MiniCPMModel(object):
         args: 
             payload: json dictionary, prepared by `prepare_payload`
         """
-
-        def minicpm_thread(self, idx, payload, results, temperature):
-
-            # creation of payload
-            mod_payload = deepcopy(payload)
-            messages = payload['messages']
-            max_tokens = payload['max_tokens']
-
-
-            try:
-                # Preparation for inference
-                output_text = self.model.chat(
-                    image=None,
-                    msgs=messages,
-                    tokenizer=self.tokenizer
-                )
-            except Exception as e:
-                raise e
-            
-            print('outputs: ', output_text)
-            message = {'content' : output_text}
-
-            results[idx] = {"metadata": output_text, "message": message} 
-
-            return
-
-        assert n_choices >= 1
-        results = [None]  * n_choices 
-        if n_choices > 1:
-            minicpm_jobs = [threading.Thread(target=minicpm_thread,
-                            args=(self, idx, payload, results, temperature))
-                                for idx in range(n_choices)]
-            for job in minicpm_jobs:
-                job.start()
-            for job in minicpm_jobs:
-                job.join()
-        else:
-            minicpm_thread(self, 0, payload, results, temperature)
-
-        messages:List[dict] = [ res["message"] for res in results]
-        metadata:List[dict] = [ res["metadata"] for res in results]
-        return messages, metadata
+        return self.ask_many([payload], n_choices=n_choices, temperature=temperature)[0]
+
+    def _generate_batch(self, requests:list) -> list:
+        # One row per choice, chat() runs a list of conversations as one batch
+        rows = [payload['messages'] for payload, n_choices, _ in requests for _ in range(n_choices)]
+        output_text = self.model.chat(
+            image=None,
+            msgs=rows,
+            tokenizer=self.tokenizer
+        )
+        print('outputs: ', output_text)
+
+        return self._split_rows(requests, [({'content' : text}, text) for text in output_text])
 
 
     @staticmethod
@@ -0,0 +1,180 @@
+"""
+Process-wide registry of locally loaded model weights.
+
+The interfaces of the open-source models (QwenModel, PhiModel, ...) are created once per TaskSpec,
+and an agent run creates several of them for the same model. They get their weights (and
+processor/tokenizer) from this registry instead of calling from_pretrained themselves, so all the
+interfaces of a process share a single copy.
+
+Entries are keyed by (model id, dtype, device) and reference counted: the weights are dropped
+when the last interface holding them is closed.
+"""
+
+import gc
+from typing import List, Tuple
+import threading
+from loguru import logger
+
+from .batching import get_batcher
+from .prefix_cache import drop_prefix_cache
+from .response_cache import get_response_cache
+
+
+class ModelRegistry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}          # key -> loaded value
+        self._refcounts = {}        # key -> number of holders
+        self._load_locks = {}       # key -> lock held while loading, so a model is loaded only once
+
+    def acquire(self, key:tuple, loader):
+        '''
+        The value registered under key, loaded with loader() if it isn't yet. Every call must be
+        paired with a release(key).
+
+        Inputs:
+            key: (model id, dtype, device)
+            loader: function without arguments returning the value to share, e.g. (weights, processor)
+        '''
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                if key in self._entries:
+                    self._refcounts[key] += 1
+                    return self._entries[key]
+
+            logger.info(f"loading {key[0]} ({key[1]}, {key[2]}) into the model registry.")
+            value = loader()
+
+            with self._lock:
+                self._entries[key] = value
+                self._refcounts[key] = 1
+                return value
+
+    def release(self, key:tuple):
+        '''
+        Drop one reference to key. The value is unloaded when no reference is left.
+        '''
+        with self._lock:
+            if key not in self._refcounts:
+                return
+            self._refcounts[key] -= 1
+            if self._refcounts[key] > 0:
+                return
+            del self._refcounts[key]
+            del self._entries[key]
+        drop_prefix_cache(key)
+
+        logger.info(f"unloading {key[0]} ({key[1]}, {key[2]}) from the model registry.")
+        gc.collect()
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
+
+    def refcount(self, key:tuple) -> int:
+        with self._lock:
+            return self._refcounts.get(key, 0)
+
+    def loaded(self) -> list:
+        with self._lock:
+            return list(self._entries)
+
+
+_registry = ModelRegistry()
+
+
+def acquire_model(model_id:str, loader, dtype:str="float16", device:str="cuda:0"):
+    '''
+    Shared value (weights, processor, ...) of model_id for this dtype and device, see ModelRegistry.acquire.
+    '''
+    return _registry.acquire((model_id, str(dtype), str(device)), loader)
+
+
+def release_model(model_id:str, dtype:str="float16", device:str="cuda:0"):
+    _registry.release((model_id, str(dtype), str(device)))
+
+
+def get_model_registry() -> ModelRegistry:
+    return _registry
+
+
+class SharedModelMixin(object):
+    '''
+    Mixin of the open-source model interfaces: holds one reference to the registry entry of the
+    interface until close() (or garbage collection), and batches the generation requests made to
+    that entry (see batching.py).
+
+    Interfaces implement _generate_batch(requests), which runs a list of (payload, n_choices, temperature)
+    requests of one group in a single generate call, and returns the [(message, metadata), ...] of
+    the n_choices of each request.
+    '''
+    _model_key = None
+    max_batch_size = 8
+
+    def __getstate__(self):
+        # A pickled (e.g. Agent.save) copy holds no reference of its own
+        state = self.__dict__.copy()
+        state['_model_key'] = None
+        return state
+
+    def _acquire_model(self, model_id:str, loader, dtype:str="float16", device:str="cuda:0"):
+        self._model_key = (model_id, str(dtype), str(device))
+        return _registry.acquire(self._model_key, loader)
+
+    def close(self):
+        key, self._model_key = self._model_key, None
+        if key is not None:
+            _registry.release(key)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:   # interpreter shutdown
+            pass
+
+    @staticmethod
+    def _generation_group(payload:dict, n_choices:int, temperature:float):
+        # Choices are sampled at temperature when there are several, decoded as the model's defaults otherwise
+        return (payload.get('max_tokens'), temperature if n_choices > 1 else None)
+
+    @staticmethod
+    def _split_rows(requests:list, rows:list) -> list:
+        # rows holds the n_choices rows of each request, in order
+        results, start = [], 0
+        for _, n_choices, _ in requests:
+            results.append(rows[start:start + n_choices])
+            start += n_choices
+        return results
+
+    def ask_many(self, payloads:list, n_choices=1, temperature=0.7) -> List[Tuple[List[dict], List[dict]]]:
+        """
+        `ask` for several payloads, submitted together (and with the concurrent asks of other threads)
+        as a single batch.
+
+        Returns:
+            List of (messages, metadata), one per payload
+        """
+        assert n_choices >= 1
+
+        # Responses recorded in the response cache are not generated again
+        cache = get_response_cache()
+        responses = [None] * len(payloads)
+        if cache is not None:
+            keys = [cache.reserve_key(self._model_key[0], payload, n_choices, temperature) for payload in payloads]
+            responses = [cache.lookup(key) for key in keys]
+        missing = [idx for idx, response in enumerate(responses) if response is None]
+
+        requests = [(payloads[idx], n_choices, temperature) for idx in missing]
+        batcher = get_batcher(self._model_key, max_batch_size=self.max_batch_size)
+        results = batcher.submit_many(requests, self._generate_batch, sizes=[n_choices] * len(requests),
+                                      groups=[self._generation_group(*request) for request in requests]) if requests else []
+        for idx, choices in zip(missing, results):
+            responses[idx] = ([message for message, _ in choices], [metadata for _, metadata in choices])
+            if cache is not None:
+                cache.put(keys[idx], self._model_key[0], responses[idx])
+        return responses
@@ -1,19 +1,32 @@
 import ollama
 from .common import TaskSpec, ParsedAnswer, Question
 from .exceptions import GPTOutputParseException, GPTMaxTriesExceededException
+from .limits import limit_slot
+from .response_cache import cached_ask
+from .ratelimit import call_with_retries, acall_with_retries
+from .clients import get_ollama_client, get_async_ollama_client
+from .aio import AsyncInterfaceMixin, async_limit_slot
+import asyncio
 import threading
 from typing import List, Tuple, Union
 from loguru import logger
 from copy import deepcopy
 import time
 
-class OllamaModel(object):
+class OllamaModel(AsyncInterfaceMixin):
     def __init__(self, 
                  task:TaskSpec,
-                 model:str):
+                 model:str,
+                 host:str=None):
         self.task:TaskSpec = task
         self.model:str = model
 
+        self.host = host
+
+        # Long-lived client, shared by the threads (and the other interfaces) using this server
+        self.client = get_ollama_client(host)
+
+    @cached_ask
     def ask(self,  payload:dict, n_choices=1) -> Tuple[List[dict], List[dict]]:
         """
         args: 
@@ -30,11 +43,13 @@ class OllamaModel(object):
             #print('mod_payload["messages"]: ', payload["messages"])
 
             
-            try:
-                response = ollama.chat(model=self.model, messages=[
-                        mod_payload["messages"]])
-            except Exception as e:
-                raise e
+            def request():
+                with limit_slot("ollama"):     # shared with the other processes of the run, see limits.py
+                    return self.client.chat(model=self.model, messages=[
+                            mod_payload["messages"]])
+
+            # Transient errors (e.g. the server restarting) retried with backoff, see ratelimit.py
+            response = call_with_retries(request, "ollama")
             message = response["message"]
             metadata = response.copy()
             del metadata["message"]
@@ -57,6 +72,32 @@ class OllamaModel(object):
         metadata:List[dict] = [ res["metadata"] for res in results]
         return messages, metadata 
 
+    @cached_ask
+    async def aask(self,  payload:dict, n_choices=1) -> Tuple[List[dict], List[dict]]:
+        """
+        Async `ask()`, the n_choices are concurrent requests.
+        """
+        client = get_async_ollama_client(self.host)
+
+        async def ollama_request():
+            string_message = "\n".join([el["text"] for el in payload["messages"]["content"]])
+            mod_payload = deepcopy(payload)
+            mod_payload["messages"]["content"] = string_message # overridding with string version
+            async def request():
+                async with async_limit_slot("ollama"):     # see aio.py
+                    return await client.chat(model=self.model, messages=[mod_payload["messages"]])
+            response = await acall_with_retries(request, "ollama")
+            message = response["message"]
+            metadata = dict(response)
+            del metadata["message"]
+            return message, metadata
+
+        assert n_choices >= 1
+        results = await asyncio.gather(*[ollama_request() for _ in range(n_choices)])
+        messages:List[dict] = [message for message, _ in results]
+        metadata:List[dict] = [metadata for _, metadata in results]
+        return messages, metadata
+
     @staticmethod
     def prepare_payload(question:Question,
             verbose:bool=False,
@@ -21,6 +21,7 @@ import math
 
 from .gpt4v import TaskSpec, ParsedAnswer, Question
 from .exceptions import GPTOutputParseException, GPTMaxTriesExceededException
+from .model_registry import SharedModelMixin
 import threading
 from typing import List, Tuple, Union
 from loguru import logger
@@ -37,17 +38,16 @@ torch.backends.cudnn.benchmark = False
 
 
 
-class PhiModel(object):
+class PhiModel(SharedModelMixin):
     def __init__(self, task:TaskSpec,
                  model:str = "microsoft/Phi-3.5-vision-instruct"):
 
         self.task:TaskSpec = task
-        self.model = self.get_model(model)
 
-        self.processor = AutoProcessor.from_pretrained(model, 
-            trust_remote_code=True, 
-            num_crops=4
-        ) 
+        # Weights and processor are shared by all the PhiModel of the process
+        self.model, self.processor = self._acquire_model(model, 
+            lambda: (self.get_model(model), AutoProcessor.from_pretrained(model, trust_remote_code=True, num_crops=4)),
+            dtype="float16", device="sequential")
 
     
     def get_model(self, model):
@@ -68,71 +68,43 @@ class PhiModel(object):
         args: 
             payload: json dictionary, prepared by `prepare_payload`
         """
+        return self.ask_many([payload], n_choices=n_choices, temperature=temperature)[0]
 
-        def phi_thread(self, idx, payload, results, temperature):
-
-            # creation of payload
-            mod_payload = deepcopy(payload)
-
+    def _generate_batch(self, requests:list) -> list:
+        # The Phi-3.5 processor takes one prompt at a time: the choices of a prompt are decoded 
+        # together (num_return_sequences), prompts one after the other
+        rows = []
+        for payload, n_choices, temperature in requests:
             prompt = self.processor.tokenizer.apply_chat_template(
             payload['messages'], 
             tokenize=False, 
             add_generation_prompt=True
             )
 
-            inputs = self.processor(prompt, mod_payload['images'], return_tensors="pt").to('cuda')
+            inputs = self.processor(prompt, payload['images'], return_tensors="pt").to('cuda')
 
             generation_args = { 
                 "max_new_tokens": payload['max_tokens'], 
                 "temperature": temperature, 
-                "do_sample": False, 
+                "do_sample": n_choices > 1, 
+                "num_return_sequences": n_choices,
             } 
 
-            try:
-                # Preparation for inference
-                generate_ids = self.model.generate(**inputs, 
-                    eos_token_id=self.processor.tokenizer.eos_token_id, 
-                    **generation_args
-                )
-
-                generate_ids = self.model.generate(**inputs, 
-                    eos_token_id=self.processor.tokenizer.eos_token_id, 
-                    **generation_args
-                )
-
-                # remove input tokens 
-                generate_ids = generate_ids[:, inputs['input_ids'].shape[1]:]
-                response = self.processor.batch_decode(generate_ids, 
-                skip_special_tokens=True, 
-                clean_up_tokenization_spaces=False)[0] 
-
-            except Exception as e:
-                raise e
-            
-            output_text = response
-            print('outputs: ', output_text)
-            message = {'content' : output_text}
-
-            results[idx] = {"metadata": output_text, "message": message} 
-
-            return
-
-        assert n_choices >= 1
-        results = [None]  * n_choices 
-        if n_choices > 1:
-            phi_jobs = [threading.Thread(target=phi_thread,
-                            args=(self, idx, payload, results, temperature))
-                                for idx in range(n_choices)]
-            for job in phi_jobs:
-                job.start()
-            for job in phi_jobs:
-                job.join()
-        else:
-            phi_thread(self, 0, payload, results, temperature)
-
-        messages:List[dict] = [ res["message"] for res in results]
-        metadata:List[dict] = [ res["metadata"] for res in results]
-        return messages, metadata
+            generate_ids = self.model.generate(**inputs, 
+                eos_token_id=self.processor.tokenizer.eos_token_id, 
+                **generation_args
+            )
+
+            # remove input tokens 
+            generate_ids = generate_ids[:, inputs['input_ids'].shape[1]:]
+            responses = self.processor.batch_decode(generate_ids, 
+            skip_special_tokens=True, 
+            clean_up_tokenization_spaces=False)
+
+            print('outputs: ', responses)
+            rows += [({'content' : response}, response) for response in responses]
+
+        return self._split_rows(requests, rows)
 
 
     @staticmethod
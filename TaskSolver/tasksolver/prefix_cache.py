@@ -0,0 +1,115 @@
+"""
+Prefix KV cache for the local models.
+
+The questions of a run share long preambles: every first_question repeats the task description,
+the parser docs and the examples, and the questions of one tree level share the same code. The
+cache keeps the key/value states of recent prompts (as transformers DynamicCache objects), and a
+new prompt resumes from the longest prefix it shares with one of them instead of re-encoding it.
+
+The cache is bounded by the total number of cached tokens, least recently used prompts are evicted
+first. It is shared by all the interfaces of a model (see get_prefix_cache).
+"""
+
+import copy
+import threading
+from collections import OrderedDict
+
+
+def common_prefix_length(tokens1, tokens2) -> int:
+    n = min(len(tokens1), len(tokens2))
+    for idx in range(n):
+        if tokens1[idx] != tokens2[idx]:
+            return idx
+    return n
+
+
+class PrefixKVCache(object):
+    def __init__(self, max_tokens:int=16384, min_prefix_tokens:int=64):
+        '''
+        Inputs:
+            max_tokens: max total number of tokens whose states are kept
+            min_prefix_tokens: shorter shared prefixes are not worth a cache copy, and are ignored
+        '''
+        self.max_tokens = max_tokens
+        self.min_prefix_tokens = min_prefix_tokens
+        self._entries = OrderedDict()   # tuple of token ids -> cache of these tokens
+        self._num_tokens = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def lookup(self, tokens:list):
+        '''
+        Inputs:
+            tokens: token ids of the prompt
+        Outputs:
+            prefix_length: number of leading tokens of the prompt covered by cache, 0 on a miss
+            cache: a copy of the cached states, cropped to prefix_length, that generation can extend; None on a miss
+        '''
+        with self._lock:
+            best_key, prefix_length = None, 0
+            for key in self._entries:
+                length = common_prefix_length(key, tokens)
+                if length > prefix_length:
+                    best_key, prefix_length = key, length
+            if best_key is None or prefix_length < self.min_prefix_tokens:
+                self.misses += 1
+                return 0, None
+
+            self._entries.move_to_end(best_key)
+            cache = copy.deepcopy(self._entries[best_key])
+            self.hits += 1
+            self.reused_tokens += prefix_length
+
+        if prefix_length < cache.get_seq_length():
+            cache.crop(prefix_length)
+        return prefix_length, cache
+
+    def store(self, tokens:list, cache):
+        '''
+        Keep (a copy of) cache, the states of exactly tokens.
+        '''
+        key = tuple(tokens)
+        if len(key) < self.min_prefix_tokens or len(key) > self.max_tokens:
+            return
+        cache = copy.deepcopy(cache)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = cache
+            self._num_tokens += len(key)
+            while self._num_tokens > self.max_tokens:
+                evicted, _ = self._entries.popitem(last=False)
+                self._num_tokens -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._num_tokens = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "reused_tokens": self.reused_tokens,
+                    "entries": len(self._entries), "cached_tokens": self._num_tokens}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_prefix_cache(key, max_tokens:int=16384) -> PrefixKVCache:
+    '''
+    The PrefixKVCache of the model registered under key (see model_registry), shared by all
+    the interfaces of that model.
+    '''
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = PrefixKVCache(max_tokens=max_tokens)
+        return _caches[key]
+
+
+def drop_prefix_cache(key):
+    with _caches_lock:
+        _caches.pop(key, None)
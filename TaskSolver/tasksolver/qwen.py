@@ -21,6 +21,7 @@ import math
 
 from .gpt4v import TaskSpec, ParsedAnswer, Question
 from .exceptions import GPTOutputParseException, GPTMaxTriesExceededException
+from .model_registry import SharedModelMixin
 import threading
 from typing import List, Tuple, Union
 from loguru import logger
@@ -37,14 +38,16 @@ torch.backends.cudnn.benchmark = False
 
 
 
-class QwenModel(object):
+class QwenModel(SharedModelMixin):
     def __init__(self, task:TaskSpec,
                  model:str = "Qwen/Qwen2-VL-7B-Instruct-AWQ"):
 
         self.task:TaskSpec = task
-        self.model = self.get_model(model)
 
-        self.processor = AutoProcessor.from_pretrained("Qwen/Qwen2-VL-7B-Instruct-AWQ")
+        # Weights and processor are shared by all the QwenModel of the process
+        self.model, self.processor = self._acquire_model(model, 
+            lambda: (self.get_model(model), AutoProcessor.from_pretrained("Qwen/Qwen2-VL-7B-Instruct-AWQ")),
+            dtype="float16", device="cuda:0")
 
     
     def get_model(self, model):
@@ -69,65 +72,37 @@ class QwenModel(object):
         args: 
             payload: json dictionary, prepared by `prepare_payload`
         """
-
-        def qwen_thread(self, idx, payload, results, temperature):
-
-            # creation of payload
-            mod_payload = deepcopy(payload)
-            messages = payload['messages']
-            max_tokens = payload['max_tokens']
-
-
-            try:
-                # Preparation for inference
-                text = self.processor.apply_chat_template(
-                    messages, tokenize=False, add_generation_prompt=True
-                )
-                image_inputs, video_inputs = process_vision_info(messages)
-                inputs = self.processor(
-                    text=[text],
-                    images=image_inputs,
-                    videos=video_inputs,
-                    padding=True,
-                    return_tensors="pt",
-                )
-                inputs = inputs.to("cuda:0")
-
-                # Inference: Generation of the output
-                generated_ids = self.model.generate(**inputs, max_new_tokens=max_tokens)
-                generated_ids_trimmed = [
-                    out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-                ]
-
-                output_text = self.processor.batch_decode(
-                    generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
-                )
-            except Exception as e:
-                raise e
-            
-            print('outputs: ', output_text)
-            message = {'content' : output_text[0]}
-
-            results[idx] = {"metadata": output_text, "message": message} 
-
-            return
-
-        assert n_choices >= 1
-        results = [None]  * n_choices 
-        if n_choices > 1:
-            qwen_jobs = [threading.Thread(target=qwen_thread,
-                            args=(self, idx, payload, results, temperature))
-                                for idx in range(n_choices)]
-            for job in qwen_jobs:
-                job.start()
-            for job in qwen_jobs:
-                job.join()
-        else:
-            qwen_thread(self, 0, payload, results, temperature)
-
-        messages:List[dict] = [ res["message"] for res in results]
-        metadata:List[dict] = [ res["metadata"] for res in results]
-        return messages, metadata
+        return self.ask_many([payload], n_choices=n_choices, temperature=temperature)[0]
+
+    def _generate_batch(self, requests:list) -> list:
+        # One row per choice, all the prompts left-padded into a single batch
+        rows = [payload['messages'] for payload, n_choices, _ in requests for _ in range(n_choices)]
+        payload, n_choices, temperature = requests[0]
+        generation_args = {"do_sample": True, "temperature": temperature} if n_choices > 1 else {}
+
+        # Preparation for inference
+        texts = [self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True) for messages in rows]
+        image_inputs, video_inputs = process_vision_info(rows)
+        self.processor.tokenizer.padding_side = "left"
+        inputs = self.processor(
+            text=texts,
+            images=image_inputs,
+            videos=video_inputs,
+            padding=True,
+            return_tensors="pt",
+        )
+        inputs = inputs.to("cuda:0")
+
+        # Inference: Generation of the output
+        generated_ids = self.model.generate(**inputs, max_new_tokens=payload['max_tokens'], **generation_args)
+        generated_ids_trimmed = generated_ids[:, inputs.input_ids.shape[1]:]
+
+        output_text = self.processor.batch_decode(
+            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )
+        print('outputs: ', output_text)
+
+        return self._split_rows(requests, [({'content' : text}, [text]) for text in output_text])
 
 
     @staticmethod
@@ -0,0 +1,288 @@
+"""
+Rate limiting and retries of the VLM API requests.
+
+    TokenBucket: requests (or tokens) per minute, refilled continuously. Each provider has a
+        request bucket and a token bucket, sized from the environment:
+            TASKSOLVER_RPM_<NAME>: requests per minute of provider <name> (e.g. TASKSOLVER_RPM_OPENAI)
+            TASKSOLVER_TPM_<NAME>: tokens per minute, counting the prompt estimate and max_tokens
+        Providers without these variables are not throttled.
+    classify_error: whether an exception of a request is worth retrying, and after how long the
+        provider asked us to retry (Retry-After).
+    backoff_delay: exponential backoff with full jitter, never shorter than Retry-After.
+    call_with_retries: runs a request with all of the above.
+
+Time spent waiting on buckets and backing off is recorded per provider, see throttle_stats().
+"""
+
+import os
+import time
+import random
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+from loguru import logger
+
+RPM_ENV_VAR_PREFIX = "TASKSOLVER_RPM_"
+TPM_ENV_VAR_PREFIX = "TASKSOLVER_TPM_"
+
+RETRYABLE_STATUS_CODES = (408, 409, 425, 429, 500, 502, 503, 504, 529)
+
+
+class TokenBucket(object):
+    def __init__(self, per_minute:float, capacity:float=None):
+        '''
+        Inputs:
+            per_minute: refill rate
+            capacity[optional]: max tokens that can be spent at once, per_minute by default
+        '''
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens:float) -> float:
+        # Take tokens now (possibly going into debt) and return how long to wait for them
+        tokens = min(tokens, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self, tokens:float=1) -> float:
+        '''
+        Block until tokens are available. Returns the time waited, in seconds.
+        '''
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self, tokens:float=1) -> float:
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+
+class ThrottleStats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, provider:str, kind:str, seconds:float):
+        '''
+        kind: "bucket" (waiting for the rate limit) or "backoff" (waiting before a retry)
+        '''
+        with self._lock:
+            stats = self._stats.setdefault(provider, {"bucket_seconds": 0.0, "backoff_seconds": 0.0, "retries": 0, "fatal_errors": 0})
+            stats[f"{kind}_seconds"] += seconds
+            if kind == "backoff":
+                stats["retries"] += 1
+
+    def record_fatal(self, provider:str):
+        with self._lock:
+            stats = self._stats.setdefault(provider, {"bucket_seconds": 0.0, "backoff_seconds": 0.0, "retries": 0, "fatal_errors": 0})
+            stats["fatal_errors"] += 1
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {provider: dict(stats) for provider, stats in self._stats.items()}
+
+
+_stats = ThrottleStats()
+
+
+def throttle_stats() -> dict:
+    '''
+    Per provider: seconds spent waiting on the rate limits and backing off, number of retries and of fatal errors.
+    '''
+    return _stats.as_dict()
+
+
+class ProviderRateLimiter(object):
+    def __init__(self, name:str, rpm:float=None, tpm:float=None):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+
+    def acquire(self, tokens:int=0):
+        waited = 0.0
+        if self.requests is not None:
+            waited += self.requests.acquire(1)
+        if self.tokens is not None and tokens:
+            waited += self.tokens.acquire(tokens)
+        if waited:
+            _stats.record(self.name, "bucket", waited)
+
+    async def aacquire(self, tokens:int=0):
+        waited = 0.0
+        if self.requests is not None:
+            waited += await self.requests.aacquire(1)
+        if self.tokens is not None and tokens:
+            waited += await self.tokens.aacquire(tokens)
+        if waited:
+            _stats.record(self.name, "bucket", waited)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name:str) -> ProviderRateLimiter:
+    '''
+    The process-wide rate limiter of provider `name` (e.g. "openai"), sized from the environment.
+    '''
+    with _limiters_lock:
+        if name not in _limiters:
+            rpm = os.environ.get(RPM_ENV_VAR_PREFIX + name.upper())
+            tpm = os.environ.get(TPM_ENV_VAR_PREFIX + name.upper())
+            _limiters[name] = ProviderRateLimiter(name, rpm=float(rpm) if rpm else None, tpm=float(tpm) if tpm else None)
+        return _limiters[name]
+
+
+def _text_length(obj) -> int:
+    # Characters of the text parts of messages, leaving out the encoded images
+    if isinstance(obj, str):
+        return len(obj)
+    if isinstance(obj, dict):
+        return sum(_text_length(value) for key, value in obj.items() if key not in ("image_url", "source", "image"))
+    if isinstance(obj, (list, tuple)):
+        return sum(_text_length(value) for value in obj)
+    return 0
+
+
+def estimate_tokens(payload:dict) -> int:
+    '''
+    Rough token count of a request, for the token buckets: ~4 characters per prompt token, plus max_tokens.
+    Images are counted by the "image_tokens" estimate of prepare_payload (see image_budget.py) when
+    the payload has one, otherwise by the length of their encoding, an over-estimate.
+    '''
+    if "image_tokens" in payload:
+        prompt_tokens = _text_length(payload.get("messages", "")) // 4 + int(payload["image_tokens"])
+    else:
+        prompt_tokens = len(str(payload.get("messages", ""))) // 4
+    return prompt_tokens + int(payload.get("max_tokens") or 0)
+
+
+def _retry_after(error:Exception):
+    # Seconds asked for by the Retry-After header of the response of error, if any
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(error:Exception):
+    '''
+    Outputs:
+        retryable: whether the request may succeed if sent again (rate limits, overload, server and network errors)
+        retry_after: seconds the provider asked to wait, or None
+    '''
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is None:
+        status = getattr(error, "code", None)     # google.api_core exceptions
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS_CODES, _retry_after(error)
+
+    # Errors without a status: timeouts and dropped connections are transient
+    names = {cls.__name__ for cls in type(error).__mro__}
+    if isinstance(error, (TimeoutError, ConnectionError)) or names & {
+            "APIConnectionError", "APITimeoutError", "TimeoutException", "NetworkError", "RemoteProtocolError",
+            "ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded", "InternalServerError", "RateLimitError"}:
+        return True, _retry_after(error)
+    return False, None
+
+
+def backoff_delay(attempt:int, retry_after:float=None, base:float=1.0, max_delay:float=60.0) -> float:
+    '''
+    Delay before retry number `attempt` (1-based): uniform in [0, base * 2^(attempt-1)], capped at
+    max_delay, and at least retry_after.
+    '''
+    delay = random.uniform(0, min(max_delay, base * 2 ** (attempt - 1)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def wait_before_retry(error:Exception, attempt:int, max_tries:int, provider:str="unknown") -> bool:
+    '''
+    For callers running their own retry loop: returns False (right away) if error is fatal or
+    max_tries is reached, otherwise sleeps the backoff delay of attempt and returns True.
+    '''
+    retryable, retry_after = classify_error(error)
+    if not retryable or attempt >= max_tries:
+        if not retryable:
+            _stats.record_fatal(provider)
+        return False
+    delay = backoff_delay(attempt, retry_after=retry_after)
+    logger.warning(f"{provider} request failed ({type(error).__name__}: {error}), retry {attempt}/{max_tries - 1} in {delay:.1f}s.")
+    _stats.record(provider, "backoff", delay)
+    time.sleep(delay)
+    return True
+
+
+def call_with_retries(request, provider:str, tokens:int=0, max_tries:int=5):
+    '''
+    Run request() under the rate limits of provider, retrying retryable errors with backoff.
+
+    Inputs:
+        request: function without arguments sending the request
+        provider: e.g. "openai"
+        tokens[optional]: estimated tokens of the request, for the token bucket
+        max_tries[optional]: total number of attempts
+    '''
+    limiter = get_rate_limiter(provider)
+    attempt = 0
+    while True:
+        attempt += 1
+        limiter.acquire(tokens)
+        try:
+            return request()
+        except Exception as e:
+            if not wait_before_retry(e, attempt, max_tries, provider=provider):
+                raise
+
+
+async def acall_with_retries(request, provider:str, tokens:int=0, max_tries:int=5):
+    '''
+    Async call_with_retries, request is a function returning an awaitable.
+    '''
+    limiter = get_rate_limiter(provider)
+    attempt = 0
+    while True:
+        attempt += 1
+        await limiter.aacquire(tokens)
+        try:
+            return await request()
+        except Exception as e:
+            retryable, retry_after = classify_error(e)
+            if not retryable or attempt >= max_tries:
+                if not retryable:
+                    _stats.record_fatal(provider)
+                raise
+            delay = backoff_delay(attempt, retry_after=retry_after)
+            logger.warning(f"{provider} request failed ({type(e).__name__}: {e}), retry {attempt}/{max_tries - 1} in {delay:.1f}s.")
+            _stats.record(provider, "backoff", delay)
+            await asyncio.sleep(delay)
@@ -0,0 +1,213 @@
+"""
+Record/replay cache of the VLM responses, in a SQLite file.
+
+The `ask` of every interface goes through the cache when one is configured. Requests are keyed by
+the model id, the payload (images by content hash), n_choices, temperature and the sample index:
+the k-th identical request of a process gets the k-th recorded response, so the `breadth` identical
+questions of a tree level keep their distinct samples on replay.
+
+Modes:
+    record: cached responses are returned, the others are requested and stored
+    replay: only cached responses are returned, a miss raises ResponseCacheMiss. Runs `refinement()`
+        without any model, e.g. to benchmark the rest of the pipeline.
+    passthrough: the cache is not used
+
+Configuration, through the environment so that it is inherited by subprocesses:
+    TASKSOLVER_RESPONSE_CACHE: path of the SQLite file. No cache when it is not set.
+    TASKSOLVER_RESPONSE_CACHE_MODE: record (default), replay or passthrough
+"""
+
+import os
+import json
+import time
+import base64
+import hashlib
+import sqlite3
+import inspect
+import functools
+import threading
+from loguru import logger
+
+CACHE_PATH_ENV_VAR = "TASKSOLVER_RESPONSE_CACHE"
+CACHE_MODE_ENV_VAR = "TASKSOLVER_RESPONSE_CACHE_MODE"
+MODES = ("record", "replay", "passthrough")
+
+
+class ResponseCacheMiss(Exception):
+    pass
+
+
+def _normalize(obj):
+    # json.dumps default: content hashes of the non-json parts of payloads
+    if hasattr(obj, "tobytes") and hasattr(obj, "mode") and hasattr(obj, "size"):     # PIL image
+        return {"image": hashlib.sha256(f"{obj.mode}:{obj.size}:".encode() + obj.tobytes()).hexdigest()}
+    if hasattr(obj, "detach") and hasattr(obj, "cpu"):      # torch tensor
+        array = obj.detach().cpu().numpy()
+        return {"tensor": hashlib.sha256(str(array.shape).encode() + array.tobytes()).hexdigest()}
+    if hasattr(obj, "tobytes"):     # numpy array
+        return {"array": hashlib.sha256(str(obj.shape).encode() + obj.tobytes()).hexdigest()}
+    if isinstance(obj, bytes):
+        return {"bytes": hashlib.sha256(obj).hexdigest()}
+    return repr(obj)
+
+
+def request_key(model_id:str, payload, n_choices:int, temperature, sample_index:int=0) -> str:
+    '''
+    Key of a request, see the module docstring.
+    '''
+    normalized = json.dumps(payload, sort_keys=True, default=_normalize)
+    sha = hashlib.sha256()
+    sha.update(json.dumps([str(model_id), n_choices, temperature, sample_index]).encode())
+    sha.update(normalized.encode())
+    return sha.hexdigest()
+
+
+def _to_json(obj):
+    # Responses are stored as json, objects (e.g. Gemini's raw responses) by their dict or string form
+    if hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    if hasattr(obj, "dict"):
+        return obj.dict()
+    if isinstance(obj, bytes):
+        return base64.b64encode(obj).decode()
+    return str(obj)
+
+
+class ResponseCache(object):
+    def __init__(self, path:str, mode:str="record"):
+        if mode not in MODES:
+            raise ValueError(f"Unknown response cache mode {mode}, expected one of {MODES}.")
+        self.path = os.path.abspath(path)
+        self.mode = mode
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")      # several processes can record into the same file
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL)""")
+        self._conn.commit()
+        self._occurrences = {}      # request key without sample index -> number of requests seen
+        self.hits = 0
+        self.misses = 0
+
+    def reserve_key(self, model_id:str, payload, n_choices:int, temperature) -> str:
+        '''
+        Key of the next occurrence of this request in the process.
+        '''
+        base_key = request_key(model_id, payload, n_choices, temperature)
+        with self._lock:
+            sample_index = self._occurrences.get(base_key, 0)
+            self._occurrences[base_key] = sample_index + 1
+        return request_key(model_id, payload, n_choices, temperature, sample_index=sample_index)
+
+    def get(self, key:str):
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        messages, metadata = json.loads(row[0])
+        return messages, metadata
+
+    def put(self, key:str, model_id:str, response):
+        messages, metadata = response
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                               (key, str(model_id), json.dumps([messages, metadata], default=_to_json), time.time()))
+            self._conn.commit()
+
+    def lookup(self, key:str):
+        '''
+        The cached response of key, None on a miss that may be requested. Raises ResponseCacheMiss in replay mode.
+        '''
+        response = self.get(key)
+        if response is None and self.mode == "replay":
+            raise ResponseCacheMiss(f"No recorded response for request {key} in {self.path}.")
+        return response
+
+    def stats(self) -> dict:
+        with self._lock:
+            num_responses = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "responses": num_responses, "mode": self.mode}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_response_cache():
+    '''
+    The ResponseCache configured in the environment, or None.
+    '''
+    path = os.environ.get(CACHE_PATH_ENV_VAR)
+    mode = os.environ.get(CACHE_MODE_ENV_VAR, "record")
+    if not path or mode == "passthrough":
+        return None
+    with _caches_lock:
+        if (path, mode) not in _caches:
+            _caches[(path, mode)] = ResponseCache(path, mode)
+            logger.info(f"VLM responses are cached in {path} ({mode} mode).")
+        return _caches[(path, mode)]
+
+
+def response_cache_env(path:str, mode:str="record") -> dict:
+    '''
+    Environment variables configuring the cache, to be set in os.environ or passed to subprocesses.
+    '''
+    if mode not in MODES:
+        raise ValueError(f"Unknown response cache mode {mode}, expected one of {MODES}.")
+    return {CACHE_PATH_ENV_VAR: os.path.abspath(path), CACHE_MODE_ENV_VAR: mode}
+
+
+def model_id_of(interface) -> str:
+    # API interfaces name their model in self.model, local ones are keyed in the model registry
+    model_key = getattr(interface, "_model_key", None)
+    if model_key is not None:
+        return model_key[0]
+    model = getattr(interface, "model", None)
+    return model if isinstance(model, str) else getattr(interface, "model_id", type(interface).__name__)
+
+
+def cached_ask(ask):
+    '''
+    Decorator of the `ask(self, payload, n_choices=1, temperature=...)` (or async `aask`) methods of the
+    interfaces, looking the response up in and recording it to the response cache.
+    '''
+    signature = inspect.signature(ask)
+
+    def request_of(self, args, kwargs):
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        arguments = bound.arguments
+        return arguments["payload"], arguments.get("n_choices", 1), arguments.get("temperature")
+
+    if inspect.iscoroutinefunction(ask):
+        @functools.wraps(ask)
+        async def async_wrapper(self, *args, **kwargs):
+            cache = get_response_cache()
+            if cache is None:
+                return await ask(self, *args, **kwargs)
+            model_id = model_id_of(self)
+            key = cache.reserve_key(model_id, *request_of(self, args, kwargs))
+            response = cache.lookup(key)
+            if response is None:
+                response = await ask(self, *args, **kwargs)
+                cache.put(key, model_id, response)
+            return response
+        return async_wrapper
+
+    @functools.wraps(ask)
+    def wrapper(self, *args, **kwargs):
+        cache = get_response_cache()
+        if cache is None:
+            return ask(self, *args, **kwargs)
+        model_id = model_id_of(self)
+        key = cache.reserve_key(model_id, *request_of(self, args, kwargs))
+        response = cache.lookup(key)
+        if response is None:
+            response = ask(self, *args, **kwargs)
+            cache.put(key, model_id, response)
+        return response
+    return wrapper
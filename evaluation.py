@@ -3,12 +3,23 @@
 # Input modules
 import os
 import sys
+import shutil
 import subprocess
 import argparse
 import time
 import json
+import queue
+import threading
 from PIL import Image
-from utils import photometric_loss, img2img_clip_similarity, blender_step, clip_similarity
+from utils import photometric_loss, img2img_clip_similarity, blender_step, blender_step_batch, clip_similarity
+from system.utils.blender_pool import ensure_worker_pool
+from system.utils.render_cache import ensure_render_cache, save_cache_stats
+from system.utils.clip_scorer import get_clip_scorer
+from system.utils.embedding_store import image_hash
+from system.utils.photometric import photometric_losses
+from system.utils.journal import Journal
+from system.utils.metadata_journal import MetadataJournal, JOURNAL_EXTENSION, compact_records, load_inference_metadata
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from tqdm import tqdm
 
 task_instance_count_dict = {
@@ -19,13 +30,129 @@ task_instance_count_dict = {
     'lighting': 40
 }
 
+def render_proposal(infinigen_installation_path, blender_file_path, blender_render_script_path, proposal_path, proposal_renders_dir):
+    '''
+    Render stage job. Returns whether the proposal is executable in Blender-Python API, i.e. rendered.
+    '''
+    try:
+        return bool(blender_step(infinigen_installation_path, blender_file_path, blender_render_script_path, proposal_path, proposal_renders_dir, merge_all_renders=False, replace_if_overlap=True))
+    except:
+        return False
+
+
+def render_proposals_batch(infinigen_installation_path, blender_file_path, blender_render_script_path, jobs):
+    '''
+    Render stage job for all the (proposal_path, proposal_renders_dir) of an instance in a single Blender process.
+    Returns None if the batch failed as a whole (e.g. Blender missing), which says nothing about the proposals.
+    '''
+    try:
+        return [bool(executable) for executable in blender_step_batch(infinigen_installation_path, blender_file_path, blender_render_script_path, jobs, merge_all_renders=False, replace_if_overlap=True)]
+    except Exception as e:
+        print(f'Batch render of {len(jobs)} proposals failed, they will be rendered again on resume: {e}')
+        return None
+
+
+def score_instance(task_instance_dir, instance_info, executable_proposal_names, embedding_store=None, photometric_chunk_size=64):
+    '''
+    Scoring stage: n_clip and pl of every render of the executable proposals of an instance, against the goal renders.
+
+    Outputs:
+        task_instance_scores: the scores saved to scores.json
+        render_hashes: content hashes of the scored renders (keys of the embedding store)
+    '''
+    # Store local scores: score for each executable render
+    task_instance_scores = {}
+
+    # CLIP-embed the goal views once and all proposal renders in batched passes, 
+    # the similarities of every (proposal render, goal view) pair then come from one matrix product
+    clip_scorer = get_clip_scorer()
+    goal_renders_dir = os.path.join(task_instance_dir, 'goal')
+    goal_renders = {render_name: Image.open(os.path.join(goal_renders_dir, render_name)) for render_name in sorted(os.listdir(goal_renders_dir))}
+    proposal_renders = {os.path.join(proposal_renders_dir, render_name): Image.open(os.path.join(proposal_renders_dir, render_name))
+                        for proposal_renders_dir, proposal_name in executable_proposal_names if proposal_name != 'goal'
+                        for render_name in os.listdir(proposal_renders_dir)}
+    clip_similarities = clip_scorer.similarity(clip_scorer.embed_images(list(proposal_renders.values()), store=embedding_store), 
+                                               clip_scorer.embed_images(list(goal_renders.values()), store=embedding_store))
+    clip_rows = {render_path: row for row, render_path in enumerate(proposal_renders)}
+    clip_cols = {render_name: col for col, render_name in enumerate(goal_renders)}
+    render_hashes = [image_hash(render) for render in list(proposal_renders.values()) + list(goal_renders.values())] if embedding_store is not None else []
+
+    # Photometric loss of all proposal renders against their goal view in vectorized chunks, each goal view decoded once
+    photometric_loss_by_render = dict(zip(proposal_renders, photometric_losses(
+                                    list(proposal_renders.values()), list(goal_renders.values()),
+                                    goal_rows=[clip_cols[os.path.basename(render_path)] for render_path in proposal_renders],
+                                    chunk_size=photometric_chunk_size)))
+
+    # Loop through each executable proposal to compute their scores
+    for proposal_renders_dir, proposal_name in executable_proposal_names:
+        if proposal_name == 'goal':
+            continue
+
+        task_instance_scores[proposal_name] = {}    
+
+        n_clip_views = []
+        pl_views = []    
+
+        for render_name in os.listdir(proposal_renders_dir):
+            task_instance_scores[proposal_name][render_name] = {}
+
+            proposal_render_path = os.path.join(proposal_renders_dir, render_name)
+
+            # Look up n_clip and pl of the render against its goal view
+            n_clip = float(1 - clip_similarities[clip_rows[proposal_render_path], clip_cols[render_name]])
+            pl = float(photometric_loss_by_render[proposal_render_path])
+
+            # Aggregate scores across all views for a proposal edit to compute average
+            n_clip_views.append(n_clip)
+            pl_views.append(pl)
+
+            # Record scores for this render
+            task_instance_scores[proposal_name][render_name]['n_clip'] = n_clip
+            task_instance_scores[proposal_name][render_name]['pl'] = pl 
+        
+        # Compute average n_clip for this proposal
+        if n_clip_views:
+            average_n_clip_views = sum(n_clip_views) / len(n_clip_views)
+
+        # Compute average pl for this task instance
+        if pl_views:
+            average_pl_views = sum(pl_views) / len(pl_views)
+
+        # Record average scores for a proposal 
+        task_instance_scores[proposal_name]['avg_n_clip'] = average_n_clip_views
+        task_instance_scores[proposal_name]['avg_pl'] = average_pl_views 
+
+    # Extract best scores and record them
+    best_n_clip_proposal_name = min(task_instance_scores, key=lambda proposal_name: task_instance_scores[proposal_name]['avg_n_clip'])            
+    best_pl_proposal_name = min(task_instance_scores, key=lambda proposal_name: task_instance_scores[proposal_name]['avg_pl'])
+    best_n_clip = task_instance_scores[best_n_clip_proposal_name]['avg_n_clip']
+    best_pl = task_instance_scores[best_pl_proposal_name]['avg_pl']
+    task_instance_scores['best_n_clip'] = (best_n_clip_proposal_name, best_n_clip)
+    task_instance_scores['best_pl'] = (best_pl_proposal_name, best_pl)
+
+    # Handle selected edit if applicable
+    selected_proposal_path = instance_info['selected_edit_path']
+    if selected_proposal_path:
+        selected_proposal_name = os.path.basename(selected_proposal_path).split('.')[0]
+        selectd_n_clip = task_instance_scores[selected_proposal_name]['avg_n_clip']
+        selected_pl = task_instance_scores[selected_proposal_name]['avg_pl']
+        task_instance_scores['selected_scores'] =  (selected_proposal_name, {'avg_n_clip':selectd_n_clip, 'avg_pl':selected_pl})
+
+    # Save the local scores to the task_instance dir
+    task_instance_scores_path = os.path.join(task_instance_dir, 'scores.json')
+    with open(task_instance_scores_path, 'w') as file:
+        json.dump(task_instance_scores, file, indent=4)
+
+    return task_instance_scores, render_hashes
+
+
 if __name__=='__main__':
 
     parser = argparse.ArgumentParser(description='Image-based program edits')
 
     parser.add_argument('--inference_metadata_saved_path', 
         type=str, 
-        help="Path to the inference metadata in json format (paths of proposal edit scripts, winner information, etc.)"
+        help="Path to the inference metadata in json format (paths of proposal edit scripts, winner information, etc.), or to its .jsonl journal"
     )
 
     parser.add_argument('--eval_render_save_dir', 
@@ -38,20 +165,84 @@ if __name__=='__main__':
         help="The installation path of blender executable file. It's `infinigen/blender/blender` by default."
     )
 
+    parser.add_argument('--num_blender_workers', 
+        type=int, default=0, 
+        help="Number of long-lived Blender processes used for rendering. 0 starts a fresh Blender process for every render."
+    )
+
+    parser.add_argument('--render_cache_dir', 
+        type=str, default=None, 
+        help="Directory of the content-addressed render cache. Renders of already seen (blend file, render script, edit script) triples are reused. Disabled by default."
+    )
+
+    parser.add_argument('--render_cache_max_gb', 
+        type=float, default=20, 
+        help="Size bound of the render cache in GB; least recently used renders are evicted beyond it."
+    )
+
+    parser.add_argument('--embedding_store_dir', 
+        type=str, default=None, 
+        help="Directory of the persistent CLIP embedding store. Renders already embedded by an earlier evaluation, found by content hash, are not embedded again. Disabled by default."
+    )
+
+    parser.add_argument('--compact_embedding_store', 
+        action='store_true', 
+        help="After scoring, drop the embeddings of every render that was not part of this evaluation from the embedding store."
+    )
+
+    parser.add_argument('--photometric_chunk_size', 
+        type=int, default=64, 
+        help="Number of renders whose photometric loss is computed at once. Lower it to bound memory."
+    )
+
+    parser.add_argument('--num_render_workers', 
+        type=int, default=1, 
+        help="Number of renders run at the same time, over all instances. Instances are scored as soon as all their renders are done."
+    )
+
+    parser.add_argument('--batch_rendering', 
+        action='store_true', 
+        help="Render all the proposals of an instance in a single Blender process instead of one process per proposal."
+    )
+
+    parser.add_argument('--follow', 
+        action='store_true', 
+        help="Evaluate the .jsonl metadata journal of an inference run that is still going: instances are evaluated as inference finishes them, until the run ends."
+    )
+
+    parser.add_argument('--follow_timeout', 
+        type=float, default=None, 
+        help="With --follow, stop waiting for the inference run after that many seconds without a finished instance. Waits until the run ends by default."
+    )
+
     # parse, save, and validate the args
     args = parser.parse_args()
     inference_metadata_saved_path = args.inference_metadata_saved_path
     eval_render_save_dir = args.eval_render_save_dir
     infinigen_installation_path = args.infinigen_installation_path
+    ensure_worker_pool(infinigen_installation_path, args.num_blender_workers)
+    ensure_render_cache(args.render_cache_dir, args.render_cache_max_gb)
 
     blender_render_script_path = "bench_data/all_render_script.py"
 
-    if not os.path.isfile(inference_metadata_saved_path):
-        raise ValueError(f'Invalid input for --inference_metadata_saved_path: {inference_metadata_saved_path}.')
-
-    # Load in the data from pipeline inference
-    with open(inference_metadata_saved_path, 'r') as file:
-        inference_metadata = json.load(file)
+    if args.follow:
+        # Load in the header of the running inference, the instances are read as they finish
+        if not inference_metadata_saved_path.endswith(JOURNAL_EXTENSION):
+            raise ValueError(f'Invalid input for --inference_metadata_saved_path: --follow needs a {JOURNAL_EXTENSION} metadata journal.')
+        metadata_journal = MetadataJournal(inference_metadata_saved_path)
+        header = metadata_journal.wait_header(timeout=args.follow_timeout)
+        if header is None:
+            raise ValueError(f'Invalid input for --inference_metadata_saved_path: no inference run found in {inference_metadata_saved_path}.')
+        inference_metadata = compact_records([header])
+        instance_stream = metadata_journal.follow_instances(timeout=args.follow_timeout)
+    else:
+        if not os.path.isfile(inference_metadata_saved_path):
+            raise ValueError(f'Invalid input for --inference_metadata_saved_path: {inference_metadata_saved_path}.')
+
+        # Load in the data from pipeline inference
+        inference_metadata = load_inference_metadata(inference_metadata_saved_path)
+        instance_stream = ((task, task_instance, instance_info) for task in inference_metadata.keys() 
+                           if task in task_instance_count_dict.keys() for task_instance, instance_info in inference_metadata[task].items())
 
     # Derive name for eval_render_save_dir
     if not eval_render_save_dir:
@@ -60,129 +251,168 @@ if __name__=='__main__':
 
     tasks = inference_metadata.keys()
 
-    # Create eval renders for all instances
+    # Persistent CLIP embeddings, keyed by the content hash of the renders
+    embedding_store = get_clip_scorer().open_store(args.embedding_store_dir) if args.embedding_store_dir else None
+
+    # Progress journal: one record per finished render and per scored instance. 
+    # Finished work found in it is neither checked nor redone.
+    journal = Journal(os.path.join(eval_render_save_dir, 'progress.jsonl'))
+    rendered = {}   # (task, task_instance, proposal_name) -> executable
+    scored = {}     # (task, task_instance) -> (task_instance_scores, render_hashes)
+    for record in journal.read():
+        if record['event'] == 'render':
+            rendered[(record['task'], record['task_instance'], record['proposal_name'])] = record['executable']
+        elif record['event'] == 'instance':
+            scored[(record['task'], record['task_instance'])] = (record['scores'], record['render_hashes'])
+    if scored or rendered:
+        print(f'Resuming from {journal.path}: {len(scored)} instances scored, {len(rendered)} renders finished.')
+
+    instances = {}  # (task, task_instance) -> (instance_info, task_instance_dir, blender_file_path, proposals)
+    executable_proposal_names = {}     # (task, task_instance) -> [(proposal_renders_dir, proposal_name)]
+    pending_renders = {}    # (task, task_instance) -> number of renders not finished yet
+
+    def finish_render(key, proposal_name, proposal_renders_dir, executable, journaled=True):
+        # Renders that are not journaled are done again by the next evaluation
+        if journaled and key + (proposal_name,) not in rendered:
+            rendered[key + (proposal_name,)] = executable
+            journal.append({'event': 'render', 'task': key[0], 'task_instance': key[1], 'proposal_name': proposal_name, 'executable': executable})
+        if executable:
+            executable_proposal_names[key].append((proposal_renders_dir, proposal_name))
+
+    def finish_instance(key):
+        # Scoring stage, as soon as the last render of the instance is done
+        instance_info, task_instance_dir = instances[key][:2]
+        try:
+            scores, render_hashes = score_instance(task_instance_dir, instance_info, executable_proposal_names[key], 
+                                                   embedding_store=embedding_store, photometric_chunk_size=args.photometric_chunk_size)
+        except Exception as e:     # e.g. the goal did not render, the other instances are still evaluated
+            print(f'Scoring {key[0]}/{key[1]} failed, it is left out: {e}')
+            return
+        scored[key] = (scores, render_hashes)
+        journal.append({'event': 'instance', 'task': key[0], 'task_instance': key[1], 'scores': scores, 'render_hashes': render_hashes})
+
+    # Instances come from the inference metadata, or from the journal of the running inference as they finish (--follow)
+    instance_queue = queue.Queue()
+    def read_instances():
+        for item in instance_stream:
+            instance_queue.put(item)
+        instance_queue.put(None)
+    threading.Thread(target=read_instances, daemon=True).start()
+
+    # Render stage: up to num_render_workers renders at a time, over all instances
+    with ThreadPoolExecutor(max_workers=args.num_render_workers) as executor:
+        futures = {}
+        progress = tqdm(total=0)
+
+        def start_instance(task, task_instance, instance_info):
+            # Register an instance to evaluate, and submit its renders
+            if task not in task_instance_count_dict.keys():
+                return
+            inference_metadata.setdefault(task, {})[task_instance] = instance_info
+            try:
+                blender_file_path = instance_info['blender_file_path']
+                start_file_path = instance_info['start_script_path']
+                goal_file_path = instance_info['goal_script_path']
+            except:
+                return
+            key = (task, task_instance)
+            if key in scored or key in instances:
+                return
 
+            task_instance_dir = os.path.join(eval_render_save_dir, task_instance)
+            os.makedirs(task_instance_dir, exist_ok=True)
+            proposals = []
+            for proposal_path in (instance_info['proposal_edits_paths'] + [start_file_path, goal_file_path]):
+                proposal_name = os.path.basename(proposal_path).split('.')[0] # Extract the name of py file, without suffix
+                proposals.append((proposal_path, proposal_name, os.path.join(task_instance_dir, proposal_name)))
+            instances[key] = (instance_info, task_instance_dir, blender_file_path, proposals)
+            executable_proposal_names[key] = []
+            pending_renders[key] = 0
+
+            batch_jobs = []
+            for proposal_path, proposal_name, proposal_renders_dir in proposals:
+                if key + (proposal_name,) not in rendered and os.path.exists(proposal_renders_dir):
+                    # Renders without a journal record may have stopped between views, render them again
+                    shutil.rmtree(proposal_renders_dir)
+                if key + (proposal_name,) in rendered:
+                    finish_render(key, proposal_name, proposal_renders_dir, rendered[key + (proposal_name,)])
+                elif args.batch_rendering:
+                    batch_jobs.append((proposal_path, proposal_name, proposal_renders_dir))
+                else:
+                    future = executor.submit(render_proposal, infinigen_installation_path, blender_file_path, blender_render_script_path, proposal_path, proposal_renders_dir)
+                    futures[future] = (key, [(proposal_name, proposal_renders_dir)])
+                    pending_renders[key] += 1
+            if batch_jobs:
+                future = executor.submit(render_proposals_batch, infinigen_installation_path, blender_file_path, blender_render_script_path, 
+                                         [(proposal_path, proposal_renders_dir) for proposal_path, _, proposal_renders_dir in batch_jobs])
+                futures[future] = (key, [(proposal_name, proposal_renders_dir) for _, proposal_name, proposal_renders_dir in batch_jobs])
+                pending_renders[key] += 1
+
+            progress.total += pending_renders[key]
+            progress.refresh()
+            if pending_renders[key] == 0:
+                finish_instance(key)
+
+        instances_done = False
+        while not instances_done or futures:
+            # Start the instances that are ready, waiting for one when no render is running
+            while not instances_done:
+                try:
+                    item = instance_queue.get_nowait() if futures else instance_queue.get()
+                except queue.Empty:
+                    break
+                if item is None:
+                    instances_done = True
+                else:
+                    start_instance(*item)
+            if not futures:
+                continue
+
+            # Finish the renders, checking for new instances every second while the inference is going
+            done, _ = wait(futures, timeout=None if instances_done else 1.0, return_when=FIRST_COMPLETED)
+            for future in done:
+                key, jobs = futures.pop(future)
+                executables = future.result()
+                journaled = executables is not None
+                if executables is None:
+                    executables = [False] * len(jobs)
+                elif not isinstance(executables, list):
+                    executables = [executables]
+                for (proposal_name, proposal_renders_dir), executable in zip(jobs, executables):
+                    finish_render(key, proposal_name, proposal_renders_dir, executable, journaled=journaled)
+                pending_renders[key] -= 1
+                progress.update(1)
+                if pending_renders[key] == 0:
+                    finish_instance(key)
+        progress.close()
+
+    # Aggregate the scores of all instances, in the order of the inference metadata
     scores_across_tasks = {}
     intermediates = {}
+    scored_render_hashes = []
 
     for task in tasks:
         if task not in task_instance_count_dict.keys():
             continue
         
-        # Iterate through each instance
         scores_across_instances = {'best_n_clip':[], 'selected_n_clip':[], 'best_pl':[], 'selected_pl':[]}
 
-        for task_instance, instance_info in inference_metadata[task].items():
-            task_instance_dir = os.path.join(eval_render_save_dir, task_instance)
-            os.makedirs(task_instance_dir, exist_ok=True)
-
-            # Store local scores: score for each executable render
-            task_instance_scores = {}
-
-            try:
-                # Iterate through each proposal_renders_path
-                blender_file_path = instance_info['blender_file_path']
-                start_file_path = instance_info['start_script_path']
-                goal_file_path = instance_info['goal_script_path']
-            except:
+        for task_instance in inference_metadata[task]:
+            if (task, task_instance) not in scored:
                 continue
-
-            executable_proposal_names = []
-
-            for proposal_path in (instance_info['proposal_edits_paths'] + [start_file_path, goal_file_path]):
-                # Render the images for that proposal_renders_path
-                proposal_name = os.path.basename(proposal_path).split('.')[0] # Extract the name of py file, without suffix
-                proposal_renders_dir = os.path.join(task_instance_dir, proposal_name)
-                
-                # Render images. "executable" checks whether the proposal is executable in Blender-Python API.
-                if not os.path.exists(proposal_renders_dir) or not os.listdir(proposal_renders_dir): 
-                    try:
-                        executable = blender_step(infinigen_installation_path, blender_file_path, blender_render_script_path, proposal_path, proposal_renders_dir, merge_all_renders=False, replace_if_overlap=True)
-                    except:
-                        continue
-                    if executable:
-                        executable_proposal_names.append((proposal_renders_dir,proposal_name))
-                else:
-                    executable_proposal_names.append((proposal_renders_dir,proposal_name))
-            
-            # Loop through each executable proposal to compute their scores
-            for proposal_renders_dir, proposal_name in tqdm(executable_proposal_names):
-                if proposal_name == 'goal':
-                    continue
-
-                task_instance_scores[proposal_name] = {}    
-
-                n_clip_views = []
-                pl_views = []    
-
-                for render_name in os.listdir(proposal_renders_dir):
-                    task_instance_scores[proposal_name][render_name] = {}
-
-                    # Get path for render
-                    proposal_render = Image.open(os.path.join(proposal_renders_dir, render_name))
-                    gt_render = Image.open(os.path.join(task_instance_dir, 'goal', render_name))
-
-                    # Compute n_clip and pl
-                    n_clip = float(1 - clip_similarity(proposal_render, gt_render))
-                    pl = float(photometric_loss(proposal_render, gt_render))
-
-                    # Aggregate scores across all views for a proposal edit to compute average
-                    n_clip_views.append(n_clip)
-                    pl_views.append(pl)
-
-                    # Record scores for this render
-                    task_instance_scores[proposal_name][render_name]['n_clip'] = n_clip
-                    task_instance_scores[proposal_name][render_name]['pl'] = pl 
-                
-                # Compute average n_clip for this proposal
-                if n_clip_views:
-                    average_n_clip_views = sum(n_clip_views) / len(n_clip_views)
-
-                # Compute average pl for this task instance
-                if pl_views:
-                    average_pl_views = sum(pl_views) / len(pl_views)
-
-                # Record average scores for a proposal 
-                task_instance_scores[proposal_name]['avg_n_clip'] = average_n_clip_views
-                task_instance_scores[proposal_name]['avg_pl'] = average_pl_views 
-            
-                # Save the local scores to the task_instance dir
-                task_instance_scores_path = os.path.join(task_instance_dir, 'scores.json')
-                with open(task_instance_scores_path, 'w') as file:
-                    json.dump(task_instance_scores, file, indent=4)
-
-            # Extract best scores and record them
-            best_n_clip_proposal_name = min(task_instance_scores, key=lambda proposal_name: task_instance_scores[proposal_name]['avg_n_clip'])            
-            best_pl_proposal_name = min(task_instance_scores, key=lambda proposal_name: task_instance_scores[proposal_name]['avg_pl'])
-            best_n_clip = task_instance_scores[best_n_clip_proposal_name]['avg_n_clip']
-            best_pl = task_instance_scores[best_pl_proposal_name]['avg_pl']
-            task_instance_scores['best_n_clip'] = (best_n_clip_proposal_name, best_n_clip)
-            task_instance_scores['best_pl'] = (best_pl_proposal_name, best_pl)
+            task_instance_scores, render_hashes = scored[(task, task_instance)]
+            scored_render_hashes += render_hashes
             
             # Register this instance to the scores across this task
-            scores_across_instances['best_n_clip'].append(best_n_clip)
-            scores_across_instances['best_pl'].append(best_pl)
-
-            # Handle selected edit if applicable
-            selected_proposal_path = instance_info['selected_edit_path']
-            if selected_proposal_path:
-                selected_proposal_name = os.path.basename(selected_proposal_path).split('.')[0]
-                selectd_n_clip = task_instance_scores[selected_proposal_name]['avg_n_clip']
-                selected_pl = task_instance_scores[selected_proposal_name]['avg_pl']
-                task_instance_scores['selected_scores'] =  (selected_proposal_name, {'avg_n_clip':selectd_n_clip, 'avg_pl':selected_pl})
-                
-                # Register this instance to the scores across this task
-                scores_across_instances["selected_n_clip"].append(selectd_n_clip)
-                scores_across_instances["selected_pl"].append(selected_pl)
-
-            # Save the local scores to the task_instance dir
-            task_instance_scores_path = os.path.join(task_instance_dir, 'scores.json')
-            with open(task_instance_scores_path, 'w') as file:
-                json.dump(task_instance_scores, file, indent=4)
-
-            scores_across_instances_path = os.path.join(eval_render_save_dir, f'{task}_scores.json',)
-            with open(scores_across_instances_path, 'w') as file:
-                json.dump(scores_across_instances, file, indent=4)
+            scores_across_instances['best_n_clip'].append(task_instance_scores['best_n_clip'][1])
+            scores_across_instances['best_pl'].append(task_instance_scores['best_pl'][1])
+            if 'selected_scores' in task_instance_scores:
+                scores_across_instances["selected_n_clip"].append(task_instance_scores['selected_scores'][1]['avg_n_clip'])
+                scores_across_instances["selected_pl"].append(task_instance_scores['selected_scores'][1]['avg_pl'])
+
+        scores_across_instances_path = os.path.join(eval_render_save_dir, f'{task}_scores.json',)
+        with open(scores_across_instances_path, 'w') as file:
+            json.dump(scores_across_instances, file, indent=4)
 
         # If the model cannot provide any edit for more than 75%
         if len(scores_across_instances['best_n_clip']) < (len(inference_metadata[task]) * 0.25) :
@@ -212,8 +442,11 @@ if __name__=='__main__':
     scores_across_instances_path = os.path.join(eval_render_save_dir, 'intermediate_scores.json',)
     with open(scores_across_instances_path, 'w') as file:
         json.dump(intermediates, file, indent=4)
+
+    save_cache_stats(os.path.join(eval_render_save_dir, 'render_cache_stats.json'))
+
+    if embedding_store is not None and args.compact_embedding_store:
+        embedding_store.compact(keep_keys=scored_render_hashes)
             
 
         # Compute Chamfer Distance for 3D-related tasks
-
-        
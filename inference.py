@@ -5,8 +5,14 @@ import subprocess
 import argparse
 import time
 import json
+import tempfile
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from PIL import Image
 from utils import BlenderAlchemy_run, tree_dim_parse
+from tasksolver.limits import limits_env
+from tasksolver.response_cache import response_cache_env
+from system.utils.metadata_journal import MetadataJournal, compact
 
 task_instance_count_dict = {
     'geometry': 50,
@@ -92,6 +98,61 @@ if __name__=='__main__':
         help="Tree dimension for generation-verification tree. We set the default to 3x4, aligned with BlenderGym configuration."
     )
 
+    parser.add_argument('--num_blender_workers', 
+        type=int, default=0, 
+        help="Number of long-lived Blender processes each instance renders with. 0 starts a fresh Blender process for every render."
+    )
+
+    parser.add_argument('--render_cache_dir', 
+        type=str, default=None, 
+        help="Directory of the render cache shared by all instances. Scripts that were already rendered are not rendered again. Disabled by default."
+    )
+
+    parser.add_argument('--exploration_render_tier', 
+        type=str, default=None, 
+        help="Render tier of the proposals during tree search, e.g. `preview` for lower resolution and samples. Winners are re-rendered at full quality. Full quality by default."
+    )
+
+    parser.add_argument('--pipelined_levels', 
+        action='store_true', 
+        help="Render each proposal of a tree level as soon as it is generated, and judge it while the others are still generated."
+    )
+
+    parser.add_argument('--level_deadline', 
+        type=float, default=None, 
+        help="With --pipelined_levels, seconds after which the proposals of a tree level that are not rendered yet are left out. No deadline by default."
+    )
+
+    parser.add_argument('--isolate_instances', 
+        action='store_true', 
+        help="Run BlenderAlchemy for each instance in its own `python system/main.py` process. By default, instances run in this process and share agents and loaded model weights."
+    )
+
+    parser.add_argument('--num_parallel_instances', 
+        type=int, default=1, 
+        help="Number of task instances run at the same time. By default, instances run one after another."
+    )
+
+    parser.add_argument('--max_blender_processes', 
+        type=int, default=0, 
+        help="Maximum number of Blender processes rendering at the same time, over all parallel instances. 0 means no limit."
+    )
+
+    parser.add_argument('--max_vlm_requests', 
+        type=str, default=None, 
+        help="Maximum number of in-flight VLM requests per provider, over all parallel instances, e.g. `openai=8,anthropic=4,gemini=4,ollama=1`. No limit by default."
+    )
+
+    parser.add_argument('--response_cache', 
+        type=str, default=None, 
+        help="SQLite file recording the VLM responses, see TaskSolver/tasksolver/response_cache.py. No cache by default."
+    )
+
+    parser.add_argument('--response_cache_mode', 
+        type=str, default='record', choices=['record', 'replay', 'passthrough'],
+        help="`record` reuses the recorded responses and records the new ones, `replay` only uses recorded responses (no VLM calls), `passthrough` ignores the cache."
+    )
+
     # parse, save, and validate the args
     args = parser.parse_args()
     tasks = args.task.strip().split(',')
@@ -119,8 +180,30 @@ if __name__=='__main__':
         raise ValueError(f'Invalid input for infinigen_installation_path: {infinigen_installation_path}')
     infinigen_installation_path = os.path.abspath(infinigen_installation_path)
 
+    if args.num_parallel_instances < 1:
+        raise ValueError(f'Invalid input for --num_parallel_instances: {args.num_parallel_instances}')
+
+    # Concurrency limits shared by every instance subprocess, see TaskSolver/tasksolver/limits.py
+    max_slots = {'blender': args.max_blender_processes}
+    if args.max_vlm_requests:
+        for provider_limit in args.max_vlm_requests.split(','):
+            provider, _, num_requests = provider_limit.partition('=')
+            if not provider.strip() or not num_requests.strip().isdigit():
+                raise ValueError(f'Invalid input for --max_vlm_requests: {provider_limit}')
+            max_slots[provider.strip()] = int(num_requests)
+    # Removed at the end of the run (and at exit if the run fails)
+    limits_dir = tempfile.TemporaryDirectory(prefix='blendergym_limits_')
+    os.environ.update(limits_env(limits_dir.name, max_slots))
+
+    # VLM response cache, shared by every instance subprocess
+    if args.response_cache:
+        os.environ.update(response_cache_env(args.response_cache, args.response_cache_mode))
+
     os.makedirs(info_saving_dir_path, exist_ok=True)
     info_saving_json_path = os.path.join(info_saving_dir_path, f'intermediate_metadata_{time.strftime("%m-%d-%H-%M-%S")}.json')
+    # Results are appended to a journal as instances finish, and compacted into info_saving_json_path at the end.
+    # evaluation.py can read (or --follow) the journal before that.
+    info_saving_journal_path = os.path.splitext(info_saving_json_path)[0] + '.jsonl'
 
     # Load in instance dir paths
     if 'all' in tasks:
@@ -143,61 +226,68 @@ if __name__=='__main__':
         generation_results = {"output_dir_name":f"outputs_{starter_time}"}
 
 
-    # Run the pipeline on each instance dir
-    for task, instance_dir_paths in task_instance_dir_paths.items():
-        # Register the task to the results-saving dict
-        generation_results[task] = {}
-
-        for instance_dir_path in instance_dir_paths:
-            # Register the task instance to the results-saving dict
-            task_instance_id = os.path.basename(instance_dir_path)
-            generation_results[task][task_instance_id] = {}
-
-            # Define input for the VLM system
-            instance_dir_path = os.path.abspath(instance_dir_path)
-            blender_file_path = os.path.join(instance_dir_path, 'blender_file.blend')
-            start_file_path = os.path.join(instance_dir_path, 'start.py')
-            start_render_path = os.path.join(instance_dir_path, 'renders/start')
-            goal_file_path = os.path.join(instance_dir_path, 'goal.py')
-            goal_render_path = os.path.join(instance_dir_path, 'renders/goal')
-
-            # Call the VLM system
-            if not custom_vlm_system:
-                if not generator_type or not verifier_type:
-                    raise ValueError("For VLM-only usage, please indicate both generator and evaluator model.")
-                try:
-                    proposal_edits_paths, proposal_renders_paths, selected_edit_path, selected_render_path = BlenderAlchemy_run(blender_file_path, start_file_path, start_render_path, goal_render_path, blender_render_script_path, task_instance_id, task, infinigen_installation_path, generator_type, evaluator_type, starter_time=starter_time, tree_dims=tree_dims)    
-                except:
-                    continue
-            else:
-                proposal_edits_paths, proposal_renders_paths, selected_edit_path, selected_render_path = VLMSystem_run(blender_file_path, start_file_path, start_render_path, goal_render_path, blender_render_script_path, task_instance_id, task, infinigen_installation_path)    
-
-            # DEBUG:
-            print(f'proposal_edits_paths: {proposal_edits_paths}')
-            print(f'proposal_renders_paths: {proposal_renders_paths}')
-            print(f'selected_edit_path: {selected_edit_path}')
-            print(f'selected_render_path: {selected_render_path}')
-
-            # Save the results for the VLM system
-            generation_results[task][task_instance_id]['instance_dir_path'] = instance_dir_path
-            generation_results[task][task_instance_id]['blender_file_path'] = blender_file_path
-            generation_results[task][task_instance_id]['start_script_path'] = start_file_path
-            generation_results[task][task_instance_id]['goal_script_path'] = goal_file_path
-            generation_results[task][task_instance_id]['proposal_edits_paths'] = proposal_edits_paths
-            generation_results[task][task_instance_id]['proposal_renders_paths'] = proposal_renders_paths
-            generation_results[task][task_instance_id]['selected_edit_path'] = selected_edit_path
-            generation_results[task][task_instance_id]['selected_render_path'] = selected_render_path
-
-            with open(info_saving_json_path, 'w') as file:
-                json.dump(generation_results, file, indent=4)
-
-
-
-
-
-
-
-
-
-
-
+    def run_instance(task, instance_dir_path):
+        '''
+        Run the VLM system on one task instance, returns the results to save for it.
+        '''
+        task_instance_id = os.path.basename(instance_dir_path)
+        instance_results = {}
+
+        # Define input for the VLM system
+        instance_dir_path = os.path.abspath(instance_dir_path)
+        blender_file_path = os.path.join(instance_dir_path, 'blender_file.blend')
+        start_file_path = os.path.join(instance_dir_path, 'start.py')
+        start_render_path = os.path.join(instance_dir_path, 'renders/start')
+        goal_file_path = os.path.join(instance_dir_path, 'goal.py')
+        goal_render_path = os.path.join(instance_dir_path, 'renders/goal')
+
+        # Call the VLM system
+        if not custom_vlm_system:
+            try:
+                proposal_edits_paths, proposal_renders_paths, selected_edit_path, selected_render_path = BlenderAlchemy_run(blender_file_path, start_file_path, start_render_path, goal_render_path, blender_render_script_path, task_instance_id, task, infinigen_installation_path, generator_type, verifier_type, starter_time=starter_time, tree_dims=tree_dims, num_blender_workers=args.num_blender_workers, render_cache_dir=args.render_cache_dir, exploration_render_tier=args.exploration_render_tier, pipelined_levels=args.pipelined_levels, level_deadline=args.level_deadline, in_process=not args.isolate_instances)    
+            except:
+                print(f'{task_instance_id} failed:\n{traceback.format_exc()}')
+                return instance_results
+        else:
+            proposal_edits_paths, proposal_renders_paths, selected_edit_path, selected_render_path = VLMSystem_run(blender_file_path, start_file_path, start_render_path, goal_render_path, blender_render_script_path, task_instance_id, task, infinigen_installation_path)    
+
+        # DEBUG:
+        print(f'proposal_edits_paths: {proposal_edits_paths}')
+        print(f'proposal_renders_paths: {proposal_renders_paths}')
+        print(f'selected_edit_path: {selected_edit_path}')
+        print(f'selected_render_path: {selected_render_path}')
+
+        # Save the results for the VLM system
+        instance_results['instance_dir_path'] = instance_dir_path
+        instance_results['blender_file_path'] = blender_file_path
+        instance_results['start_script_path'] = start_file_path
+        instance_results['goal_script_path'] = goal_file_path
+        instance_results['proposal_edits_paths'] = proposal_edits_paths
+        instance_results['proposal_renders_paths'] = proposal_renders_paths
+        instance_results['selected_edit_path'] = selected_edit_path
+        instance_results['selected_render_path'] = selected_render_path
+        return instance_results
+
+    if not custom_vlm_system and (not generator_type or not verifier_type):
+        raise ValueError("For VLM-only usage, please indicate both generator and evaluator model.")
+
+    # Register every task instance to the metadata journal, in order
+    metadata_journal = MetadataJournal(info_saving_journal_path)
+    metadata_journal.write_header(generation_results, {task: [os.path.basename(instance_dir_path) for instance_dir_path in instance_dir_paths] 
+                                                       for task, instance_dir_paths in task_instance_dir_paths.items()})
+    print(f'Saving the inference metadata to {info_saving_journal_path}')
+
+    # Run the pipeline on each instance dir, up to num_parallel_instances at a time, 
+    # and save the results every time an instance finishes
+    with limits_dir, ThreadPoolExecutor(max_workers=args.num_parallel_instances) as executor:
+        futures = {executor.submit(run_instance, task, instance_dir_path): (task, os.path.basename(instance_dir_path))
+                    for task, instance_dir_paths in task_instance_dir_paths.items()
+                    for instance_dir_path in instance_dir_paths}
+
+        for future in as_completed(futures):
+            task, task_instance_id = futures[future]
+            metadata_journal.write_instance(task, task_instance_id, future.result())
+
+    metadata_journal.write_end()
+    compact(info_saving_journal_path, info_saving_json_path)
+    print(f'Inference metadata saved to {info_saving_json_path}')
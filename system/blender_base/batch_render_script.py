@@ -0,0 +1,36 @@
+"""
+Render many edit scripts in one Blender process, started by run_blender_batch() in utils/blender_pool.py.
+
+sys.argv[6] is a json manifest:
+    {"render_script": ..., "results_path": ..., "jobs": [{"script_path": ..., "render_dir": ...}, ...]}
+Each job runs the render script against a freshly reloaded scene. A job that raises is recorded as
+failed and the next job still runs. Results are rewritten to results_path after every job, so the
+caller knows how far the batch got if Blender itself crashes.
+"""
+
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from render_job import revert_scene, run_render_job
+
+
+if __name__ == "__main__":
+
+    manifest_fpath = sys.argv[6]  # Path to the manifest of render jobs
+    with open(manifest_fpath, "r") as f:
+        manifest = json.load(f)
+
+    blender_file = sys.argv[2]
+    results = []
+    for job_idx, job in enumerate(manifest["jobs"]):
+        if job_idx > 0:
+            revert_scene(blender_file)
+
+        ok, error = run_render_job(blender_file, manifest["render_script"],
+                                   job["script_path"], job["render_dir"])
+        results.append({"ok": ok, "error": error})
+
+        with open(manifest["results_path"], "w") as f:
+            json.dump(results, f)
@@ -0,0 +1,47 @@
+"""
+Helpers to run a render script inside an already running Blender process.
+
+Imported by the long-lived Blender scripts (e.g. worker_render_script.py), which keep a .blend
+loaded and render many edit scripts one after another.
+"""
+
+import bpy
+import os
+import sys
+import runpy
+import traceback
+
+def revert_scene(blender_file):
+    '''
+    Reload blender_file from disk, discarding every change made by previous edit scripts.
+    '''
+    bpy.ops.wm.open_mainfile(filepath=blender_file, load_ui=False)
+
+
+def is_scene_loaded(blender_file):
+    return bool(bpy.data.filepath) and os.path.abspath(bpy.data.filepath) == os.path.abspath(blender_file)
+
+
+def run_render_job(blender_file, render_script, code_fpath, rendering_dir):
+    '''
+    Execute render_script as if Blender had been launched with
+        blender --background blender_file --python render_script -- code_fpath rendering_dir
+    so that the render scripts can keep reading sys.argv[6] and sys.argv[7].
+
+    Outputs:
+        ok: False if the render script (or the edit script it executes) raised
+        error: the traceback string when ok is False, else None
+    '''
+    os.makedirs(rendering_dir, exist_ok=True)
+
+    saved_argv = sys.argv
+    sys.argv = [saved_argv[0], "--background", blender_file,
+                "--python", render_script,
+                "--", code_fpath, rendering_dir]
+    try:
+        runpy.run_path(render_script, run_name="__main__")
+        return True, None
+    except (Exception, SystemExit):
+        return False, traceback.format_exc()
+    finally:
+        sys.argv = saved_argv
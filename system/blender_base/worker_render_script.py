@@ -0,0 +1,50 @@
+"""
+Long-lived Blender worker, started by utils/blender_pool.py.
+
+It connects back to the pool over a local socket and takes render jobs as json lines:
+    {"blender_file": ..., "render_script": ..., "script_path": ..., "render_dir": ...}
+Before every job, except the first one after startup, the .blend is reloaded so that each edit
+script runs against the pristine scene.
+"""
+
+import os
+import sys
+import json
+import socket
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from render_job import revert_scene, is_scene_loaded, run_render_job
+
+
+if __name__ == "__main__":
+
+    host = sys.argv[6]
+    port = int(sys.argv[7])
+    token = sys.argv[8]
+
+    connection = socket.create_connection((host, port))
+    stream = connection.makefile("rw")
+    stream.write(token + "\n")
+    stream.flush()
+
+    scene_is_pristine = True
+    while True:
+        line = stream.readline()
+        if not line:    # The pool went away
+            break
+        job = json.loads(line)
+        if job is None:     # Shutdown request
+            break
+
+        if not scene_is_pristine or not is_scene_loaded(job["blender_file"]):
+            revert_scene(job["blender_file"])
+
+        ok, error = run_render_job(job["blender_file"], job["render_script"],
+                                   job["script_path"], job["render_dir"])
+        scene_is_pristine = False
+
+        stream.write(json.dumps({"ok": ok, "error": error}) + "\n")
+        stream.flush()
+
+    stream.close()
+    connection.close()
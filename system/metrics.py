@@ -5,6 +5,7 @@ from PIL import Image
 import torch
 from torchvision.transforms import Compose, Resize, CenterCrop, ToTensor, Normalize
 from transformers import CLIPProcessor, CLIPModel
+from utils.clip_scorer import get_clip_scorer
 
 
 
@@ -22,22 +23,14 @@ def clip_similarity(image1, image2):
     if image1.size != image2.size:
         image2 = image2.resize(image1.size)
 
-    # Load the CLIP model
-    model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
+    # The CLIP model is loaded once per process
+    scorer = get_clip_scorer("openai/clip-vit-base-patch32")
 
-    # Load the CLIP processor
-    processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-
-    # Preprocess the images
-    images = [image1, image2]
-    inputs = processor(images=images, return_tensors="pt")
-
-    # Compute the features for the images
-    with torch.no_grad():
-        features = model.get_image_features(**inputs)
+    # Compute the normalized features for both images in one batch
+    features = scorer.embed_images([image1, image2])
 
     # Compute the cosine similarity between the image features
-    sim = torch.nn.functional.cosine_similarity(features[0], features[1], dim=-1)
+    sim = scorer.similarity(features[:1], features[1:])
 
     return sim.item()
 
@@ -84,24 +77,16 @@ def img2text_clip_similarity(image, text):
     float: The CLIP similarity between the image and the text.
     """
     
-    # Load the CLIP model
-    # model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-    model = CLIPModel.from_pretrained("openai/clip-vit-large-patch14")
-
-    # Load the CLIP processor
-    # processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-    processor = CLIPProcessor.from_pretrained("openai/clip-vit-large-patch14")
-
-    # Preprocess the image and text
-    inputs = processor(text=text, images=image, return_tensors="pt")
+    # The CLIP model is loaded once per process
+    # scorer = get_clip_scorer("openai/clip-vit-base-patch32")
+    scorer = get_clip_scorer("openai/clip-vit-large-patch14")
 
-    # Compute the features for the image and text
-    with torch.no_grad():
-        image_features = model.get_image_features(pixel_values=inputs.pixel_values)
-        text_features = model.get_text_features(input_ids=inputs.input_ids)
+    # Compute the normalized features for the image and text
+    image_features = scorer.embed_images([image])
+    text_features = scorer.embed_texts([text])
 
     # Compute the cosine similarity between the image and text features
-    sim = torch.nn.functional.cosine_similarity(image_features, text_features, dim=-1)
+    sim = scorer.similarity(image_features, text_features)
 
     return sim.item()
 
@@ -15,14 +15,27 @@ from loguru import logger
 import threading
 import time
 import io
+import functools
+import contextlib
+import queue
+import urllib.request
+from openai import OpenAI
 
 from utils.image import plot_image_grid
 from utils.code import get_code_as_string
+from utils.blender_pool import run_blender, run_blender_batch, ensure_worker_pool
+from utils.render_cache import ensure_render_cache, save_cache_stats
+from utils.tournament import Tournament, JudgementMemo, target_key
+from utils.dedup import ProposalDedup
+from utils.search_control import get_search_controller
+from utils.prefilter import CandidatePrefilter, get_prefilter
 
 from tasksolver.event import *
 from tasksolver.common import  Question
 from tasksolver.exceptions import  CodeExecutionException
 from tasksolver.agent import Agent
+from tasksolver.keychain import KeyChain
+from tasksolver.ratelimit import throttle_stats
 from tqdm import tqdm
 
 from agents import EditCodeAgent, GeneralAgent, Agent
@@ -41,10 +54,84 @@ TASKSETTING2PROMPTMODULE = {TaskSetting.GEONODES: "geonodes",
                             TaskSetting.SHAPEKEY: "shapekey",
                             TaskSetting.PLACEMENT: "placement"}
 
+def think_and_act(question_to_agent:Question, agent:Agent, idx:int,
+                  script_save:Path, render_save:Path, blender_file:str, blender_script:str,
+                  iteration:int, config:dict, blender_step, think_slot=None, act_slot=None, dedup:ProposalDedup=None,
+                  cancel:threading.Event=None):
+    '''
+    Generate one code change by think, and render it by act. The code change must be runnable, as checked by agent.act
+
+    Inputs:
+        think_slot, act_slot[optional]: context managers held while generating and while rendering
+        dedup[optional]: ProposalDedup of the level, a change already proposed is not rendered again and 
+            gets the code and render of the first proposal
+        cancel[optional]: once set, e.g. when the level is over, nothing is generated or rendered anymore
+    Outputs:
+        (code_path, render_path, 'placeholder'), with code_path and render_path None if no runnable change came out
+    '''
+    think_slot = think_slot if think_slot is not None else contextlib.nullcontext()
+    act_slot = act_slot if act_slot is not None else contextlib.nullcontext()
+    done = False
+    num_tries = 0 
+    max_tries = 1
+    while not done and num_tries < max_tries:
+        num_tries += 1
+        try:
+            # Generate the code by think, the whole trunk
+            with think_slot:
+                if cancel is not None and cancel.is_set():
+                    break
+                p_ans = agent.think(question_to_agent, num_tokens=3000, agent_idx=idx)
+            if len(p_ans.code) == 0:
+                logger.warning(f"The following response didn't parse into any code:\n{idx, script_save}")
+                pass
+        except Exception as e:
+            # Transient (rate limit, overload, network) errors were already retried by the interface, see tasksolver/ratelimit.py
+            logger.warning(f"thread {idx} LLM querying failed with error:\n{str(e)}") 
+            break
+
+        entry = None
+        if dedup is not None:
+            original, entry = dedup.claim(p_ans.code)
+            if not original:
+                shared = dedup.wait(entry)
+                if shared is not None:
+                    code_path, render_path = shared
+                    done = True
+                break
+        try:
+            # Execute the code by act
+            with act_slot:
+                if cancel is not None and cancel.is_set():
+                    break
+                code_path, render_path = agent.act(p_ans, 
+                                                script_save=script_save, 
+                                                render_save=render_save, 
+                                                iteration=iteration,
+                                                blender_file=blender_file,
+                                                blender_script=blender_script,
+                                                config=config,
+                                                blender_step=blender_step)
+            done = True
+        except CodeExecutionException:
+            # blender execution failed, count failure.
+            pass
+        finally:
+            if entry is not None:
+                if done:
+                    dedup.resolve(entry, code_path, render_path)
+                else:
+                    dedup.resolve(entry)
+    if not done: 
+        code_path = None
+        render_path = None 
+    return (code_path, render_path, 'placeholder')
+
+
 def tree_branch(branching_factor:int, question_to_agent:Question, agent:Agent,
                 script_save:Path, render_save:Path, thoughtprocess_save:Path,
                 blender_file:str, blender_script:str,
-                iteration:int, config:dict):
+                iteration:int, config:dict, dedup:ProposalDedup=None):
     '''
     For a given question, generate a list of runnable modifications by think and act
     '''
@@ -53,48 +140,24 @@ def tree_branch(branching_factor:int, question_to_agent:Question, agent:Agent,
         min(config["run_config"]["max_concurrent_rendering_processes"], 
             config["run_config"]["max_concurrent_generator_requests"]) )
     
+    # With batch rendering, agent.act only records its render job, and the whole level is rendered together below
+    batch_rendering = config["run_config"].get("batch_rendering", False)
+    deferred_step = DeferredBlenderStep() if batch_rendering else None
+    step = deferred_step if batch_rendering else blender_step
+
+    # Proposals are rendered at the (cheaper) exploration tier, winners get re-rendered at full quality later
+    render_tier = get_render_tier(config["run_config"], config["run_config"].get("exploration_render_tier"))
+    if render_tier is not None:
+        step = functools.partial(step, render_tier=render_tier)
+
     results = [None] * branching_factor     # each slot is a position for a proposed modification
     def thread(question_to_agent, idx, results):
         # Fill one spot in the list results with a potential code change
-        # The code change must be runnable, as checked by agent.act
         with query_and_act_semaphore: 
-            #logger.info(f"thread {idx} acquired semaphore lock.")
-            done = False
-            num_tries = 0 
-            max_tries = 1
-            while not done and num_tries < max_tries:
-                num_tries += 1
-                try:
-                    # Generate the code by think, the whole trunk
-                    p_ans = agent.think(question_to_agent, num_tokens=3000, agent_idx=idx)
-                    if len(p_ans.code) == 0:
-                        logger.warning(f"The following response didn't parse into any code:\n{idx, script_save}")
-                        pass
-                except Exception as e: # TODO  ratelimitexception
-                    print(e)
-                    logger.warning(f"thread {idx} LLM querying failed with error:\n{str(e)}") 
-                    time.sleep(30)
-                    continue
-                try:
-                    # Execute the code by act
-                    code_path, render_path = agent.act(p_ans, 
-                                                    script_save=script_save, 
-                                                    render_save=render_save, 
-                                                    iteration=iteration,
-                                                    blender_file=blender_file,
-                                                    blender_script=blender_script,
-                                                    config=config,
-                                                    blender_step=blender_step)
-                    done = True
-                except CodeExecutionException:
-                    # blender execution failed, count failure.
-                    # code_exec_exceptions += 1 
-                    #logger.warning(f"thread {idx} code execution failed.")
-                    pass
-            if not done: 
-                code_path = None
-                render_path = None 
-            results[idx] = (code_path, render_path, 'placeholder')  # The in-place modification of results with the 3-tuple
+            results[idx] = think_and_act(question_to_agent, agent, idx, 
+                                         script_save=script_save, render_save=render_save,
+                                         blender_file=blender_file, blender_script=blender_script,
+                                         iteration=iteration, config=config, blender_step=step, dedup=dedup)
         logger.info(f"thread {idx} released semaphore lock.")
 
     # FOR DEBUGGING
@@ -111,6 +174,12 @@ def tree_branch(branching_factor:int, question_to_agent:Question, agent:Agent,
     for x in llm_threads:
         x.join() # wait till they all finish
     #logger.info(f"joined all threads")
+
+    if batch_rendering:
+        rendered = deferred_step.render()
+        for idx, result in enumerate(results):
+            if result is not None and result[1] is not None and not rendered.get(result[1], False):
+                results[idx] = None     # the proposal didn't render
     
     # assert all([el is not None for el in results])
     clean_results = []
@@ -124,140 +193,186 @@ def tree_branch(branching_factor:int, question_to_agent:Question, agent:Agent,
     return results
 
 
-def get_top_candidate(candidates, target, judge, task_setting:TaskSetting, config:dict, 
-                            target_description=None, use_vision=True,):
+def candidate_tournament(target, judge, task_setting:TaskSetting, config:dict, 
+                         target_description=None, use_vision=True, memo:JudgementMemo=None) -> Tournament:
+    '''
+    The Tournament (see utils/tournament.py) between candidates judged by judge against the target.
 
+    Inputs:
+        memo[optional]: JudgementMemo shared by the selections of a run, pairs found in it are not judged again
+    '''
+    run_config = config["run_config"]
     prompting_submodule = importlib.import_module("prompting."+TASKSETTING2PROMPTMODULE[task_setting])
     craft_eval_question = getattr(prompting_submodule, "craft_eval_question")
-    evaluation_semaphore = threading.Semaphore(config["run_config"]["max_concurrent_evaluation_requests"])
-
-    def competition_thread(candidate1, candidate2, results, index, target_image=target):
-        # Takes in two candidates and return left or right
-
-        with evaluation_semaphore:
-            # randomize the ordering
-            done = False
-            num_tries = 0
-            max_tries = 3
-
-            while not done and num_tries < max_tries:
-                num_tries += 1
-                order = random.sample([0,1], 2)
-
-                left_code = get_code_as_string([candidate1[0], candidate2[0]][order[0]])
-                left_img_file = [candidate1[1], candidate2[1]][order[0]]
-                left_img = Image.open(left_img_file)
-
-                right_code = get_code_as_string([candidate1[0], candidate2[0]][order[1]])
-                right_img_file = [candidate1[1], candidate2[1]][order[1]]
-                right_img = Image.open(right_img_file)
-
-                assert left_img is not None
-                assert right_img is not None
-                assert left_code is not None
-                assert right_code is not None
-                if target_description is None:
-                    print("target description is None -- intended?")
-
-                question_to_critic = craft_eval_question(
-                                        target_image=target_image,
-                                        left_image=left_img,
-                                        right_image=right_img,
-                                        left_code=left_code,
-                                        right_code=right_code,
-                                        target_description=target_description,
-                                        use_vision=use_vision)
-                
-                if target_description is None and target is None:
-                    raise ValueError("No target provided to the competition_thread, either textual or image")
+    judgement_counter = iter(range(sys.maxsize))
+
+    if target_description is None and target is None:
+        raise ValueError("No target provided to the competition, either textual or image")
+
+    def judge_pair(candidate1, candidate2):
+        # Takes in two candidates and returns the index of the winner with the record of the judgement, None if judging failed
+        index = next(judgement_counter)
+
+        # randomize the ordering. Transient errors are retried by the interface (see tasksolver/ratelimit.py), 
+        # so a failed judgement is not asked again
+        done = False
+        num_tries = 0
+        max_tries = 1
+
+        while not done and num_tries < max_tries:
+            num_tries += 1
+            order = random.sample([0,1], 2)
+
+            left_code = get_code_as_string([candidate1[0], candidate2[0]][order[0]])
+            left_img_file = [candidate1[1], candidate2[1]][order[0]]
+            left_img = Image.open(left_img_file)
+
+            right_code = get_code_as_string([candidate1[0], candidate2[0]][order[1]])
+            right_img_file = [candidate1[1], candidate2[1]][order[1]]
+            right_img = Image.open(right_img_file)
+
+            assert left_img is not None
+            assert right_img is not None
+            assert left_code is not None
+            assert right_code is not None
+            if target_description is None:
+                print("target description is None -- intended?")
+
+            question_to_critic = craft_eval_question(
+                                    target_image=target,
+                                    left_image=left_img,
+                                    right_image=right_img,
+                                    left_code=left_code,
+                                    right_code=right_code,
+                                    target_description=target_description,
+                                    use_vision=use_vision)
+
+            try: 
+                p_ans = judge.think(question_to_critic, num_tokens=1000, agent_idx=index)
+                done = True
+            except Exception as e:
+                logger.warning(f"judge querying failed with error: {str(e)}")
+                break
+
+        if not done or p_ans.data not in ("left", "right"):
+            return None
+        winner_index = order[0] if p_ans.data == "left" else order[1]
+        return winner_index, {"left": left_img_file,
+                              "right": right_img_file,
+                              "winner": [candidate1, candidate2][winner_index][1],
+                              "inbound_question": str(question_to_critic),
+                              "thought_string": p_ans.raw}
+
+    return Tournament(judge_pair, 
+                      target=target_key(target, target_description),
+                      memo=memo,
+                      max_concurrent=run_config["max_concurrent_evaluation_requests"],
+                      judge_budget=run_config.get("tournament_judge_budget"))
 
-                try: 
-                    p_ans = judge.think(question_to_critic, num_tokens=1000, agent_idx=index)
-                    done = True
-                except Exception as e: # TODO  ratelimitexception
-                    logger.warning(f"Sleep for 30s, {str(e)}")
-                    time.sleep(30)
-                    continue
-
-            if done:
-                if p_ans.data == "left":
-                    winner_index = order[0]
-                elif p_ans.data == "right":
-                    winner_index = order[1]
-                
-                # return a tuple of (winner, (left_img, right_img), raw answer(left or right), question )
-                results[index] = ([candidate1, candidate2][winner_index], 
-                                (left_img_file, right_img_file),
-                                p_ans.raw, 
-                                question_to_critic)             
-            
-    # assert len(candidates)%2 == 0, "Number candidates should be even, otherwise not handled."
-    assert len(candidates) > 0, "the candidate list is empty"
-     
-    odd_one_out = None
-    if len(candidates)%2 == 1: # number of candidates is odd
-        odd_one_out = candidates[-1] 
-        candidates = candidates[:-1]
 
-    num_candidates = len(candidates)
-    assert num_candidates % 2 == 0
+def get_top_candidate(candidates, target, judge, task_setting:TaskSetting, config:dict, 
+                            target_description=None, use_vision=True, memo:JudgementMemo=None):
+    '''
+    Runs a tournament between candidates, judged by judge against the target.
 
-    results = [None]*(num_candidates//2)
+    Inputs:
+        candidates: (code_path, render_path, ...) tuples
+        memo[optional]: JudgementMemo shared by the selections of a run, pairs found in it are not judged again
+    Outputs:
+        the winner, and the records of the judgements
+    '''
+    run_config = config["run_config"]
+    tournament = candidate_tournament(target, judge, task_setting, config, target_description=target_description,
+                                      use_vision=use_vision, memo=memo)
+    ranking, intermediates = tournament.run(list(candidates),
+                                            format=run_config.get("tournament_format", "single_elimination"),
+                                            top_k=run_config.get("tournament_top_k", 2),
+                                            rounds=run_config.get("tournament_rounds"))
+    num_memoized = sum(1 for record in intermediates if record.get("memoized"))
+    logger.info(f"Tournament between {len(candidates)} candidates: {tournament.judge_calls} judge calls, {num_memoized} memoized judgements.")
+    return ranking[0], intermediates
+
+
+def pipeline_slots(run_config:dict) -> tuple:
+    '''
+    The (think, act) semaphores bounding the generations and the renders of pipelined levels.
+    '''
+    return (threading.Semaphore(run_config["max_concurrent_generator_requests"]),
+            threading.Semaphore(run_config["max_concurrent_rendering_processes"]))
 
-    max_tries = 3
-    num_tries = 0
-    done = False
-    while not done and num_tries < max_tries:
-        num_tries += 1 
 
-        if num_tries > 1:
-            #logger.warning(f"reattempt # {num_tries} for competition between candidates")
-            pass
+def pipelined_level(branching_factor:int, question_to_agent:Question, agent:Agent, incumbent:tuple,
+                    script_save:Path, render_save:Path, blender_file:str, blender_script:str, iteration:int,
+                    target, judge, task_setting:TaskSetting, config:dict, 
+                    target_description=None, use_vision=True, memo:JudgementMemo=None, dedup:ProposalDedup=None,
+                    prefilter:CandidatePrefilter=None, slots:tuple=None):
+    '''
+    One tree level with its stages overlapped: each proposal is rendered as soon as its response is parsed, 
+    and judged against the candidates already rendered while the others are still being generated. 
+    Proposals not rendered `level_deadline` seconds (run_config) after the start of the level are left out,
+    and their generation or rendering is cancelled as soon as the current step is done.
 
-        # results: each entry is (winner, (left_img, right_img), raw answer(left or right), question) 
-        competition_threads = [threading.Thread(target=competition_thread,
-                args=(candidates[2*i], candidates[2*i+1], results, i, target))
-                for i in range(num_candidates//2)]
-        
-        for x in competition_threads:
-            x.start()
-        for x in competition_threads:
-            x.join()             
-
-        # Pick the winners from the list results
-        winners = [winner[0] for winner in results if winner is not None]
-        if len(winners) == 0 and num_candidates//2 > 0:
-            continue
-        done = True
-
-        intermediates = [{"left": winner[1][0],
-                        "right": winner[1][1],
-                        "winner": winner[0][1],
-                        "inbound_question": str(winner[3]),
-                        "thought_string": winner[2]} 
-                        for winner in results if winner is not None]
-
-    if not(len(winners) > 0 or num_candidates//2 == 0):
-        # raise ValueError("All comparisons between samples seem to have failed.")
-        print("All comparisons between samples seem to have failed.")
-    
-    if odd_one_out is not None:
-        winners += [odd_one_out]
-    
-    try:
-        intermediates
-    except NameError:
-        intermediates = []
-
-    if len(winners) > 1:
-        winner, _intermediates = get_top_candidate(winners, target, judge, config=config,
-                    target_description=target_description, task_setting=task_setting,
-                    use_vision=use_vision) 
-        return winner, intermediates + _intermediates
-    else:
-        if not winners:
-            winners.append((None, None))
-        return winners[0], intermediates # the only winner
+    Inputs:
+        incumbent: the (code_path, render_path, ...) best so far, competing with the proposals
+        slots[optional]: (think, act) semaphores shared by the levels of the run, so that the stragglers of 
+            a level count against the concurrency limits of the next one. New ones by default.
+        the others: as for tree_branch and get_top_candidate
+    Outputs:
+        results: the (code_path, render_path, 'placeholder') proposals that made it to the selection
+        top_candidate: the winner
+        intermediates: the records of the judgements
+        discarded: render path -> reason, of the proposals the prefilter kept from the judge. Only blank and 
+            unchanged renders are discarded, the top_k of the prefilter needs all the proposals at once.
+    '''
+    run_config = config["run_config"]
+    deadline = time.monotonic() + run_config["level_deadline"] if run_config.get("level_deadline") else None
+
+    # Generation and rendering hold separate slots, a proposal being rendered doesn't hold back the next generation
+    think_semaphore, act_semaphore = slots if slots is not None else pipeline_slots(run_config)
+    cancel = threading.Event()
+    step = blender_step
+    render_tier = get_render_tier(run_config, run_config.get("exploration_render_tier"))
+    if render_tier is not None:
+        step = functools.partial(step, render_tier=render_tier)
+
+    arrivals = queue.Queue()
+    discarded = {}
+    def thread(idx):
+        result = think_and_act(question_to_agent, agent, idx, 
+                               script_save=script_save, render_save=render_save,
+                               blender_file=blender_file, blender_script=blender_script,
+                               iteration=iteration, config=config, blender_step=step,
+                               think_slot=think_semaphore, act_slot=act_semaphore, dedup=dedup, cancel=cancel)
+        if result[0] is None or (dedup is not None and not dedup.first_time(result)):
+            return
+        reason = prefilter.discard_reason(result, parent_render_path=incumbent[1]) if prefilter is not None else None
+        if reason is not None:
+            discarded[result[1]] = reason
+            return
+        arrivals.put(result)
+
+    # Stragglers past the deadline finish their current step in the background, their proposals are not judged
+    llm_threads = [threading.Thread(target=thread, args=(i,), daemon=True) for i in range(branching_factor)]
+    for x in llm_threads:
+        x.start()
+    def close_arrivals():
+        for x in llm_threads:
+            x.join()
+        arrivals.put(None)
+    threading.Thread(target=close_arrivals, daemon=True).start()
+
+    tournament = candidate_tournament(target, judge, task_setting, config, target_description=target_description,
+                                      use_vision=use_vision, memo=memo)
+    ranking, intermediates = tournament.run_stream(arrivals, candidates=[incumbent],
+                                                   format=run_config.get("tournament_format", "single_elimination"),
+                                                   top_k=run_config.get("tournament_top_k", 2),
+                                                   rounds=run_config.get("tournament_rounds"),
+                                                   deadline=deadline)
+    cancel.set()
+    results = [candidate for candidate in tournament.entrants if candidate is not incumbent]
+    if len(results) < branching_factor:
+        logger.info(f"{len(results)}/{branching_factor} proposals made it to the selection of iteration {iteration}.")
+    return results, ranking[0], intermediates, dict(discarded)
 
 
 def make_if_nonexistent(folder):
@@ -338,7 +453,7 @@ def merge_images_in_directory(directory, saved_to_local=True, merge_dir_into_ima
 
 
 
-def blender_step(infinigen_installation_path, blender_file_path, blender_render_script_path, script_path, render_dir, merge_all_renders=False, replace_if_overlap=True, merge_dir_into_image=False):
+def blender_step(infinigen_installation_path, blender_file_path, blender_render_script_path, script_path, render_dir, merge_all_renders=False, replace_if_overlap=True, merge_dir_into_image=False, render_tier=None):
 
     '''
     Generate a rendered image with given script_path at render_dir.
@@ -350,6 +465,7 @@ def blender_step(infinigen_installation_path, blender_file_path, blender_render_
         render_dir: dir path to save the rendered images
         merge_all_renders[optional]: True will merge all images in render_dir
         replace_if_overlap[optional]: False will skip if the render_dir exists and is non-empty, and True will proceed replace every overlapping render 
+        render_tier[optional]: render setting overrides (see `render_tiers` in run_config), None for full quality
     '''
 
     def is_directory_empty(directory_path):
@@ -374,12 +490,8 @@ def blender_step(infinigen_installation_path, blender_file_path, blender_render_
     print('script_path: ', script_path)
     print('render_dir: ', render_dir)
 
-    # Enter the blender code
-    command = [infinigen_installation_path, "--background", blender_file_path, 
-                    "--python", blender_render_script_path, 
-                    "--", script_path, render_dir]
-    command = ' '.join(command)
-    command_run = subprocess.run(command, shell=True, check=True)
+    # Enter the blender code, through the Blender worker pool if one is running
+    run_blender(infinigen_installation_path, blender_file_path, blender_render_script_path, script_path, render_dir, render_tier=render_tier)
 
     # if is_directory_empty(render_dir):
     #     print(f"The following bpy script didn't run correctly in blender:{script_path}")
@@ -393,6 +505,124 @@ def blender_step(infinigen_installation_path, blender_file_path, blender_render_
     return True
 
 
+def blender_step_batch(infinigen_installation_path, blender_file_path, blender_render_script_path, jobs, merge_all_renders=False, replace_if_overlap=True, merge_dir_into_image=False, render_tier=None):
+
+    '''
+    Same as blender_step, for a list of scripts rendered in a single Blender process (or by the worker pool).
+
+    Inputs:
+        jobs: list of (script_path, render_dir)
+        other inputs: same as blender_step
+    Outputs:
+        list of booleans, False where the script did not produce any render
+    '''
+
+    assert blender_file_path is not None and blender_render_script_path is not None
+
+    outcomes = [None] * len(jobs)
+    to_render = []
+    for idx, (script_path, render_dir) in enumerate(jobs):
+        if not replace_if_overlap and os.path.isdir(render_dir) and len(os.listdir(render_dir)) > 0:
+            continue
+        os.makedirs(render_dir, exist_ok=True)
+        to_render.append(idx)
+
+    rendered = run_blender_batch(infinigen_installation_path, blender_file_path, blender_render_script_path,
+                                 [jobs[idx] for idx in to_render], render_tier=render_tier)
+
+    for idx, ok in zip(to_render, rendered):
+        try:
+            merge_images_in_directory(jobs[idx][1], saved_to_local=True, merge_dir_into_image=merge_dir_into_image)
+            outcomes[idx] = os.path.exists(jobs[idx][1])
+        except CodeExecutionException:
+            outcomes[idx] = False
+    return outcomes
+
+
+# Render setting overrides by tier name, extended/overridden by `render_tiers` in run_config.
+# "full" (or no tier) renders with the settings of the render script.
+DEFAULT_RENDER_TIERS = {
+    "full": None,
+    "preview": {"resolution_percentage": 50, "samples": 16},
+}
+
+
+def get_render_tier(run_config:dict, tier_name:str):
+    '''
+    Render setting overrides for tier_name, None for full quality.
+    '''
+    if tier_name is None:
+        return None
+    render_tiers = dict(DEFAULT_RENDER_TIERS)
+    render_tiers.update(run_config.get("render_tiers") or {})
+    if tier_name not in render_tiers:
+        raise ValueError(f"Unknown render tier {tier_name}, expected one of {list(render_tiers)}")
+    return render_tiers[tier_name] or None
+
+
+class DeferredBlenderStep(object):
+    """
+    Stands in for blender_step in agent.act: records the render jobs of a tree level instead of
+    rendering them one by one, so that render() can submit them to blender_step_batch at once.
+    """
+    def __init__(self):
+        self.jobs = []
+        self.lock = threading.Lock()
+
+    def __call__(self, infinigen_installation_path, blender_file_path, blender_render_script_path, script_path, render_dir, merge_all_renders=False, replace_if_overlap=True, merge_dir_into_image=False, render_tier=None):
+        with self.lock:
+            self.jobs.append(((infinigen_installation_path, blender_file_path, blender_render_script_path),
+                              (script_path, render_dir),
+                              dict(merge_all_renders=merge_all_renders,
+                                   replace_if_overlap=replace_if_overlap,
+                                   merge_dir_into_image=merge_dir_into_image,
+                                   render_tier=json.dumps(render_tier, sort_keys=True))))
+        return True
+
+    def render(self):
+        '''
+        Returns a dict render_dir -> whether it rendered successfully.
+        '''
+        with self.lock:
+            jobs, self.jobs = self.jobs, []
+
+        # one batch per distinct (blender, .blend, render script, options)
+        batches = {}
+        for blender_args, job, options in jobs:
+            batch_key = (blender_args, tuple(sorted(options.items())))
+            batches.setdefault(batch_key, []).append(job)
+
+        outcomes = {}
+        for (blender_args, options), batch_jobs in batches.items():
+            options = dict(options)
+            options["render_tier"] = json.loads(options["render_tier"])
+            batch_outcomes = blender_step_batch(*blender_args, batch_jobs, **options)
+            for (script_path, render_dir), ok in zip(batch_jobs, batch_outcomes):
+                outcomes[render_dir] = ok
+        return outcomes
+
+
+# Agents (and the model weights they hold) built so far in this process, reused by later refinement runs
+_agents = {}
+_agents_lock = threading.Lock()
+
+
+def get_agent(agent_class, credentials, task, vision_model:str):
+    '''
+    The agent_class agent for task and vision_model, constructed on first use and shared by every
+    refinement run of the process afterwards. Agents keep no state between questions.
+    '''
+    if isinstance(credentials, KeyChain):
+        credentials_key = tuple(sorted(credentials.keys.items()))
+    else:
+        credentials_key = credentials
+    key = (agent_class, id(task), vision_model, credentials_key)
+    with _agents_lock:
+        if key not in _agents:
+            _agents[key] = (task, agent_class(credentials, task, vision_model=vision_model))
+        return _agents[key][1]
+
+
 def refinement(config, credentials, breadth, depth, blender_file, blender_script, 
                 init_code, method_variation, output_folder, overwrite=True):        
     
@@ -427,6 +657,12 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
     make_if_nonexistent(render_save)
     make_if_nonexistent(thoughtprocess_save)
             
+    # Keep Blender processes alive across renders if asked to
+    ensure_worker_pool(run_config["blender_command"], run_config.get("num_blender_workers", 0))
+    # Reuse renders of scripts that were already rendered, by this or an earlier run
+    render_cache = ensure_render_cache(run_config.get("render_cache_dir"), run_config.get("render_cache_max_gb", 20))
+    render_cache_stats_before = render_cache.stats() if render_cache is not None else None
+
     init_render_file = os.path.join(output_folder, "init_render.png")      # The original blender rendered image
     target_code = config["input"]["target_code"]       # Target bpy code
     target_render_file = config["input"]["input_image"]     # Dalle generated pseudo-target image based on the text file
@@ -438,6 +674,37 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
 
     init_image = Image.open(init_render_file)      # Keep an record of original image
 
+    # Optionally render the proposals at a cheaper tier (see `render_tiers`), and only the winners at full quality
+    exploration_tier_name = run_config.get("exploration_render_tier")
+    exploration_tier = get_render_tier(run_config, exploration_tier_name)
+    full_render_save = Path(output_folder)/Path("renders_full/")
+    if exploration_tier is not None:
+        make_if_nonexistent(full_render_save)
+
+    def render_preview(code_path, render_path):
+        # The best so far is judged against the proposals as a render of the same tier
+        if exploration_tier is None:
+            return render_path
+        preview_path = os.path.splitext(render_path)[0] + "_preview.png"
+        if not os.path.exists(preview_path):
+            try:
+                blender_step(run_config["blender_command"], blender_file, blender_script, code_path, preview_path, merge_all_renders=True, merge_dir_into_image=True, render_tier=exploration_tier)
+            except CodeExecutionException:
+                logger.warning(f"Preview render of {code_path} failed, judging its full quality render instead.")
+                return render_path
+        return preview_path
+
+    def render_full(code_path, preview_path):
+        # Re-render a winning proposal with the settings of the render script
+        full_path = str(full_render_save / os.path.basename(preview_path))
+        if not os.path.exists(full_path):
+            try:
+                blender_step(run_config["blender_command"], blender_file, blender_script, code_path, full_path, merge_all_renders=True, merge_dir_into_image=True)
+            except CodeExecutionException:
+                logger.warning(f"Full quality render of {code_path} failed, keeping its preview render.")
+                return preview_path
+        return full_path
+
 
     if target_render_file is not None:      # If provided with a path to ideal target image
         if target_code is not None and not os.path.exists(target_render_file):  # If target_code is also provided and no image provided
@@ -528,8 +795,8 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
     #     agent = param_tuner
     #     thinker_is_visual = True
 
-    param_tuner = thinker_class_type (credentials, parameter_search_task, vision_model=run_config["edit_generator_type"])
-    agent = thinker_class_type (credentials, code_editing_task, vision_model=run_config["edit_generator_type"])
+    param_tuner = get_agent(thinker_class_type, credentials, parameter_search_task, vision_model=run_config["edit_generator_type"])
+    agent = get_agent(thinker_class_type, credentials, code_editing_task, vision_model=run_config["edit_generator_type"])
     thinker_is_visual = True
 
 
@@ -566,7 +833,7 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
     #     judge = GeneralAgent(None, pruning_task, vision_model=run_config["state_evaluator_type"])
     #     evaluator_is_visual = True
 
-    judge = GeneralAgent(credentials, pruning_task, vision_model=run_config["state_evaluator_type"])
+    judge = get_agent(GeneralAgent, credentials, pruning_task, vision_model=run_config["state_evaluator_type"])
     evaluator_is_visual = True
 
     # raise ValueError(f"Invalid evaluator: {run_config['state_evaluator_type']}")
@@ -581,8 +848,19 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
     # start of simulation
     code_path = init_code       # original starter code
     render_path = init_render_file      # path of original rendered image
+    preview_path = None     # render of code_path at the exploration tier, rendered lazily
 
     intermediary_outputs = []
+    # Judgements of the run, pairs that meet again at a later level are not judged twice
+    judgement_memo = JudgementMemo()
+    # Overlap the generation, rendering and judging of each level (see pipelined_level). Batch rendering 
+    # renders a whole level at once, so it keeps the staged levels.
+    pipelined_levels = run_config.get("pipelined_levels", False) and not run_config.get("batch_rendering", False)
+    level_slots = pipeline_slots(run_config) if pipelined_levels else None
+    # Breadth of each level and early stopping, see utils/search_control.py
+    search_controller = get_search_controller(run_config, breadth, depth, target_image=target_image)
+    # Local pre-selection of the candidates before judging, see utils/prefilter.py
+    prefilter = get_prefilter(run_config, target_image=target_image)
 
     for i in tqdm(range(depth)):       # Tree depth
         if not overwrite:
@@ -595,6 +873,7 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
                 if "winner_code" in process_json[-1] and "winner_image" in process_json[-1]:
                     code_path = process_json[-1]["winner_code"]
                     render_path = process_json[-1]["winner_image"]
+                    preview_path = process_json[-1].get("winner_preview_image")
                     intermediary_outputs.append({
                                     'code_path': code_path, 
                                     'render_path': render_path,
@@ -605,6 +884,11 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
                     pass # start at this iteration! 
 
         process_json = []
+        if preview_path is None:
+            preview_path = render_preview(code_path, render_path)
+        # Proposals repeating each other or the best so far share one render and one tournament slot
+        dedup = ProposalDedup(incumbent=(code_path, preview_path))
+        level_breadth = search_controller.next_breadth(i)
         
         if (method_variation in ('tune_leap',) and i%2 == 0) or method_variation in ('tune',):
         # The case of tune
@@ -619,22 +903,42 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
             
             logger.info(f"tuner_question_formed")
 
-            # Run think-act on the agent by `breadth` times
+            # Run think-act on the agent by `level_breadth` times (`breadth`, unless the search controller changes it)
             # results is a list of length `breadth`, one runnable modification on each entry
             # Each entry is (code_path, render_path, p_ans.raw), code_path is the path to the modified bpy script, 
             # render_path the resulting rendered image, and parsed answer
-            results = tree_branch(breadth, tuner_question, 
+            if pipelined_levels:
+                results, top_candidate, intermediates, discarded = pipelined_level(level_breadth, tuner_question, 
+                                        agent=param_tuner,
+                                        incumbent=(code_path, preview_path, 'placeholder'),
+                                        script_save=script_save,
+                                        render_save=render_save,
+                                        blender_file=blender_file, 
+                                        blender_script=blender_script,
+                                        iteration=i, 
+                                        target=target_image, judge=judge, 
+                                        task_setting=task_type, config=config,
+                                        target_description=target_description,
+                                        use_vision=evaluator_is_visual,
+                                        memo=judgement_memo,
+                                        dedup=dedup,
+                                        prefilter=prefilter,
+                                        slots=level_slots)
+            else:
+                results = tree_branch(level_breadth, tuner_question, 
                                         agent=param_tuner,
                                         script_save=script_save,
                                         render_save=render_save,
                                         thoughtprocess_save=process_json,
                                         blender_file=blender_file, 
                                         blender_script=blender_script,
-                                        iteration=i, config=config)
+                                        iteration=i, config=config, dedup=dedup)
             
             logger.info(f"Runnable modifications generated for iteration {i}/{depth-1}(0-indexed) of depth")
 
             results = [el for el in results if el[0] is not None]       # Take out the code_path
+            if not pipelined_levels:
+                results = dedup.unique(results)     # pipelined levels only queue distinct proposals
 
             # Register all the potential modifications to the json file
             process_json.append(
@@ -644,21 +948,35 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
                     "inbound_question": str(tuner_question),
                     "choices_image": [res[1] for res in results],
                     "choices_code": [res[0] for res in results],
-                    "thought_strings": [res[2] for res in results]
+                    "thought_strings": [res[2] for res in results],
+                    "render_tier": exploration_tier_name
                 }   
             )
+            process_json.append({"phase": "dedup", "iteration": i, **dedup.stats()})
 
-            results.append((code_path, render_path, 'placeholder'))
+            incumbent = (code_path, preview_path, 'placeholder')
+            results.append(incumbent)
+
+            # Keep blank, unchanged and (with a target image) far off renders from the judge
+            if prefilter is not None:
+                if pipelined_levels:
+                    prefilter_record = {"phase": "prefilter", "metric": prefilter.metric, "discarded": discarded, 
+                                        "kept": [res[1] for res in results], "judge_calls_saved": len(discarded)}
+                else:
+                    results, prefilter_record = prefilter.select(results, incumbent=incumbent)
+                process_json.append(dict(prefilter_record, iteration=i))
 
-            # Get the top candidate by state evaluator
+            # Get the top candidate by state evaluator (already done with pipelined levels)
             if len(results) > 1:
 
                 # top_candidate is a (code, image) pair
-                top_candidate, intermediates = get_top_candidate(results,
+                if not pipelined_levels:
+                    top_candidate, intermediates = get_top_candidate(results,
                                 target_image, judge, config=config, 
                                 target_description=target_description, 
                                 task_setting=task_type,
-                                use_vision=evaluator_is_visual)
+                                use_vision=evaluator_is_visual,
+                                memo=judgement_memo)
                 process_json.append(
                     {
                         "phase": "selection",
@@ -670,7 +988,7 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
                     }
                 )
             else:
-                top_candidate = (code_path, render_path)
+                top_candidate = (code_path, preview_path)
                 process_json.append(
                     {
                         "phase": "selection",
@@ -694,17 +1012,37 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
                 target_description=target_description,
                 use_vision=thinker_is_visual) 
 
-            results = tree_branch(breadth, question_to_agent, 
+            if pipelined_levels:
+                results, top_candidate, intermediates, discarded = pipelined_level(level_breadth, question_to_agent, 
+                                        agent=agent,
+                                        incumbent=(code_path, preview_path, 'placeholder'),
+                                        script_save=script_save,
+                                        render_save=render_save,
+                                        blender_file=blender_file, 
+                                        blender_script=blender_script,
+                                        iteration=i, 
+                                        target=target_image, judge=judge, 
+                                        task_setting=task_type, config=config,
+                                        target_description=target_description,
+                                        use_vision=evaluator_is_visual,
+                                        memo=judgement_memo,
+                                        dedup=dedup,
+                                        prefilter=prefilter,
+                                        slots=level_slots)
+            else:
+                results = tree_branch(level_breadth, question_to_agent, 
                                         agent=agent,
                                         script_save=script_save,
                                         render_save=render_save,
                                         thoughtprocess_save=process_json,
                                         blender_file=blender_file, 
                                         blender_script=blender_script,
-                                        iteration=i, config=config)
+                                        iteration=i, config=config, dedup=dedup)
             logger.info(f"Runnable modifications generated for iteration {i}/{depth} of depth")
 
             results = [el for el in results if el[0] is not None]
+            if not pipelined_levels:
+                results = dedup.unique(results)     # pipelined levels only queue distinct proposals
             process_json.append(
                 {
                     "phase": "explode_options_LEAP",
@@ -712,18 +1050,32 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
                     "inbound_question": str(question_to_agent),
                     "choices_image": [res[1] for res in results],
                     "choices_code": [res[0] for res in results],
-                    "thought_strings": [res[2] for res in results]
+                    "thought_strings": [res[2] for res in results],
+                    "render_tier": exploration_tier_name
                 }   
             )
+            process_json.append({"phase": "dedup", "iteration": i, **dedup.stats()})
+
+            incumbent = (code_path, preview_path, 'placeholder')
+            results.append(incumbent)
 
-            results.append((code_path, render_path, 'placeholder'))
+            # Keep blank, unchanged and (with a target image) far off renders from the judge
+            if prefilter is not None:
+                if pipelined_levels:
+                    prefilter_record = {"phase": "prefilter", "metric": prefilter.metric, "discarded": discarded, 
+                                        "kept": [res[1] for res in results], "judge_calls_saved": len(discarded)}
+                else:
+                    results, prefilter_record = prefilter.select(results, incumbent=incumbent)
+                process_json.append(dict(prefilter_record, iteration=i))
 
             if len(results) > 1:
-                top_candidate, intermediates = get_top_candidate(results, 
+                if not pipelined_levels:
+                    top_candidate, intermediates = get_top_candidate(results, 
                                 target_image, judge, config=config, 
                                 target_description=target_description,
                                 task_setting=task_type,
-                                use_vision=evaluator_is_visual)
+                                use_vision=evaluator_is_visual,
+                                memo=judgement_memo)
                 process_json.append(
                     {
                         "phase": "selection",
@@ -736,7 +1088,7 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
                     }
                 )
             else:
-                top_candidate = (code_path, render_path)
+                top_candidate = (code_path, preview_path)
                 process_json.append(
                     {
                         "phase": "selection",
@@ -772,22 +1124,134 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
         #             #logger.info("Check shows that old sample is better. Rebasing to old sample.")
         #             pass
         
+        # The selection was made on exploration tier renders, carry the winner on with a full quality render
+        winner_preview_path = top_candidate[1]
+        if exploration_tier is not None:
+            if top_candidate[0] == code_path:
+                top_candidate = (code_path, render_path)
+            elif top_candidate[0] is not None:
+                top_candidate = (top_candidate[0], render_full(top_candidate[0], winner_preview_path))
+            process_json.append(
+                {
+                    "phase": "selection_rerender",
+                    "iteration": i,
+                    "render_tier": exploration_tier_name,
+                    "winner_preview_image": winner_preview_path,
+                    "winner_image": top_candidate[1],
+                    "winner_code": top_candidate[0]
+                }
+            )
+
         logger.info(f"Top candidated picked for iteration {i}/{depth-1}(0-indexed) of depth. Code:{top_candidate[0]}, image:{top_candidate[1]}")
 
+        # Outcome of the level for the search controller, with the winner so that it reads as the last selection
+        search_record = search_controller.observe(i, level_breadth, new_winner=top_candidate[0] not in (None, code_path), 
+                                                  render_path=top_candidate[1])
+        process_json.append(dict(search_record, phase="search_control", winner_code=top_candidate[0], 
+                                 winner_image=top_candidate[1], winner_preview_image=winner_preview_path))
+
         with open(thoughtprocess_save/f"iteration_{i}.json", "w") as f:
             json.dump(process_json, f)
             logger.info(f"Thought process saved for iteration {i}")
 
         # set new, best so far
         code_path, render_path = top_candidate[0], top_candidate[1] 
+        preview_path = winner_preview_path
         # add to final output
         intermediary_outputs.append({'code_path': code_path, 
                                 'render_path': render_path,
                                 "iteration": i})
 
+        # Stop early, recording the winner as the outcome of the skipped iterations
+        stop_reason = search_controller.should_stop()
+        if stop_reason is not None and i < depth - 1:
+            logger.info(f"Search stopped after iteration {i}/{depth-1}(0-indexed) of depth: {stop_reason}")
+            for j in range(i + 1, depth):
+                with open(thoughtprocess_save/f"iteration_{j}.json", "w") as f:
+                    json.dump([{"phase": "early_stop", "iteration": j, "stopped_after": i, "reason": stop_reason,
+                                "winner_code": code_path, "winner_image": render_path, "winner_preview_image": preview_path}], f)
+            break
+
 
     fig = plot_image_grid([(Image.open(el["render_path"]) if el is not None else None) 
                 for el in intermediary_outputs], 
                 rows=1, cols=len(intermediary_outputs))
     fig.savefig(str(output_folder/"best_of.png"))
+
+    save_cache_stats(str(output_folder/"render_cache_stats.json"), since=render_cache_stats_before)
+
+    # Time spent throttled by the provider rate limits and backing off, since the start of the process
+    with open(str(output_folder/"throttle_stats.json"), "w") as f:
+        json.dump(throttle_stats(), f, indent=4)
+
+
+def run_refinement(config:dict, starter_blend:str, blender_base:str, blender_script:str, model_id:str=None):
+    '''
+    Run BlenderAlchemy on one starter scene, for every variant and tree dimension of the config,
+    in the calling process. Agents are reused across calls (see get_agent).
+
+    Inputs:
+        config: the config dict, as loaded from configs/*.yaml
+        starter_blend: path to the base blender file
+        blender_base: path to the render script of the blender scene
+        blender_script: path to the script to edit
+        model_id[optional]: overrides both the generator and the verifier model
+    Outputs:
+        list of the result folders, one per (instance, variant, tree dimension)
+    '''
+    if model_id:
+        config["run_config"]["edit_generator_type"] = model_id
+        config["run_config"]["state_evaluator_type"] = model_id
+
+    kc = KeyChain() 
+    for el in config["credentials"]:
+        if config["credentials"][el] is not None:
+            kc.add_key(el, config["credentials"][el])
+
+    output_dir = Path(config['output']['output_dir'])
+    if not output_dir.exists():
+        output_dir.mkdir(parents=True, exist_ok=True)
     
+    dimensions = [[int(ell) for ell in el.strip().split("x")] for el in config["run_config"]["tree_dims"]]    
+    variants = [el.strip() for el in config["run_config"]["variants"]]
+    
+    desc = config["input"]["text_prompt"]
+
+    if config["run_config"]["enable_visual_imagination"]:
+        assert config["run_config"]["num_tries"] > 0, "number of starter images should be positive if imagination is on."
+        # initialize the image generator client
+        client = OpenAI(api_key=kc["openai"])  
+        download_paths = []
+        for i in range(config["run_config"]["num_tries"]):     # The number of starer_images entered in cmd line
+            response = client.images.generate(
+                model="dall-e-3",
+                prompt=f"Close-up photorealistic rendering of {desc}",
+                size="1024x1024",
+                quality="standard",
+                n=1,
+            )
+            download_paths.append(response.data[0].url)
+
+        for instance_idx, url in enumerate(download_paths):     # Saved the generated images based on description
+            download_to = output_dir/f"target_instance{instance_idx}.png"
+            urllib.request.urlretrieve(url, download_to)
+            logger.info(f"Saved generated image to {download_to}.")
+
+    results_folders = []
+    for instance_idx in range(config["run_config"]["num_tries"]):
+        for var in variants:
+            for depth, breadth in dimensions:
+                subfolder = f'{var}_d{depth}_b{breadth}'
+                results_folder = output_dir/f"instance{instance_idx}"/subfolder
+                
+                # down the hole we go.
+                refinement(config, 
+                           credentials=kc,
+                           breadth=breadth, depth=depth,
+                           blender_file=starter_blend,
+                           blender_script=blender_base,
+                           init_code=blender_script,
+                           method_variation=var,
+                           output_folder=results_folder)
+                results_folders.append(results_folder)
+    return results_folders
@@ -0,0 +1,407 @@
+"""
+A pool of long-lived Blender processes.
+
+Spawning `blender --background <file>.blend --python <render script>` for every proposal pays
+Blender startup and .blend loading each time. A pool worker keeps a .blend loaded and renders
+(script, render_dir) jobs sent over a local socket, reloading the pristine scene between jobs.
+
+blender_step() in refinement_process.py and in the top-level utils.py both go through run_blender(),
+which uses the process-wide pool when one has been started with ensure_worker_pool().
+blender_step_batch() goes through run_blender_batch(), which renders a list of scripts in a single
+Blender process when no pool is running.
+
+Render tiers (cheaper render settings, see `render_tiers` in run_config) are applied to a temporary
+copy of the edit script, which gets the setting overrides appended. Every render script exec()s the
+edit script right before rendering, so the overrides apply whichever render script is used.
+
+Every render holds a slot of the "blender" limit of tasksolver/limits.py, which bounds the number of
+Blender processes rendering at once across all the instances of a run.
+"""
+
+import os
+import json
+import time
+import atexit
+import contextlib
+import socket
+import secrets
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from tasksolver.limits import limit_slot
+
+from .render_cache import get_active_cache, image_stats
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             "blender_base", "worker_render_script.py")
+BATCH_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            "blender_base", "batch_render_script.py")
+
+RENDER_TIER_OVERRIDES = """
+
+# Render tier overrides, appended by run_blender() (utils/blender_pool.py)
+import bpy as _bpy
+_render_tier = {render_tier!r}
+if "engine" in _render_tier:
+    _bpy.context.scene.render.engine = _render_tier["engine"]
+if "resolution_percentage" in _render_tier:
+    _bpy.context.scene.render.resolution_percentage = _render_tier["resolution_percentage"]
+if "samples" in _render_tier:
+    _bpy.context.scene.cycles.samples = _render_tier["samples"]
+    if hasattr(_bpy.context.scene, "eevee"):
+        _bpy.context.scene.eevee.taa_render_samples = _render_tier["samples"]
+"""
+
+
+class BlenderWorker(object):
+    """
+    One Blender process, connected to the pool through a local socket.
+    """
+    def __init__(self, blender_command:str, blender_file:str, startup_timeout:float=300):
+        self.blender_file = os.path.abspath(blender_file)
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        listener.settimeout(1.0)
+        host, port = listener.getsockname()
+        token = secrets.token_hex(16)
+
+        self.command = [blender_command, "--background", self.blender_file,
+                        "--python", WORKER_SCRIPT,
+                        "--", host, str(port), token]
+        self.process = subprocess.Popen(self.command)
+
+        # Wait for the worker to connect back, as long as the process is still alive
+        self.connection = None
+        start_time = time.time()
+        try:
+            while self.connection is None:
+                if self.process.poll() is not None:
+                    raise subprocess.CalledProcessError(self.process.returncode, self.command)
+                if time.time() - start_time > startup_timeout:
+                    self.process.kill()
+                    raise TimeoutError(f"Blender worker did not connect within {startup_timeout}s.")
+                try:
+                    connection, _ = listener.accept()
+                except socket.timeout:
+                    continue
+                connection.settimeout(None)
+                stream = connection.makefile("rw")
+                if stream.readline().strip() != token:
+                    stream.close()
+                    connection.close()
+                    continue
+                self.connection = connection
+                self.stream = stream
+        finally:
+            listener.close()
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def render(self, blender_file:str, render_script:str, script_path:str, render_dir:str) -> bool:
+        '''
+        Render script_path into render_dir.
+
+        Outputs:
+            False if the edit script raised inside Blender, True otherwise.
+        Raises:
+            subprocess.CalledProcessError if the Blender process died during the job.
+        '''
+        job = {"blender_file": os.path.abspath(blender_file),
+               "render_script": os.path.abspath(render_script),
+               "script_path": os.path.abspath(script_path),
+               "render_dir": os.path.abspath(render_dir)}
+        try:
+            self.stream.write(json.dumps(job) + "\n")
+            self.stream.flush()
+            line = self.stream.readline()
+        except OSError:
+            line = ""
+        if not line:
+            self.process.wait()
+            raise subprocess.CalledProcessError(self.process.returncode, self.command)
+
+        self.blender_file = job["blender_file"]
+        result = json.loads(line)
+        if not result["ok"]:
+            logger.warning(f"The following bpy script failed in the Blender worker:{script_path}\n{result['error']}")
+        return result["ok"]
+
+    def close(self, timeout:float=30):
+        try:
+            self.stream.write(json.dumps(None) + "\n")
+            self.stream.flush()
+            self.stream.close()
+            self.connection.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class BlenderWorkerPool(object):
+    """
+    Up to `num_workers` Blender processes, spawned lazily. Jobs are routed to an idle worker that
+    already has the requested .blend loaded when there is one.
+
+    Example usage:
+        with BlenderWorkerPool(blender_command, num_workers=4) as pool:
+            pool.render(blender_file, render_script, script_path, render_dir)
+    """
+    def __init__(self, blender_command:str, num_workers:int=1, startup_timeout:float=300):
+        assert num_workers > 0
+        self.blender_command = blender_command
+        self.num_workers = num_workers
+        self.startup_timeout = startup_timeout
+
+        self._idle = []
+        self._num_live = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def _acquire(self, blender_file):
+        # Returns an idle worker, or None when the caller should spawn a new one.
+        blender_file = os.path.abspath(blender_file)
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("BlenderWorkerPool is closed.")
+                for worker in self._idle:
+                    if worker.blender_file == blender_file:
+                        self._idle.remove(worker)
+                        return worker
+                if self._num_live < self.num_workers:
+                    self._num_live += 1
+                    return None
+                if self._idle:
+                    return self._idle.pop(0)
+                self._condition.wait()
+
+    def _release(self, worker):
+        with self._condition:
+            if worker is not None and worker.alive and not self._closed:
+                self._idle.append(worker)
+            else:
+                self._num_live -= 1
+                if worker is not None:
+                    worker.close()
+            self._condition.notify()
+
+    def render(self, blender_file:str, render_script:str, script_path:str, render_dir:str) -> bool:
+        worker = self._acquire(blender_file)
+        try:
+            # Only count busy workers against the "blender" limit shared by all processes of the run
+            with limit_slot("blender"):
+                if worker is None:
+                    worker = BlenderWorker(self.blender_command, blender_file, startup_timeout=self.startup_timeout)
+                return worker.render(blender_file, render_script, script_path, render_dir)
+        finally:
+            self._release(worker)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._condition.notify_all()
+        for worker in idle:
+            worker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_active_pool = None
+_active_pool_lock = threading.Lock()
+
+
+def get_active_pool():
+    return _active_pool
+
+
+def set_active_pool(pool):
+    global _active_pool
+    with _active_pool_lock:
+        _active_pool = pool
+
+
+def ensure_worker_pool(blender_command:str, num_workers:int):
+    '''
+    Start the process-wide worker pool if num_workers > 0 and no pool is running yet.
+    The pool is kept alive across refinement() calls and closed at interpreter exit.
+    '''
+    global _active_pool
+    if not num_workers or num_workers <= 0:
+        return _active_pool
+    with _active_pool_lock:
+        if _active_pool is None:
+            logger.info(f"Starting a pool of {num_workers} Blender workers.")
+            _active_pool = BlenderWorkerPool(blender_command, num_workers=num_workers)
+            atexit.register(_active_pool.close)
+    return _active_pool
+
+
+@contextlib.contextmanager
+def tiered_scripts(script_paths:list, render_tier:dict=None):
+    '''
+    Paths of copies of the edit scripts with the render setting overrides of render_tier appended,
+    removed on exit. The scripts themselves when render_tier is None.
+    '''
+    if not render_tier:
+        yield list(script_paths)
+        return
+    with tempfile.TemporaryDirectory(prefix="render_tier_") as tier_dir:
+        tiered_paths = []
+        for idx, script_path in enumerate(script_paths):
+            with open(script_path, "r") as f:
+                code = f.read()
+            tiered_path = os.path.join(tier_dir, f"{idx}_{os.path.basename(script_path)}")
+            with open(tiered_path, "w") as f:
+                f.write(code + RENDER_TIER_OVERRIDES.format(render_tier=dict(render_tier)))
+            tiered_paths.append(tiered_path)
+        yield tiered_paths
+
+
+def render_tier_cache_tag(render_tier:dict=None):
+    return json.dumps(render_tier, sort_keys=True) if render_tier else ""
+
+
+def run_blender(blender_command:str, blender_file:str, render_script:str, script_path:str, render_dir:str, render_tier:dict=None):
+    '''
+    Render script_path into render_dir, through the active worker pool when there is one,
+    otherwise with a fresh Blender process. Renders found in the active render cache are copied
+    into render_dir without running Blender.
+
+    Inputs:
+        blender_command: path to the blender executable
+        blender_file: file path to the .blend base file
+        render_script: file path to the render script of blender scene
+        script_path: file path to the script we want to render
+        render_dir: dir path to save the rendered images
+        render_tier[optional]: render setting overrides, e.g. {"engine": "BLENDER_EEVEE_NEXT", "resolution_percentage": 50, "samples": 16}.
+            None renders with the settings of the render script.
+    '''
+    cache = get_active_cache()
+    if cache is not None:
+        cache_key = cache.key(blender_file, render_script, script_path, extra=render_tier_cache_tag(render_tier))
+        if cache.fetch(cache_key, render_dir):
+            return
+        before = image_stats(render_dir)
+
+    ok = True
+    pool = _active_pool
+    with tiered_scripts([script_path], render_tier) as (render_script_path,):
+        if pool is not None and pool.blender_command == blender_command:
+            ok = pool.render(blender_file, render_script, render_script_path, render_dir)
+        else:
+            command = [blender_command, "--background", blender_file,
+                            "--python", render_script,
+                            "--", render_script_path, render_dir]
+            command = ' '.join(command)
+            with limit_slot("blender"):
+                subprocess.run(command, shell=True, check=True)
+
+    # A failed edit script may leave the images of an earlier render, never cache those
+    if ok and cache is not None:
+        cache.store(cache_key, render_dir, before=before)
+
+
+def _run_batch_process(blender_command:str, blender_file:str, render_script:str, jobs:list) -> list:
+    # Runs jobs in one Blender process, relaunching it for the remaining jobs if it crashes.
+    outcomes = [None] * len(jobs)
+    with tempfile.TemporaryDirectory() as manifest_dir:
+        while None in outcomes:
+            pending = [idx for idx, outcome in enumerate(outcomes) if outcome is None]
+            manifest_path = os.path.join(manifest_dir, "manifest.json")
+            results_path = os.path.join(manifest_dir, "results.json")
+            if os.path.exists(results_path):
+                os.remove(results_path)
+            with open(manifest_path, "w") as f:
+                json.dump({"render_script": os.path.abspath(render_script),
+                           "results_path": results_path,
+                           "jobs": [{"script_path": os.path.abspath(jobs[idx][0]),
+                                     "render_dir": os.path.abspath(jobs[idx][1])} for idx in pending]}, f)
+
+            command = [blender_command, "--background", blender_file,
+                            "--python", BATCH_SCRIPT,
+                            "--", manifest_path]
+            with limit_slot("blender"):
+                command_run = subprocess.run(' '.join(command), shell=True)
+
+            results = []
+            if os.path.exists(results_path):
+                with open(results_path, "r") as f:
+                    results = json.load(f)
+            for idx, result in zip(pending, results):
+                outcomes[idx] = result["ok"]
+                if not result["ok"]:
+                    logger.warning(f"The following bpy script failed in the batch:{jobs[idx][0]}\n{result['error']}")
+
+            if len(results) < len(pending):
+                # Blender died on the first unfinished job, skip it and go on with the rest
+                crashed = pending[len(results)]
+                logger.warning(f"Blender exited with code {command_run.returncode} while rendering {jobs[crashed][0]}")
+                outcomes[crashed] = False
+    return outcomes
+
+
+def run_blender_batch(blender_command:str, blender_file:str, render_script:str, jobs:list, render_tier:dict=None) -> list:
+    '''
+    Render many scripts against the same .blend. Cached renders are copied, the rest are rendered
+    by the active worker pool if there is one, otherwise all in a single Blender process that reloads
+    the scene between scripts.
+
+    Inputs:
+        blender_command: path to the blender executable
+        blender_file: file path to the .blend base file
+        render_script: file path to the render script of blender scene
+        jobs: list of (script_path, render_dir)
+        render_tier[optional]: render setting overrides, see run_blender
+    Outputs:
+        list of booleans, False where the script raised or crashed Blender
+    '''
+    outcomes = [None] * len(jobs)
+
+    cache = get_active_cache()
+    cache_keys = [None] * len(jobs)
+    befores = [None] * len(jobs)
+    if cache is not None:
+        for idx, (script_path, render_dir) in enumerate(jobs):
+            cache_keys[idx] = cache.key(blender_file, render_script, script_path, extra=render_tier_cache_tag(render_tier))
+            if cache.fetch(cache_keys[idx], render_dir):
+                outcomes[idx] = True
+            else:
+                befores[idx] = image_stats(render_dir)
+
+    pending = [idx for idx, outcome in enumerate(outcomes) if outcome is None]
+    if not pending:
+        return outcomes
+
+    pool = _active_pool
+    with tiered_scripts([jobs[idx][0] for idx in pending], render_tier) as script_paths:
+        pending_jobs = [(script_path, jobs[idx][1]) for script_path, idx in zip(script_paths, pending)]
+        if pool is not None and pool.blender_command == blender_command:
+            def render_one(job):
+                try:
+                    return pool.render(blender_file, render_script, job[0], job[1])
+                except subprocess.CalledProcessError:
+                    return False
+            with ThreadPoolExecutor(max_workers=pool.num_workers) as executor:
+                pending_outcomes = list(executor.map(render_one, pending_jobs))
+        else:
+            pending_outcomes = _run_batch_process(blender_command, blender_file, render_script, pending_jobs)
+
+    for idx, outcome in zip(pending, pending_outcomes):
+        outcomes[idx] = outcome
+        if outcome and cache is not None:
+            cache.store(cache_keys[idx], jobs[idx][1], before=befores[idx])
+    return outcomes
@@ -0,0 +1,93 @@
+"""
+CLIP scoring with the model loaded once per process.
+
+Images (and texts) are embedded in batched forward passes and L2-normalized, so that the cosine
+similarities of many pairs come out of a single matrix product of the embeddings.
+Image embeddings can be kept in an EmbeddingStore, so that only never seen images are embedded.
+"""
+
+import os
+import threading
+import torch
+from transformers import CLIPProcessor, CLIPModel
+
+from .embedding_store import EmbeddingStore, image_hash
+
+
+class CLIPScorer(object):
+    def __init__(self, model_name:str="openai/clip-vit-base-patch32", device:str=None, batch_size:int=32):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model_name = model_name
+        self.device = device
+        self.batch_size = batch_size
+        self.model = CLIPModel.from_pretrained(model_name).to(device).eval()
+        self.processor = CLIPProcessor.from_pretrained(model_name)
+
+    def open_store(self, store_dir:str) -> EmbeddingStore:
+        '''
+        The embedding store of this model under store_dir.
+        '''
+        return EmbeddingStore(os.path.join(store_dir, self.model_name.replace("/", "--")), dim=self.model.config.projection_dim)
+
+    def embed_images(self, images:list, store:EmbeddingStore=None) -> torch.Tensor:
+        '''
+        Inputs:
+            images: list of PIL images
+            store[optional]: embedding store (see open_store) to look embeddings up in and add new ones to
+        Outputs:
+            (len(images), dim) tensor of L2-normalized image embeddings, on the cpu
+        '''
+        if store is not None:
+            keys = [image_hash(image) for image in images]
+            embeddings, found = store.lookup(keys)
+            missing = [idx for idx in range(len(images)) if not found[idx]]
+            if missing:
+                new_embeddings = self.embed_images([images[idx] for idx in missing]).numpy()
+                store.append([keys[idx] for idx in missing], new_embeddings)
+                embeddings[missing] = new_embeddings.astype(store.dtype)    # same precision as later lookups
+            return torch.from_numpy(embeddings)
+
+        embeddings = []
+        for start in range(0, len(images), self.batch_size):
+            batch = [image.convert("RGB") for image in images[start:start + self.batch_size]]
+            inputs = self.processor(images=batch, return_tensors="pt").to(self.device)
+            with torch.no_grad():
+                embeddings.append(self.model.get_image_features(**inputs).float().cpu())
+        if not embeddings:
+            return torch.empty(0, self.model.config.projection_dim)
+        return torch.nn.functional.normalize(torch.cat(embeddings), dim=-1)
+
+    def embed_texts(self, texts:list) -> torch.Tensor:
+        '''
+        Same as embed_images, for a list of strings.
+        '''
+        embeddings = []
+        for start in range(0, len(texts), self.batch_size):
+            inputs = self.processor(text=texts[start:start + self.batch_size], return_tensors="pt", padding=True).to(self.device)
+            with torch.no_grad():
+                embeddings.append(self.model.get_text_features(**inputs).float().cpu())
+        if not embeddings:
+            return torch.empty(0, self.model.config.projection_dim)
+        return torch.nn.functional.normalize(torch.cat(embeddings), dim=-1)
+
+    @staticmethod
+    def similarity(embeddings1:torch.Tensor, embeddings2:torch.Tensor) -> torch.Tensor:
+        '''
+        (N, M) matrix of cosine similarities between N and M normalized embeddings.
+        '''
+        return embeddings1 @ embeddings2.T
+
+
+_scorers = {}
+_scorers_lock = threading.Lock()
+
+
+def get_clip_scorer(model_name:str="openai/clip-vit-base-patch32") -> CLIPScorer:
+    '''
+    The process-wide CLIPScorer of model_name, loaded on first use.
+    '''
+    with _scorers_lock:
+        if model_name not in _scorers:
+            _scorers[model_name] = CLIPScorer(model_name)
+        return _scorers[model_name]
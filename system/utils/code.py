@@ -2,7 +2,9 @@ import os
 import numpy as np
 import subprocess
 import re
+import ast
 import copy
+import hashlib
 from tasksolver.exceptions import CodeExecutionException, ToolCallException
 from pathlib import Path
 
@@ -206,6 +208,45 @@ def tally_total_changes(changes_list):
 
 
 
+class _RoundNumbers(ast.NodeTransformer):
+    def __init__(self, significant_digits:int):
+        self.significant_digits = significant_digits
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, float):
+            value = float(f"{node.value:.{self.significant_digits}g}") + 0.0
+            return ast.copy_location(ast.Constant(value=value), node)
+        return node
+
+
+def normalize_code(code_str:str, significant_digits:int=6) -> str:
+    """
+    Args:
+        code_str: python code
+        significant_digits: number of significant digits float literals are rounded to, so that small 
+            parameters (e.g. 0.00012 and 0.00014) stay apart
+    Returns:
+        a canonical form of the code, equal for scripts that differ only by comments, whitespace,
+        formatting or float literals equal up to significant_digits (e.g. 0.5 and 0.50). Code that 
+        doesn't parse is returned with comments and blank lines dropped.
+    """
+    try:
+        tree = ast.parse(code_str)
+    except SyntaxError:
+        lines = [line.split("#", 1)[0].rstrip() for line in code_str.replace("\r\n", "\n").split("\n")]
+        return "\n".join(line for line in lines if line.strip())
+    tree = _RoundNumbers(significant_digits).visit(tree)
+    return ast.dump(tree, annotate_fields=False)
+
+
+def code_fingerprint(code_str:str, significant_digits:int=6) -> str:
+    """
+    Returns:
+        hash of normalize_code(code_str), equal for scripts that do the same thing up to formatting.
+    """
+    return hashlib.sha256(normalize_code(code_str, significant_digits=significant_digits).encode()).hexdigest()
+
+
 if __name__ == "__main__":
 
     code = """
@@ -238,18 +279,3 @@ c = a + b
 
     # new_code = replace_matches_with_list(code, pattern, replacements)
     # print(new_code)
-
-
-
-
-    
-
-
-
-    
-
-
-    
-
-
-
@@ -0,0 +1,90 @@
+"""
+Elimination of duplicate proposals within a tree level.
+
+Parameter-tuning prompts often make several branches propose the same script, up to comments,
+formatting or float noise, and the same as the code they started from. Proposals are fingerprinted
+(see utils/code.py code_fingerprint) right after they are generated: the first of a fingerprint is
+rendered, the others wait for it and share its code and render, and only one of them enters the
+tournament.
+"""
+
+import threading
+
+from .code import code_fingerprint
+
+
+class _Entry(object):
+    def __init__(self):
+        self.result = None      # (code_path, render_path), None if the proposal failed to render
+        self.done = threading.Event()
+
+
+class ProposalDedup(object):
+    def __init__(self, incumbent:tuple=None):
+        '''
+        Inputs:
+            incumbent[optional]: (code_path, render_path) of the best so far, proposals repeating it are not rendered
+        '''
+        self._entries = {}      # fingerprint -> _Entry
+        self._lock = threading.Lock()
+        self._seen_code_paths = set()      # candidates passed on to the tournament
+        self.proposals = 0
+        self.duplicates = 0
+        self.judge_calls_saved = 0
+        if incumbent is not None:
+            with open(incumbent[0], "r") as f:
+                entry = self._entries.setdefault(code_fingerprint(f.read()), _Entry())
+            entry.result = (incumbent[0], incumbent[1])
+            entry.done.set()
+            self._seen_code_paths.add(incumbent[0])
+
+    def claim(self, code_str:str):
+        '''
+        Registers a generated proposal.
+
+        Outputs:
+            original: True if it is the first proposal with this fingerprint, then the caller renders it
+                and calls resolve() with the entry, whatever the outcome
+            entry: to resolve() if original, to wait() on otherwise
+        '''
+        fingerprint = code_fingerprint(code_str)
+        with self._lock:
+            self.proposals += 1
+            if fingerprint in self._entries:
+                self.duplicates += 1
+                return False, self._entries[fingerprint]
+            entry = self._entries[fingerprint] = _Entry()
+            return True, entry
+
+    @staticmethod
+    def resolve(entry:_Entry, code_path:str=None, render_path:str=None):
+        entry.result = (code_path, render_path) if code_path is not None else None
+        entry.done.set()
+
+    @staticmethod
+    def wait(entry:_Entry):
+        '''
+        (code_path, render_path) of the original proposal once rendered, None if it failed.
+        '''
+        entry.done.wait()
+        return entry.result
+
+    def first_time(self, candidate:tuple) -> bool:
+        '''
+        Whether candidate should enter the tournament: False if it shares the code of an earlier one or of the incumbent.
+        '''
+        with self._lock:
+            if candidate[0] in self._seen_code_paths:
+                self.judge_calls_saved += 1
+                return False
+            self._seen_code_paths.add(candidate[0])
+            return True
+
+    def unique(self, candidates:list) -> list:
+        return [candidate for candidate in candidates if self.first_time(candidate)]
+
+    def stats(self) -> dict:
+        # Every duplicate reuses a render, and every candidate left out of the tournament saves a knockout match
+        with self._lock:
+            return {"proposals": self.proposals, "duplicates": self.duplicates,
+                    "renders_saved": self.duplicates, "judge_calls_saved": self.judge_calls_saved}
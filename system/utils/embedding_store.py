@@ -0,0 +1,169 @@
+"""
+Persistent store of embeddings keyed by image content hash.
+
+Embeddings live in a memory-mapped float16 matrix, one row per image, and a json index maps
+the content hash of an image to its row. Scoring code looks embeddings up by hash and only
+embeds (and appends) the images it has never seen, so re-scoring the same renders is nearly free.
+
+    <store_dir>/embeddings.bin     float16 matrix, rows x dim, row-major
+    <store_dir>/index.json         {"dim": ..., "rows": ..., "index": {hash: row}}
+
+Appends and compaction take an exclusive file lock and lookups a shared one, so several evaluation
+processes can share a store: a lookup never sees a compacted matrix with the rows of the old index.
+"""
+
+import os
+import json
+import hashlib
+import threading
+import contextlib
+import numpy as np
+from PIL import Image
+
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+
+
+def image_hash(image:Image.Image) -> str:
+    '''
+    Hash of the pixels of image, independent of the file it was read from.
+    '''
+    sha = hashlib.sha256()
+    sha.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    sha.update(image.tobytes())
+    return sha.hexdigest()
+
+
+class EmbeddingStore(object):
+    def __init__(self, store_dir:str, dim:int, dtype=np.float16):
+        self.store_dir = os.path.abspath(store_dir)
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.matrix_path = os.path.join(self.store_dir, "embeddings.bin")
+        self.index_path = os.path.join(self.store_dir, "index.json")
+        self.lock_path = os.path.join(self.store_dir, ".lock")
+
+        self._lock = threading.Lock()
+        self._index_mtime = None
+        self._matrix = None
+        self.index = {}
+        self.rows = 0
+        self._load_index()
+
+    @property
+    def row_bytes(self):
+        return self.dim * self.dtype.itemsize
+
+    def _load_index(self):
+        # (Re)read the index if another process has changed it since we last did
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._index_mtime:
+            return
+        with open(self.index_path, "r") as f:
+            data = json.load(f)
+        if data["dim"] != self.dim:
+            raise ValueError(f"The embedding store at {self.store_dir} holds {data['dim']}-d embeddings, not {self.dim}-d.")
+        self.index = data["index"]
+        self.rows = data["rows"]
+        self._index_mtime = mtime
+        self._matrix = None
+
+    def _save_index(self):
+        tmp_path = f"{self.index_path}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, "w") as f:
+            json.dump({"dim": self.dim, "rows": self.rows, "index": self.index}, f)
+        os.replace(tmp_path, self.index_path)
+        self._index_mtime = os.stat(self.index_path).st_mtime_ns
+        self._matrix = None
+
+    @contextlib.contextmanager
+    def _file_lock(self, shared:bool=False):
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _get_matrix(self):
+        if self._matrix is None and self.rows > 0:
+            self._matrix = np.memmap(self.matrix_path, dtype=self.dtype, mode="r", shape=(self.rows, self.dim))
+        return self._matrix
+
+    def __len__(self):
+        return self.rows
+
+    def __contains__(self, key:str):
+        return key in self.index
+
+    def lookup(self, keys:list):
+        '''
+        Outputs:
+            embeddings: (len(keys), dim) float32 array, zero rows for keys not in the store
+            found: boolean mask of the keys that are in the store
+        '''
+        with self._lock, self._file_lock(shared=True):
+            self._load_index()
+            rows = [self.index.get(key) for key in keys]
+            found = np.array([row is not None for row in rows], dtype=bool)
+            embeddings = np.zeros((len(keys), self.dim), dtype=np.float32)
+            if found.any():
+                embeddings[found] = self._get_matrix()[[row for row in rows if row is not None]]
+        return embeddings, found
+
+    def append(self, keys:list, embeddings:np.ndarray):
+        '''
+        Add the embeddings of keys, in one write. Keys already in the store are skipped.
+        '''
+        embeddings = np.asarray(embeddings, dtype=self.dtype).reshape(len(keys), self.dim)
+        with self._lock, self._file_lock():
+            self._load_index()
+            new_rows = {}
+            for key, embedding in zip(keys, embeddings):
+                if key not in self.index and key not in new_rows:
+                    new_rows[key] = embedding
+            if not new_rows:
+                return
+
+            # Rows past self.rows (left by an interrupted append) are overwritten
+            mode = "r+b" if os.path.exists(self.matrix_path) else "w+b"
+            with open(self.matrix_path, mode) as f:
+                f.seek(self.rows * self.row_bytes)
+                f.write(np.stack(list(new_rows.values())).tobytes())
+            for row, key in enumerate(new_rows, start=self.rows):
+                self.index[key] = row
+            self.rows += len(new_rows)
+            self._save_index()
+
+    def compact(self, keep_keys=None):
+        '''
+        Rewrite the matrix with only the embeddings of keep_keys (all indexed ones by default),
+        dropping everything else, including rows left by interrupted appends.
+        '''
+        with self._lock, self._file_lock():
+            self._load_index()
+            keys = list(self.index) if keep_keys is None else [key for key in dict.fromkeys(keep_keys) if key in self.index]
+            keys.sort(key=lambda key: self.index[key])
+            matrix = self._get_matrix()
+
+            tmp_path = f"{self.matrix_path}.{os.getpid()}.compact"
+            with open(tmp_path, "wb") as f:
+                for start in range(0, len(keys), 4096):
+                    chunk = keys[start:start + 4096]
+                    f.write(np.ascontiguousarray(matrix[[self.index[key] for key in chunk]]).tobytes())
+            self._matrix = None
+            del matrix
+            os.replace(tmp_path, self.matrix_path)
+
+            self.index = {key: row for row, key in enumerate(keys)}
+            self.rows = len(keys)
+            self._save_index()
@@ -0,0 +1,89 @@
+"""
+Append-only journal of json records, one per line.
+
+Each record is written with a single append and fsync'ed, so after a crash the journal holds every
+record appended before it, plus at most one truncated last line, which read() skips. Another process
+can follow() the journal while it is being written.
+"""
+
+import os
+import json
+import time
+import threading
+
+
+class Journal(object):
+    def __init__(self, path:str):
+        self.path = os.path.abspath(path)
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    def read(self) -> list:
+        records = []
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:    # cut short by a crash
+                    continue
+        return records
+
+    def follow(self, until=None, poll_interval:float=1.0, timeout:float=None):
+        '''
+        Yields the records of the journal from the first one, waiting for new ones as they are appended.
+
+        Inputs:
+            until[optional]: function of a record, following stops after the first record it is true for
+            poll_interval[optional]: seconds between two checks for new records
+            timeout[optional]: stop when no record was appended for that many seconds, never by default
+        '''
+        offset = 0
+        pending = b""
+        last_record_time = time.monotonic()
+        while True:
+            data = b""
+            if os.path.exists(self.path):
+                with open(self.path, "rb") as f:
+                    f.seek(offset)
+                    data = f.read()
+                offset += len(data)
+
+            # Only complete lines are parsed, the last one may still be written
+            *lines, pending = (pending + data).split(b"\n")
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:    # cut short by a crash
+                    continue
+                last_record_time = time.monotonic()
+                yield record
+                if until is not None and until(record):
+                    return
+
+            if timeout is not None and time.monotonic() - last_record_time > timeout:
+                return
+            time.sleep(poll_interval)
+
+    def append(self, record:dict):
+        line = (json.dumps(record) + "\n").encode()
+        with self._lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                # Start on a fresh line if the last append was cut short
+                if os.fstat(fd).st_size > 0:
+                    with open(self.path, "rb") as f:
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b"\n":
+                            line = b"\n" + line
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
@@ -0,0 +1,95 @@
+"""
+Journal of the inference metadata (paths of the proposal edit scripts, winner information, etc.).
+
+inference.py appends one record per finished instance instead of rewriting the whole metadata json
+every time, so saving stays constant-time and a crash loses at most the instance being written:
+    {'event': 'header', 'metadata': {...}, 'instances': {task: [task_instance, ...]}}
+    {'event': 'instance', 'task': ..., 'task_instance': ..., 'results': {...}}
+    {'event': 'end'}
+compact() turns the journal into the metadata json read by evaluation.py, and evaluation.py can also
+follow the journal while inference is running.
+"""
+
+import os
+import json
+
+from .journal import Journal
+
+JOURNAL_EXTENSION = '.jsonl'
+
+
+class MetadataJournal(Journal):
+    def write_header(self, metadata:dict, instances:dict):
+        '''
+        Inputs:
+            metadata: the run information (output_dir_name, generator_type, etc.)
+            instances: task -> task instance ids to run, in order
+        '''
+        self.append({'event': 'header', 'metadata': metadata, 'instances': instances})
+
+    def write_instance(self, task:str, task_instance:str, results:dict):
+        self.append({'event': 'instance', 'task': task, 'task_instance': task_instance, 'results': results})
+
+    def write_end(self):
+        self.append({'event': 'end'})
+
+    def wait_header(self, poll_interval:float=1.0, timeout:float=None):
+        '''
+        The header record, once inference has written it. None on timeout.
+        '''
+        for record in self.follow(until=lambda record: record['event'] == 'header', poll_interval=poll_interval, timeout=timeout):
+            if record['event'] == 'header':
+                return record
+        return None
+
+    def follow_instances(self, poll_interval:float=1.0, timeout:float=None):
+        '''
+        Yields (task, task_instance, results) of the instances as inference finishes them, until the end
+        of the run (or `timeout` seconds without progress, see Journal.follow).
+        '''
+        for record in self.follow(until=lambda record: record['event'] == 'end', poll_interval=poll_interval, timeout=timeout):
+            if record['event'] == 'instance':
+                yield record['task'], record['task_instance'], record['results']
+
+
+def compact_records(records:list) -> dict:
+    '''
+    The metadata json of the journal records: the header metadata, then task -> task instance -> results,
+    in the order of the header. Instances that are not finished have empty results.
+    '''
+    generation_results = {}
+    for record in records:
+        if record['event'] == 'header':
+            generation_results.update(record['metadata'])
+            for task, task_instances in record['instances'].items():
+                generation_results.setdefault(task, {})
+                for task_instance in task_instances:
+                    generation_results[task].setdefault(task_instance, {})
+        elif record['event'] == 'instance':
+            generation_results.setdefault(record['task'], {})[record['task_instance']] = record['results']
+    return generation_results
+
+
+def compact(journal_path:str, json_path:str=None) -> dict:
+    '''
+    Writes the metadata json of the journal at journal_path to json_path (the journal path with a .json
+    extension by default). The json is written to a temporary file first, so it is never left half-written.
+    '''
+    if json_path is None:
+        json_path = os.path.splitext(journal_path)[0] + '.json'
+    generation_results = compact_records(MetadataJournal(journal_path).read())
+    tmp_path = f'{json_path}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(generation_results, file, indent=4)
+    os.replace(tmp_path, json_path)
+    return generation_results
+
+
+def load_inference_metadata(path:str) -> dict:
+    '''
+    The inference metadata saved at path, either a metadata json or a metadata journal.
+    '''
+    if path.endswith(JOURNAL_EXTENSION):
+        return compact_records(MetadataJournal(path).read())
+    with open(path, 'r') as file:
+        return json.load(file)
@@ -0,0 +1,82 @@
+"""
+Photometric loss (the MSE of photometric_loss() in utils.py) over many renders at once.
+
+Renders are decoded once into uint8 stacks, (N, H, W, 3), and the squared errors are accumulated
+exactly in integers, chunk by chunk, so memory stays bounded for instances with many proposals.
+"""
+
+import numpy as np
+
+
+def stack_images(images:list, size:tuple=None) -> np.ndarray:
+    '''
+    Stack the RGB channels of images into a (N, H, W, 3) uint8 array.
+
+    Inputs:
+        images: list of PIL images
+        size[optional]: (width, height), images of another size are resized to it, as photometric_loss() does
+    '''
+    if size is None and images:
+        size = images[0].size
+    arrays = []
+    for image in images:
+        if image.size != size:
+            image = image.resize(size)
+        arrays.append(np.asarray(image)[:, :, :3])
+    if not arrays:
+        return np.empty((0, 0, 0, 3), dtype=np.uint8)
+    return np.stack(arrays).astype(np.uint8, copy=False)
+
+
+def stack_mse(stack:np.ndarray, goal_stack:np.ndarray, goal_rows=None, chunk_size:int=64) -> np.ndarray:
+    '''
+    Per-row MSE between stack and goal_stack, on colors normalized to [0, 1].
+
+    Inputs:
+        stack: (N, H, W, 3) uint8 array
+        goal_stack: (M, H, W, 3) uint8 array
+        goal_rows[optional]: for each row of stack, the row of goal_stack to compare it to. Defaults to
+            range(N) (M == N), or to 0 when goal_stack holds a single image.
+        chunk_size[optional]: number of rows processed at once
+    Outputs:
+        (N,) float64 array
+    '''
+    if goal_rows is None:
+        goal_rows = np.zeros(len(stack), dtype=int) if len(goal_stack) == 1 else np.arange(len(stack))
+    goal_rows = np.asarray(goal_rows)
+    losses = np.empty(len(stack), dtype=np.float64)
+    values_per_row = np.prod(stack.shape[1:])
+    for start in range(0, len(stack), chunk_size):
+        diff = stack[start:start + chunk_size].astype(np.int32) - goal_stack[goal_rows[start:start + chunk_size]].astype(np.int32)
+        squared_error = np.einsum("nhwc,nhwc->n", diff, diff, dtype=np.int64)
+        losses[start:start + chunk_size] = squared_error / (values_per_row * 255.0**2)
+    return losses
+
+
+def photometric_losses(images:list, goal_images:list, goal_rows=None, chunk_size:int=64) -> np.ndarray:
+    '''
+    photometric_loss(images[i], goal_images[goal_rows[i]]) for every i, with each goal image decoded once.
+
+    Inputs:
+        images: list of PIL images
+        goal_images: list of PIL images
+        goal_rows[optional]: see stack_mse
+        chunk_size[optional]: see stack_mse
+    Outputs:
+        (len(images),) float64 array
+    '''
+    if goal_rows is None:
+        goal_rows = [0] * len(images) if len(goal_images) == 1 else list(range(len(images)))
+    goal_rows = np.asarray(goal_rows, dtype=int)
+
+    # Renders of one render script share their size, but group by size in case they don't
+    losses = np.empty(len(images), dtype=np.float64)
+    rows_by_size = {}
+    for row, image in enumerate(images):
+        rows_by_size.setdefault(image.size, []).append(row)
+    for size, rows in rows_by_size.items():
+        used_goal_rows = np.unique(goal_rows[rows])
+        goal_stack = stack_images([goal_images[goal_row] for goal_row in used_goal_rows], size=size)
+        losses[rows] = stack_mse(stack_images([images[row] for row in rows], size=size), goal_stack,
+                                 goal_rows=np.searchsorted(used_goal_rows, goal_rows[rows]), chunk_size=chunk_size)
+    return losses
@@ -0,0 +1,135 @@
+"""
+Local pre-selection of the candidates of a tree level, before they are judged by the VLM.
+
+Renders that are (almost) fully black, or that did not change from the render of the best so far,
+are discarded. When there is a target image, the other proposals are scored by photometric loss or
+CLIP distance to it, and only the top_k of them go to the judge, with the best so far.
+
+Configured by run_config["prefilter"], absent to judge every candidate:
+    top_k: number of proposals judged, all by default
+    metric: "photometric" (default) or "clip"
+    black_level: renders with no channel value above it are blank (default 5, of 255)
+    unchanged_threshold: renders with a photometric loss to the best so far at most this are unchanged (default 1e-5)
+    embedding_store_dir: EmbeddingStore of the CLIP embeddings, shared with evaluation.py. Without it,
+        embeddings are only cached for the run.
+"""
+
+import threading
+import numpy as np
+from PIL import Image
+
+from .photometric import photometric_losses
+from .embedding_store import image_hash
+
+METRICS = ("photometric", "clip")
+
+
+def is_blank(image:Image.Image, black_level:int=5) -> bool:
+    '''
+    Whether no pixel of image has a color channel above black_level.
+    '''
+    return int(np.asarray(image.convert("RGB")).max()) <= black_level
+
+
+class CandidatePrefilter(object):
+    def __init__(self, target_image:Image.Image=None, top_k:int=None, metric:str="photometric", black_level:int=5,
+                 unchanged_threshold:float=1e-5, embedding_store_dir:str=None):
+        if metric not in METRICS:
+            raise ValueError(f"Unknown prefilter metric {metric}, expected one of {METRICS}.")
+        self.target_image = target_image.convert("RGB") if target_image is not None else None
+        self.top_k = top_k
+        self.metric = metric
+        self.black_level = black_level
+        self.unchanged_threshold = unchanged_threshold
+        self.embedding_store_dir = embedding_store_dir
+        self._store = None
+        self._embeddings = {}      # image hash -> CLIP embedding, when there is no embedding store
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _render(candidate) -> Image.Image:
+        return Image.open(candidate[1]).convert("RGB")
+
+    def discard_reason(self, candidate, parent_render_path:str=None):
+        '''
+        "blank", "unchanged" (same render as parent_render_path), or None to keep candidate.
+        '''
+        render = self._render(candidate)
+        if is_blank(render, self.black_level):
+            return "blank"
+        if parent_render_path is not None and candidate[1] != parent_render_path:
+            parent_render = Image.open(parent_render_path).convert("RGB")
+            if photometric_losses([render], [parent_render])[0] <= self.unchanged_threshold:
+                return "unchanged"
+        return None
+
+    def _clip_embeddings(self, images:list):
+        from .clip_scorer import get_clip_scorer
+        scorer = get_clip_scorer()
+        with self._lock:
+            if self.embedding_store_dir is not None:
+                if self._store is None:
+                    self._store = scorer.open_store(self.embedding_store_dir)
+                return scorer.embed_images(images, store=self._store).float()
+            keys = [image_hash(image) for image in images]
+            missing = [idx for idx, key in enumerate(keys) if key not in self._embeddings]
+            if missing:
+                for idx, embedding in zip(missing, scorer.embed_images([images[idx] for idx in missing])):
+                    self._embeddings[keys[idx]] = embedding
+            return [self._embeddings[key] for key in keys]
+
+    def distances(self, candidates:list) -> list:
+        '''
+        Distance of the render of each candidate to the target image, lower is better.
+        '''
+        renders = [self._render(candidate) for candidate in candidates]
+        if self.metric == "photometric":
+            return [float(loss) for loss in photometric_losses(renders, [self.target_image])]
+        embeddings = self._clip_embeddings(renders + [self.target_image])
+        target_embedding = embeddings[-1]
+        return [1.0 - float((embedding * target_embedding).sum()) for embedding in embeddings[:-1]]
+
+    def select(self, candidates:list, incumbent:tuple=None):
+        '''
+        Inputs:
+            candidates: (code_path, render_path, ...) tuples, may include incumbent
+            incumbent[optional]: the best so far, always kept, renders equal to its render are unchanged
+        Outputs:
+            kept: the candidates to judge, in their order
+            record: the decisions, for the thought process
+        '''
+        parent_render_path = incumbent[1] if incumbent is not None else None
+        record = {"phase": "prefilter", "metric": self.metric, "discarded": {}, "distances": {}}
+        proposals = []
+        for candidate in candidates:
+            if candidate is incumbent:
+                continue
+            reason = self.discard_reason(candidate, parent_render_path=parent_render_path)
+            if reason is not None:
+                record["discarded"][candidate[1]] = reason
+            else:
+                proposals.append(candidate)
+
+        if self.target_image is not None and self.top_k is not None and len(proposals) > self.top_k:
+            distances = self.distances(proposals)
+            record["distances"] = {candidate[1]: distance for candidate, distance in zip(proposals, distances)}
+            order = sorted(range(len(proposals)), key=lambda idx: distances[idx])
+            for idx in order[self.top_k:]:
+                record["discarded"][proposals[idx][1]] = "not in top_k"
+            top = set(order[:self.top_k])
+            proposals = [candidate for idx, candidate in enumerate(proposals) if idx in top]
+
+        kept = [candidate for candidate in candidates if candidate is incumbent or candidate in proposals]
+        record["kept"] = [candidate[1] for candidate in kept]
+        record["judge_calls_saved"] = len(candidates) - len(kept)
+        return kept, record
+
+
+def get_prefilter(run_config:dict, target_image:Image.Image=None):
+    '''
+    The CandidatePrefilter configured by run_config["prefilter"], or None.
+    '''
+    options = run_config.get("prefilter")
+    if not options:
+        return None
+    return CandidatePrefilter(target_image=target_image, **options)
@@ -0,0 +1,231 @@
+"""
+Disk-backed, content-addressed cache of Blender renders.
+
+A render is keyed by the hash of the .blend bytes, the render script and the normalized edit script,
+so proposals that repeat an earlier script (unchanged starting code, regenerated edits, start.py and
+goal.py at evaluation time) are copied from the cache instead of rendered again.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from loguru import logger
+
+IMAGE_EXTENSIONS = ('png', 'jpg', 'jpeg', 'webp')
+
+
+def normalize_script(code_str:str) -> str:
+    '''
+    Normalize line endings and trailing whitespace, which never change what a bpy script does.
+    '''
+    lines = code_str.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip("\n")
+
+
+def image_stats(render_dir:str) -> dict:
+    '''
+    image name -> (size, mtime) of the images in render_dir, to tell the images a render writes from older ones.
+    '''
+    if not os.path.isdir(render_dir):
+        return {}
+    stats = {}
+    for f in os.listdir(render_dir):
+        if f.endswith(IMAGE_EXTENSIONS):
+            stat = os.stat(os.path.join(render_dir, f))
+            stats[f] = (stat.st_size, stat.st_mtime_ns)
+    return stats
+
+
+def hash_file(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class RenderCache(object):
+    """
+    Each entry is a directory <cache_dir>/<key[:2]>/<key>/ holding the rendered images.
+    Entries are evicted least-recently-used first (by directory mtime, which is refreshed on every hit)
+    once the cache grows over max_bytes.
+    """
+    def __init__(self, cache_dir:str, max_bytes:int=20 * 1024**3):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._file_hashes = {}  # (path, size, mtime) -> sha256, so a .blend is only read once
+        self._entry_sizes = {entry: self._dir_size(entry) for entry in self._entries()}
+
+    def _entries(self):
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                if not key.startswith("."):
+                    yield os.path.join(prefix_dir, key)
+
+    @staticmethod
+    def _dir_size(directory):
+        return sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+
+    def _cached_file_hash(self, path):
+        stat = os.stat(path)
+        file_id = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if file_id not in self._file_hashes:
+            self._file_hashes[file_id] = hash_file(path)
+        return self._file_hashes[file_id]
+
+    def key(self, blender_file:str, render_script:str, script_path:str, extra:str="") -> str:
+        '''
+        Inputs:
+            blender_file: file path to the .blend base file
+            render_script: file path to the render script of blender scene
+            script_path: file path to the edit script
+            extra[optional]: anything else that changes the render (e.g. render settings)
+        '''
+        with open(script_path, "r") as f:
+            script = normalize_script(f.read())
+        sha = hashlib.sha256()
+        sha.update(self._cached_file_hash(blender_file).encode())
+        sha.update(self._cached_file_hash(render_script).encode())
+        sha.update(hashlib.sha256(script.encode()).hexdigest().encode())
+        sha.update(extra.encode())
+        return sha.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def fetch(self, key:str, render_dir:str) -> bool:
+        '''
+        Copy the cached images of `key` into render_dir. Returns False on a miss.
+        The images are copied rather than hard-linked: a later render into render_dir writes its
+        images in place, which would overwrite the cache entry through a link.
+        '''
+        entry = self._entry_dir(key)
+        try:
+            images = os.listdir(entry)
+            os.utime(entry)     # mark as recently used
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+
+        os.makedirs(render_dir, exist_ok=True)
+        for image in images:
+            target = os.path.join(render_dir, image)
+            if os.path.lexists(target):
+                os.remove(target)
+            shutil.copy2(os.path.join(entry, image), target)
+
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def store(self, key:str, render_dir:str, before:dict=None):
+        '''
+        Copy the images in render_dir into the cache under `key`.
+
+        Inputs:
+            before[optional]: image_stats() of render_dir before the render, only the images the render
+                wrote are stored, so that older images of render_dir never enter the entry of `key`
+        '''
+        images = [f for f, stat in image_stats(render_dir).items() if before is None or before.get(f) != stat]
+        if not images:
+            return
+        entry = self._entry_dir(key)
+        if os.path.isdir(entry):
+            return
+
+        # Write into a temporary dir first, so a concurrent fetch never sees a partial entry
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp_entry = os.path.join(os.path.dirname(entry), f".{key}.{os.getpid()}.{threading.get_ident()}")
+        os.makedirs(tmp_entry, exist_ok=True)
+        for image in images:
+            shutil.copy2(os.path.join(render_dir, image), os.path.join(tmp_entry, image))
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:     # someone else stored the same render meanwhile
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            return
+
+        with self._lock:
+            self.stores += 1
+            self._entry_sizes[entry] = self._dir_size(entry)
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            total = sum(self._entry_sizes.values())
+            if total <= self.max_bytes:
+                return
+            def last_used(entry):
+                try:
+                    return os.path.getmtime(entry)
+                except FileNotFoundError:
+                    return 0
+            for entry in sorted(self._entry_sizes, key=last_used):
+                if total <= self.max_bytes:
+                    break
+                total -= self._entry_sizes.pop(entry)
+                shutil.rmtree(entry, ignore_errors=True)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "stores": self.stores,
+                    "evictions": self.evictions,
+                    "entries": len(self._entry_sizes),
+                    "bytes": sum(self._entry_sizes.values())}
+
+
+_active_cache = None
+_active_cache_lock = threading.Lock()
+
+
+def get_active_cache():
+    return _active_cache
+
+
+def ensure_render_cache(cache_dir, max_gb:float=20):
+    '''
+    Start the process-wide render cache if cache_dir is given and no cache is active yet.
+    '''
+    global _active_cache
+    if not cache_dir:
+        return _active_cache
+    with _active_cache_lock:
+        if _active_cache is None:
+            logger.info(f"Using the render cache at {cache_dir}.")
+            _active_cache = RenderCache(cache_dir, max_bytes=int(max_gb * 1024**3))
+    return _active_cache
+
+
+def save_cache_stats(path, since:dict=None):
+    '''
+    Dump the hit/miss counters of the active cache, optionally relative to an earlier stats() snapshot.
+    '''
+    if _active_cache is None:
+        return None
+    stats = _active_cache.stats()
+    if since is not None:
+        for counter in ("hits", "misses", "stores", "evictions"):
+            stats[counter] -= since.get(counter, 0)
+    stats["time"] = time.strftime("%m-%d-%H-%M-%S")
+    with open(path, "w") as f:
+        json.dump(stats, f, indent=4)
+    logger.info(f"Render cache: {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions.")
+    return stats
@@ -0,0 +1,121 @@
+"""
+Search controllers of refinement(): the breadth of every tree level, and whether to stop before `depth` levels.
+
+Configured by run_config["search_controller"], absent for the fixed breadth x depth search:
+    type: "fixed" or "adaptive"
+    patience: stop after that many levels in a row where the best so far kept winning
+    metric: "photometric" or "clip", distance of the best render to the target render
+    distance_threshold: stop once the distance of the best render is at most this
+    min_breadth, max_breadth: bounds of the breadth, the configured breadth by default (fixed)
+    breadth_growth: the breadth is multiplied by it after a level without a new winner, to explore
+        more around a best that is hard to beat, and divided by it after a new winner (default 2)
+
+Stopping early leaves the levels it skips to harder instances; the skipped iterations are recorded
+with the final winner, so their thought process files read like those of a full run.
+"""
+
+import math
+from PIL import Image
+
+METRICS = ("photometric", "clip")
+
+
+def distance_to_target(render_path:str, target_image:Image.Image, metric:str="photometric") -> float:
+    '''
+    Photometric loss, or 1 - CLIP similarity, between the render at render_path and target_image.
+    '''
+    render = Image.open(render_path).convert("RGB")
+    if metric == "photometric":
+        from .photometric import photometric_losses
+        return float(photometric_losses([render], [target_image.convert("RGB")])[0])
+    if metric == "clip":
+        from .clip_scorer import get_clip_scorer
+        scorer = get_clip_scorer()
+        embeddings = scorer.embed_images([render, target_image.convert("RGB")])
+        return 1.0 - float(scorer.similarity(embeddings[:1], embeddings[1:])[0, 0])
+    raise ValueError(f"Unknown search metric {metric}, expected one of {METRICS}.")
+
+
+class SearchController(object):
+    '''
+    The fixed search: `breadth` proposals at every level, all `depth` levels.
+    '''
+    def __init__(self, breadth:int, depth:int):
+        self.breadth = breadth
+        self.depth = depth
+        self.stop_reason = None
+        self.history = []
+
+    def next_breadth(self, iteration:int) -> int:
+        return self.breadth
+
+    def _update(self, record:dict, render_path:str=None):
+        # Sets the next breadth and self.stop_reason from the outcome of a level
+        pass
+
+    def observe(self, iteration:int, breadth:int, new_winner:bool, render_path:str=None) -> dict:
+        '''
+        Inputs:
+            iteration, breadth: the level and the breadth it ran with
+            new_winner: whether a proposal beat the best so far
+            render_path[optional]: render of the best after the level
+        Outputs:
+            record of the level for the thought process
+        '''
+        record = {"iteration": iteration, "breadth": breadth, "new_winner": new_winner}
+        self.history.append(record)
+        self._update(record, render_path=render_path)
+        record["next_breadth"] = self.breadth
+        record["stop_reason"] = self.stop_reason
+        return record
+
+    def should_stop(self):
+        '''
+        The reason to stop the search, None to go on.
+        '''
+        return self.stop_reason
+
+
+class AdaptiveSearchController(SearchController):
+    def __init__(self, breadth:int, depth:int, patience:int=None, metric:str=None, distance_threshold:float=None,
+                 target_image:Image.Image=None, min_breadth:int=None, max_breadth:int=None, breadth_growth:float=2):
+        super().__init__(breadth, depth)
+        if metric is not None and metric not in METRICS:
+            raise ValueError(f"Unknown search metric {metric}, expected one of {METRICS}.")
+        self.patience = patience
+        self.metric = metric if (metric is not None and target_image is not None) else None
+        self.distance_threshold = distance_threshold
+        self.target_image = target_image
+        self.min_breadth = max(1, min_breadth if min_breadth is not None else breadth)
+        self.max_breadth = max_breadth if max_breadth is not None else breadth
+        self.breadth_growth = breadth_growth
+        self.levels_without_winner = 0
+
+    def _update(self, record:dict, render_path:str=None):
+        if record["new_winner"]:
+            self.levels_without_winner = 0
+            self.breadth = max(self.min_breadth, math.floor(self.breadth / self.breadth_growth))
+        else:
+            self.levels_without_winner += 1
+            self.breadth = min(self.max_breadth, math.ceil(self.breadth * self.breadth_growth))
+
+        if self.metric is not None and render_path is not None:
+            record["distance"] = distance_to_target(render_path, self.target_image, metric=self.metric)
+            if self.distance_threshold is not None and record["distance"] <= self.distance_threshold:
+                self.stop_reason = f"{self.metric} distance to the target {record['distance']:.4g} <= {self.distance_threshold}"
+                return
+        if self.patience is not None and self.levels_without_winner >= self.patience:
+            self.stop_reason = f"no new winner for {self.levels_without_winner} levels"
+
+
+def get_search_controller(run_config:dict, breadth:int, depth:int, target_image:Image.Image=None) -> SearchController:
+    '''
+    The search controller configured by run_config["search_controller"], see the module docstring.
+    '''
+    options = dict(run_config.get("search_controller") or {})
+    controller_type = options.pop("type", "adaptive" if options else "fixed")
+    if controller_type == "fixed":
+        return SearchController(breadth, depth)
+    if controller_type == "adaptive":
+        return AdaptiveSearchController(breadth, depth, target_image=target_image, **options)
+    raise ValueError(f"Unknown search controller {controller_type}, expected fixed or adaptive.")
@@ -0,0 +1,296 @@
+"""
+Tournaments between candidate edits, judged pairwise by the state evaluator.
+
+A candidate is a (code_path, render_path, ...) tuple. Judgements are memoized by the content of the
+two codes and the target, so pairs that meet again (e.g. the best so far, carried over to every tree
+level, against a proposal repeating an earlier edit) are not judged twice within a refinement run.
+Matches run concurrently, and a match starts as soon as both of its candidates are known instead of
+waiting for the whole level of the bracket.
+
+Formats:
+    single_elimination: knockout, len(candidates) - 1 judgements
+    top_k: knockout down to k candidates, then a round robin between them
+    swiss: `rounds` rounds pairing candidates of equal scores, ranked by score
+
+Every format can be given a budget of judge calls. Matches past the budget (and matches whose
+judgement failed) are won by the candidate listed first.
+
+run_stream() takes the candidates from a queue as they are produced, so that the knockouts start
+judging while other candidates are still being generated, up to an optional deadline.
+"""
+
+import math
+import time
+import queue
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from loguru import logger
+
+from .code import code_fingerprint
+
+FORMATS = ("single_elimination", "top_k", "swiss")
+
+
+def code_hash(code_path) -> str:
+    # Scripts equal up to comments, formatting and float noise share their judgements
+    with open(code_path, "r") as f:
+        return code_fingerprint(f.read())
+
+
+def target_key(target_image=None, target_description=None) -> str:
+    '''
+    Key of what the candidates are judged against: the content of the target image and/or the description.
+    '''
+    sha = hashlib.sha256()
+    if target_image is not None:
+        if hasattr(target_image, "tobytes"):
+            sha.update(f"{target_image.mode}:{target_image.size}:".encode())
+            sha.update(target_image.tobytes())
+        else:
+            sha.update(str(target_image).encode())
+    sha.update(f"|{target_description}".encode())
+    return sha.hexdigest()
+
+
+class JudgementMemo(object):
+    def __init__(self):
+        self._verdicts = {}     # (code hash, code hash, target key), hashes sorted -> (winner code hash, record)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(hash_a:str, hash_b:str, target:str):
+        return (min(hash_a, hash_b), max(hash_a, hash_b), target)
+
+    def get(self, hash_a:str, hash_b:str, target:str):
+        '''
+        (winner code hash, record of the judgement) of a pair judged before, or None.
+        '''
+        with self._lock:
+            verdict = self._verdicts.get(self._key(hash_a, hash_b, target))
+            if verdict is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return verdict
+
+    def put(self, hash_a:str, hash_b:str, target:str, winner_hash:str, record:dict):
+        with self._lock:
+            self._verdicts[self._key(hash_a, hash_b, target)] = (winner_hash, record)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "verdicts": len(self._verdicts)}
+
+
+class Tournament(object):
+    def __init__(self, judge, target:str="", memo:JudgementMemo=None, max_concurrent:int=1, judge_budget:int=None):
+        '''
+        Inputs:
+            judge: function (candidate1, candidate2) -> (index of the winner, 0 or 1, record of the judgement),
+                or None when the judgement failed
+            target[optional]: target_key() of the judgements, for the memo
+            memo[optional]: JudgementMemo shared by the tournaments of a run, a new one by default
+            max_concurrent[optional]: max judge calls at once
+            judge_budget[optional]: max judge calls of one run of the tournament, unlimited by default
+        '''
+        self.judge = judge
+        self.target = target
+        self.memo = memo if memo is not None else JudgementMemo()
+        self.max_concurrent = max_concurrent
+        self.judge_budget = judge_budget
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self.judge_calls = 0
+        self.entrants = []      # the candidates of the last run
+
+    def _hash(self, candidate) -> str:
+        with self._lock:
+            if candidate[0] not in self._hashes:
+                self._hashes[candidate[0]] = code_hash(candidate[0])
+            return self._hashes[candidate[0]]
+
+    def _match(self, candidate1, candidate2):
+        # Returns (winner, record of the judgement or None)
+        hash1, hash2 = self._hash(candidate1), self._hash(candidate2)
+        if hash1 == hash2:      # the same edit twice
+            return candidate1, None
+        verdict = self.memo.get(hash1, hash2, self.target)
+        if verdict is not None:
+            winner_hash, record = verdict
+            return (candidate1 if winner_hash == hash1 else candidate2), dict(record, memoized=True)
+
+        with self._lock:
+            over_budget = self.judge_budget is not None and self.judge_calls >= self.judge_budget
+            if not over_budget:
+                self.judge_calls += 1
+        if over_budget:
+            logger.warning(f"Judge call budget ({self.judge_budget}) spent, {candidate1[0]} wins against {candidate2[0]} unjudged.")
+            return candidate1, None
+
+        judgement = self.judge(candidate1, candidate2)
+        if judgement is None:
+            logger.warning(f"Judgement between {candidate1[0]} and {candidate2[0]} failed, {candidate1[0]} wins.")
+            return candidate1, None
+        winner_index, record = judgement
+        self.memo.put(hash1, hash2, self.target, (hash1, hash2)[winner_index], record)
+        return (candidate1, candidate2)[winner_index], record
+
+    def _arrive(self, arrivals, block:bool=False, deadline:float=None):
+        # Takes the next candidate out of arrivals into self.entrants. Returns False once arrivals are
+        # closed (by a None) or the deadline is passed, True otherwise.
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                logger.warning(f"Tournament deadline passed, going on with {len(self.entrants)} candidates.")
+                return False
+        try:
+            candidate = arrivals.get(timeout=timeout) if block else arrivals.get_nowait()
+        except queue.Empty:
+            return True
+        if candidate is None:
+            return False
+        self.entrants.append(candidate)
+        return True
+
+    def _knockout(self, executor, candidates:list, remaining:int=1, arrivals:queue.Queue=None, deadline:float=None):
+        # Pairs candidates whose opponent is known as soon as possible, until `remaining` are left.
+        # More candidates may come from arrivals until it is closed or the deadline is passed.
+        # Returns the candidates left, in the order they qualified, and the judgement records.
+        waiting = list(candidates)
+        running = {}
+        records = []
+        open_arrivals = arrivals is not None
+        while True:
+            while open_arrivals:
+                num_entrants = len(self.entrants)
+                open_arrivals = self._arrive(arrivals, deadline=deadline)
+                if len(self.entrants) == num_entrants:
+                    break
+                waiting.append(self.entrants[-1])
+
+            # Every running match will knock one candidate out
+            while len(waiting) >= 2 and len(waiting) + len(running) > remaining:
+                candidate1, candidate2 = waiting.pop(0), waiting.pop(0)
+                running[executor.submit(self._match, candidate1, candidate2)] = (candidate1, candidate2)
+            if not running:
+                if not open_arrivals:
+                    return waiting, records
+                # Nothing to judge until the next candidate comes
+                num_entrants = len(self.entrants)
+                open_arrivals = self._arrive(arrivals, block=True, deadline=deadline)
+                if len(self.entrants) > num_entrants:
+                    waiting.append(self.entrants[-1])
+                continue
+            done, _ = wait(running, timeout=0.1 if open_arrivals else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                winner, record = future.result()
+                waiting.append(winner)
+                if record is not None:
+                    records.append(record)
+
+    def _round(self, executor, pairs:list):
+        # Plays matches at once, returns [(winner index in its pair, record)]
+        futures = [executor.submit(self._match, candidate1, candidate2) for candidate1, candidate2 in pairs]
+        results = []
+        for (candidate1, _), future in zip(pairs, futures):
+            winner, record = future.result()
+            results.append((0 if winner is candidate1 else 1, record))
+        return results
+
+    def _round_robin(self, executor, candidates:list):
+        # Ranks candidates by their wins against each other, ties in the order of candidates
+        pairs = [(i, j) for i in range(len(candidates)) for j in range(i + 1, len(candidates))]
+        wins = [0] * len(candidates)
+        records = []
+        for (i, j), (winner_index, record) in zip(pairs, self._round(executor, [(candidates[i], candidates[j]) for i, j in pairs])):
+            wins[(i, j)[winner_index]] += 1
+            if record is not None:
+                records.append(record)
+        order = sorted(range(len(candidates)), key=lambda i: (-wins[i], i))
+        return [candidates[i] for i in order], records
+
+    def _swiss(self, executor, candidates:list, rounds:int=None):
+        if rounds is None:
+            rounds = math.ceil(math.log2(len(candidates)))
+        scores = [0] * len(candidates)
+        played = set()
+        records = []
+        for _ in range(rounds):
+            # Pair candidates of equal (or the closest) scores that have not met yet, the last one gets a bye
+            standing = sorted(range(len(candidates)), key=lambda i: (-scores[i], i))
+            pairs = []
+            while len(standing) >= 2:
+                i = standing.pop(0)
+                j = next((j for j in standing if (min(i, j), max(i, j)) not in played), standing[0])
+                standing.remove(j)
+                pairs.append((i, j))
+                played.add((min(i, j), max(i, j)))
+            for i in standing:
+                scores[i] += 1
+            for (i, j), (winner_index, record) in zip(pairs, self._round(executor, [(candidates[i], candidates[j]) for i, j in pairs])):
+                scores[(i, j)[winner_index]] += 1
+                if record is not None:
+                    records.append(record)
+        order = sorted(range(len(candidates)), key=lambda i: (-scores[i], i))
+        return [candidates[i] for i in order], records
+
+    def run(self, candidates:list, format:str="single_elimination", top_k:int=2, rounds:int=None):
+        '''
+        Inputs:
+            candidates: the candidates to rank
+            format[optional]: one of FORMATS
+            top_k[optional]: finalists of the top_k format
+            rounds[optional]: rounds of the swiss format, ceil(log2(len(candidates))) by default
+        Outputs:
+            ranking: the candidates from best, the winner alone for single_elimination
+            records: the records of the judgements made or found in the memo (marked "memoized")
+        '''
+        if format not in FORMATS:
+            raise ValueError(f"Unknown tournament format {format}, expected one of {FORMATS}.")
+        assert len(candidates) > 0, "the candidate list is empty"
+        self.judge_calls = 0
+        self.entrants = list(candidates)
+        if len(candidates) == 1:
+            return list(candidates), []
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+            if format == "single_elimination":
+                return self._knockout(executor, candidates)
+            if format == "top_k":
+                finalists, records = self._knockout(executor, candidates, remaining=max(1, top_k))
+                ranking, final_records = self._round_robin(executor, finalists)
+                return ranking, records + final_records
+            return self._swiss(executor, candidates, rounds=rounds)
+
+    def run_stream(self, arrivals:queue.Queue, candidates:list=(), format:str="single_elimination", top_k:int=2,
+                   rounds:int=None, deadline:float=None):
+        '''
+        run() over candidates and the candidates put into arrivals, until a None is put or the deadline
+        (a time.monotonic() time) is passed. Candidates arriving later are left out; see self.entrants
+        for the candidates that made it. The knockouts start judging the candidates as they arrive,
+        swiss waits for all of them.
+        '''
+        if format not in FORMATS:
+            raise ValueError(f"Unknown tournament format {format}, expected one of {FORMATS}.")
+        self.judge_calls = 0
+        self.entrants = list(candidates)
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+            if format == "swiss":
+                while self._arrive(arrivals, block=True, deadline=deadline):
+                    pass
+                if len(self.entrants) <= 1:
+                    return list(self.entrants), []
+                return self._swiss(executor, list(self.entrants), rounds=rounds)
+
+            remaining = 1 if format == "single_elimination" else max(1, top_k)
+            finalists, records = self._knockout(executor, list(candidates), remaining=remaining, arrivals=arrivals, deadline=deadline)
+            if format == "single_elimination" or len(finalists) <= 1:
+                return finalists, records
+            ranking, final_records = self._round_robin(executor, finalists)
+            return ranking, records + final_records
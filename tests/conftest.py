@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tests import the top-level modules (utils.py, system/) like evaluation.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
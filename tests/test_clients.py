@@ -0,0 +1,112 @@
+"""
+The shared API clients of tasksolver/clients.py, against a local mock HTTP server standing in for each provider.
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("httpx")
+from tasksolver import clients
+
+RESPONSES = {
+    "/v1/chat/completions": {
+        "id": "chatcmpl-mock", "object": "chat.completion", "created": 0, "model": "gpt-4o",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "mock answer"}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3},
+    },
+    "/v1/messages": {
+        "id": "msg_mock", "type": "message", "role": "assistant", "model": "claude-3-5-sonnet-latest",
+        "content": [{"type": "text", "text": "mock answer"}],
+        "stop_reason": "end_turn", "stop_sequence": None,
+        "usage": {"input_tokens": 1, "output_tokens": 2},
+    },
+    "/v1beta/models/gemini-1.5-flash:generateContent": {
+        "candidates": [{"content": {"parts": [{"text": "mock answer"}], "role": "model"}, "finishReason": "STOP", "index": 0}],
+        "usageMetadata": {"promptTokenCount": 1, "candidatesTokenCount": 2, "totalTokenCount": 3},
+    },
+    "/api/chat": {
+        "model": "llama3", "created_at": "2024-01-01T00:00:00Z",
+        "message": {"role": "assistant", "content": "mock answer"}, "done": True,
+    },
+}
+
+
+class MockProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive, as the real endpoints
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.server.requests.append((self.path, json.loads(self.rfile.read(length) or b"null")))
+        self.server.client_ports.add(self.client_address[1])
+        response = RESPONSES.get(self.path.split("?")[0])
+        body = json.dumps(response if response is not None else {"error": self.path}).encode()
+        self.send_response(200 if response is not None else 404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def mock_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockProviderHandler)
+    server.requests = []
+    server.client_ports = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def server_url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def test_openai_client(mock_server):
+    pytest.importorskip("openai")
+    client = clients.get_openai_client("mock-key", base_url=server_url(mock_server) + "/v1")
+    assert client is clients.get_openai_client("mock-key", base_url=server_url(mock_server) + "/v1")
+    for _ in range(3):
+        response = client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": "hi"}], max_tokens=10)
+        assert response.choices[0].message.content == "mock answer"
+    assert [path for path, _ in mock_server.requests] == ["/v1/chat/completions"] * 3
+    assert len(mock_server.client_ports) == 1     # one keep-alive connection for the sequential requests
+
+
+def test_anthropic_client(mock_server):
+    pytest.importorskip("anthropic")
+    client = clients.get_anthropic_client("mock-key", base_url=server_url(mock_server))
+    assert client is clients.get_anthropic_client("mock-key", base_url=server_url(mock_server))
+    for _ in range(3):
+        response = client.messages.create(model="claude-3-5-sonnet-latest", max_tokens=10,
+                                          messages=[{"role": "user", "content": "hi"}])
+        assert response.content[0].text == "mock answer"
+    assert [path for path, _ in mock_server.requests] == ["/v1/messages"] * 3
+    assert len(mock_server.client_ports) == 1
+
+
+def test_gemini_model(mock_server):
+    pytest.importorskip("google.generativeai")
+    model = clients.get_gemini_model("mock-key", "gemini-1.5-flash", base_url=server_url(mock_server))
+    assert model is clients.get_gemini_model("mock-key", "gemini-1.5-flash", base_url=server_url(mock_server))
+    response = model.generate_content(contents=["hi"])
+    assert response.text == "mock answer"
+    assert mock_server.requests[0][0].startswith("/v1beta/models/gemini-1.5-flash:generateContent")
+
+
+def test_ollama_client(mock_server):
+    pytest.importorskip("ollama")
+    client = clients.get_ollama_client(host=server_url(mock_server))
+    assert client is clients.get_ollama_client(host=server_url(mock_server))
+    for _ in range(3):
+        response = client.chat(model="llama3", messages=[{"role": "user", "content": "hi"}])
+        assert response["message"]["content"] == "mock answer"
+    assert [path for path, _ in mock_server.requests] == ["/api/chat"] * 3
+    assert len(mock_server.client_ports) == 1
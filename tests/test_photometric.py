@@ -0,0 +1,74 @@
+"""
+Parity of the vectorized photometric losses of system/utils/photometric.py with photometric_loss() in utils.py.
+"""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from system.utils.photometric import photometric_losses
+
+# The reference implementation; utils.py pulls in torchvision and tasksolver, skip without them
+photometric_loss = pytest.importorskip("utils").photometric_loss
+
+
+def random_image(rng, size, mode):
+    channels = len(mode)
+    return Image.fromarray(rng.integers(0, 256, size=(size[1], size[0], channels), dtype=np.uint8), mode)
+
+
+def reference_losses(images, goal_images, goal_rows):
+    return np.array([photometric_loss(image, goal_images[goal_row]) for image, goal_row in zip(images, goal_rows)])
+
+
+@pytest.mark.parametrize("chunk_size", [64, 1, 3])
+@pytest.mark.parametrize("mode", ["RGB", "RGBA"])
+def test_shared_goal(chunk_size, mode):
+    rng = np.random.default_rng(0)
+    images = [random_image(rng, (32, 24), mode) for _ in range(7)]
+    goal_images = [random_image(rng, (32, 24), mode)]
+    losses = photometric_losses(images, goal_images, chunk_size=chunk_size)
+    assert losses.shape == (len(images),)
+    assert np.allclose(losses, reference_losses(images, goal_images, [0] * len(images)))
+
+
+@pytest.mark.parametrize("chunk_size", [64, 2])
+@pytest.mark.parametrize("mode", ["RGB", "RGBA"])
+def test_per_row_goals(chunk_size, mode):
+    rng = np.random.default_rng(1)
+    images = [random_image(rng, (20, 20), mode) for _ in range(6)]
+    goal_images = [random_image(rng, (20, 20), mode) for _ in range(6)]
+    losses = photometric_losses(images, goal_images, chunk_size=chunk_size)
+    assert np.allclose(losses, reference_losses(images, goal_images, range(len(images))))
+
+
+@pytest.mark.parametrize("chunk_size", [64, 2])
+def test_goal_rows(chunk_size):
+    rng = np.random.default_rng(2)
+    images = [random_image(rng, (16, 12), "RGB") for _ in range(8)]
+    goal_images = [random_image(rng, (16, 12), "RGB") for _ in range(3)]
+    goal_rows = [2, 0, 0, 1, 2, 1, 0, 2]
+    losses = photometric_losses(images, goal_images, goal_rows=goal_rows, chunk_size=chunk_size)
+    assert np.allclose(losses, reference_losses(images, goal_images, goal_rows))
+
+
+@pytest.mark.parametrize("chunk_size", [64, 1])
+def test_mixed_sizes_and_modes(chunk_size):
+    # Goal images of another size are resized to the size of the render, as photometric_loss() does
+    rng = np.random.default_rng(3)
+    images = [random_image(rng, (32, 24), "RGBA"), random_image(rng, (16, 16), "RGB"),
+              random_image(rng, (32, 24), "RGB"), random_image(rng, (16, 16), "RGBA"),
+              random_image(rng, (40, 30), "RGB")]
+    goal_images = [random_image(rng, (32, 24), "RGB"), random_image(rng, (24, 24), "RGBA")]
+    goal_rows = [0, 1, 1, 0, 0]
+    losses = photometric_losses(images, goal_images, goal_rows=goal_rows, chunk_size=chunk_size)
+    assert np.allclose(losses, reference_losses(images, goal_images, goal_rows))
+
+    shared_losses = photometric_losses(images, goal_images[1:], chunk_size=chunk_size)
+    assert np.allclose(shared_losses, reference_losses(images, goal_images[1:], [0] * len(images)))
+
+
+def test_identical_images():
+    rng = np.random.default_rng(4)
+    image = random_image(rng, (8, 8), "RGBA")
+    assert np.allclose(photometric_losses([image, image.convert("RGB")], [image]), 0.0)
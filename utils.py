@@ -6,15 +6,55 @@ import time
 import json
 from PIL import Image
 import shutil
+import importlib
+import pkgutil
+import threading
 from torchvision import transforms
 
+from system.utils.blender_pool import run_blender, run_blender_batch
+
+SYSTEM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'system')
+_system_import_lock = threading.Lock()
+
+
+def load_refinement_process():
+    '''
+    Import system/refinement_process.py (BlenderAlchemy) into this process and return the module.
+
+    The modules of system/ import their own `utils` package, which this file shadows, so `utils` is
+    pointed at system/utils while they are imported. Every module of system/utils is registered under
+    its `utils.` name as well, so each is loaded once: the worker pool, render cache and CLIP scorer
+    are shared with the top-level code, and the lazy relative imports of system/utils resolve to
+    `system.utils` once `utils` is restored.
+    '''
+    with _system_import_lock:
+        if 'refinement_process' in sys.modules:
+            return sys.modules['refinement_process']
+
+        if SYSTEM_DIR not in sys.path:
+            sys.path.append(SYSTEM_DIR)
+        top_level_utils = sys.modules.get('utils')
+        system_utils = importlib.import_module('system.utils')
+        sys.modules['utils'] = system_utils
+        for module_info in pkgutil.iter_modules(system_utils.__path__):
+            sys.modules['utils.' + module_info.name] = importlib.import_module('system.utils.' + module_info.name)
+        try:
+            refinement_process = importlib.import_module('refinement_process')
+            # The prompting modules are imported lazily by refinement(), import them while `utils` is swapped
+            for prompting_module in refinement_process.TASKSETTING2PROMPTMODULE.values():
+                importlib.import_module('prompting.' + prompting_module)
+        finally:
+            if top_level_utils is not None:
+                sys.modules['utils'] = top_level_utils
+            else:
+                del sys.modules['utils']
+        return refinement_process
 
-env = os.environ.copy()
 
 ## Focus on model swapping; make a default_BA.py (all BA-based structure) that can reproduce our results, also allow customzied system 
 ## 
 
-def BlenderAlchemy_run(blender_file_path, start_script, start_render, goal_render, blender_render_script_path, task_instance_id, task, infinigen_installation_path, generator_type, evaluator_type, starter_time=None, tree_dims=(4, 8)):
+def BlenderAlchemy_run(blender_file_path, start_script, start_render, goal_render, blender_render_script_path, task_instance_id, task, infinigen_installation_path, generator_type, evaluator_type, starter_time=None, tree_dims=(4, 8), num_blender_workers=0, render_cache_dir=None, exploration_render_tier=None, pipelined_levels=False, level_deadline=None, in_process=True):
     '''
     Generation and potentially selection process of the VLM system.
 
@@ -27,6 +67,13 @@ def BlenderAlchemy_run(blender_file_path, start_script, start_render, goal_rende
         task: name of the task, like `geometry`, `placement`
         task_instance_id: f'{task}{i}', like `placement1`, `geometry2`
         infinigen_installation_path: file/dir path to infinigen blender executable file for background rendering
+        num_blender_workers[optional]: number of long-lived Blender processes used for rendering, 0 spawns Blender for every render
+        render_cache_dir[optional]: directory of the render cache shared across instances and runs, None disables it
+        exploration_render_tier[optional]: render tier of the proposals during tree search (e.g. `preview`), None renders them at full quality
+        pipelined_levels[optional]: True renders and judges each proposal of a tree level as soon as it is generated
+        level_deadline[optional]: with pipelined_levels, seconds after which the proposals of a tree level not rendered yet are left out
+        in_process[optional]: True runs BlenderAlchemy in this process, reusing the agents (and local model weights) of earlier instances.
+            False runs it in a fresh `python system/main.py` process
 
     Outputs:
         proposal_edits_paths: a list of file paths to proposal scripts from the VLM system 
@@ -55,9 +102,9 @@ def BlenderAlchemy_run(blender_file_path, start_script, start_render, goal_rende
     config_dict = {     # This should allow plug-in for different models
         'task':{'type': task},
         'credentials':{
-            'openai': 'credentials/openai_api.txt',
-            'claude': 'credentials/claude_api.txt',
-            'gemini': 'credentials/gemini_api.txt',
+            'openai': os.path.join(SYSTEM_DIR, 'credentials/openai_api.txt'),
+            'claude': os.path.join(SYSTEM_DIR, 'credentials/claude_api.txt'),
+            'gemini': os.path.join(SYSTEM_DIR, 'credentials/gemini_api.txt'),
         },
         'input':{
             'text_prompt': None,
@@ -65,7 +112,7 @@ def BlenderAlchemy_run(blender_file_path, start_script, start_render, goal_rende
             'target_code': None,
         },
         'output':{
-            'output_dir': f"{output_folder_name}/{task_instance_id}/"
+            'output_dir': os.path.join(SYSTEM_DIR, f"{output_folder_name}/{task_instance_id}/")
         },
         'run_config':{
             'blender_command': infinigen_installation_path,
@@ -81,29 +128,44 @@ def BlenderAlchemy_run(blender_file_path, start_script, start_render, goal_rende
             'state_evaluator_type': evaluator_type,
             'max_concurrent_rendering_processes': 1,
             'max_concurrent_evaluation_requests': 1,
-            'max_concurrent_generator_requests': 1
+            'max_concurrent_generator_requests': 1,
+            'num_blender_workers': num_blender_workers,
+            'render_cache_dir': os.path.abspath(render_cache_dir) if render_cache_dir else None,
+            'exploration_render_tier': exploration_render_tier,
+            'pipelined_levels': pipelined_levels,
+            'level_deadline': level_deadline
         }
     }
-    import yaml
-    config_file_path = os.path.abspath('temp.yml')
+    print(f'config_dict: {config_dict}')
 
-    with open(config_file_path, 'w') as file:
-        yaml.dump(config_dict, file)
+    if in_process:
+        load_refinement_process().run_refinement(config_dict,
+                                                 starter_blend=blender_file_path,
+                                                 blender_base=blender_render_script_path,
+                                                 blender_script=start_script)
+    else:
+        import yaml
+        # One config file per instance, since inference.py may run several instances at once
+        config_file_path = os.path.abspath(f'temp_{output_folder_name.replace("/", "_")}_{task_instance_id}.yml')
 
-    command = f'''
-        cd system && \
+        with open(config_file_path, 'w') as file:
+            yaml.dump(config_dict, file)
 
-        python main.py \
-            --starter_blend {blender_file_path} \
-            --blender_base {blender_render_script_path} \
-            --blender_script {start_script} \
-            --config {config_file_path}
-    '''
+        command = f'''
+            cd system && \
 
-    print(f'config_dict: {config_dict}')
-    print(f'command: {command}')
+            python main.py \
+                --starter_blend {blender_file_path} \
+                --blender_base {blender_render_script_path} \
+                --blender_script {start_script} \
+                --config {config_file_path}
+        '''
 
-    subprocess.run(command, shell=True, env=env)
+        print(f'command: {command}')
+
+        # The environment is read now rather than at import, so that the concurrency limits set by inference.py are inherited
+        subprocess.run(command, shell=True, env=os.environ.copy())
+        os.remove(config_file_path)
 
     proposal_edits_dir_path = f'system/{output_folder_name}/{task_instance_id}/instance0/{variants[0]}_d{tree_dims[0]}_b{tree_dims[1]}/scripts'
     proposal_renders_dir_path = f'system/{output_folder_name}/{task_instance_id}/instance0/{variants[0]}_d{tree_dims[0]}_b{tree_dims[1]}/renders'
@@ -115,8 +177,9 @@ def BlenderAlchemy_run(blender_file_path, start_script, start_render, goal_rende
     with open(last_iter_info, 'r') as file:
         info = json.load(file)
     
-    selected_edit_path = "system/" + info[-1]['winner_code']
-    selected_render_path = "system/" + info[-1]['winner_image']
+    # Paths in the thought process are relative to system/, unless they are absolute
+    selected_edit_path = os.path.join("system", info[-1]['winner_code'])
+    selected_render_path = os.path.join("system", info[-1]['winner_image'])
 
     return proposal_edits_paths, proposal_renders_paths, selected_edit_path, selected_render_path
 
@@ -164,7 +227,7 @@ def merge_images_in_directory(directory, saved_to_local=True, merge_dir_into_ima
 
 
 
-def blender_step(infinigen_installation_path, blender_file_path, blender_render_script_path, script_path, render_dir, merge_all_renders=False, replace_if_overlap=True, merge_dir_into_image=False):
+def blender_step(infinigen_installation_path, blender_file_path, blender_render_script_path, script_path, render_dir, merge_all_renders=False, replace_if_overlap=True, merge_dir_into_image=False, render_tier=None):
 
     '''
     Generate a rendered image with given script_path at render_dir.
@@ -177,6 +240,7 @@ def blender_step(infinigen_installation_path, blender_file_path, blender_render_
         merge_all_renders[optional]: True will merge all images in render_dir
         replace_if_overlap[optional]: False will skip if the render_dir exists and is non-empty, and True will proceed replace every overlapping render 
         merge_dir_into_image[optional]: True will delete the render_dir and replace it with the merged image
+        render_tier[optional]: render setting overrides, e.g. {"resolution_percentage": 50, "samples": 16}, None for full quality
     '''
 
     def is_directory_empty(directory_path):
@@ -201,12 +265,8 @@ def blender_step(infinigen_installation_path, blender_file_path, blender_render_
     print('script_path: ', script_path)
     print('render_dir: ', render_dir)
 
-    # Enter the blender code
-    command = [infinigen_installation_path, "--background", blender_file_path, 
-                    "--python", blender_render_script_path, 
-                    "--", script_path, render_dir]
-    command = ' '.join(command)
-    command_run = subprocess.run(command, shell=True, check=True)
+    # Enter the blender code, through the Blender worker pool if one is running
+    run_blender(infinigen_installation_path, blender_file_path, blender_render_script_path, script_path, render_dir, render_tier=render_tier)
 
     if is_directory_empty(render_dir):
         print(f"The following bpy script didn't run correctly in blender:{script_path}")
@@ -218,6 +278,44 @@ def blender_step(infinigen_installation_path, blender_file_path, blender_render_
 
     return True
 
+
+def blender_step_batch(infinigen_installation_path, blender_file_path, blender_render_script_path, jobs, merge_all_renders=False, replace_if_overlap=True, merge_dir_into_image=False, render_tier=None):
+
+    '''
+    Same as blender_step, for a list of scripts rendered in a single Blender process (or by the worker pool).
+
+    Inputs:
+        jobs: list of (script_path, render_dir)
+        other inputs: same as blender_step
+    Outputs:
+        list with, for each job, None if it was skipped (replace_if_overlap=False and render_dir non-empty), 
+        False if the script didn't render and True otherwise
+    '''
+
+    assert blender_file_path is not None and blender_render_script_path is not None
+
+    outcomes = [None] * len(jobs)
+    to_render = []
+    for idx, (script_path, render_dir) in enumerate(jobs):
+        if not replace_if_overlap and os.path.isdir(render_dir) and len(os.listdir(render_dir)) > 0:
+            continue
+        os.makedirs(render_dir, exist_ok=True)
+        to_render.append(idx)
+
+    run_blender_batch(infinigen_installation_path, blender_file_path, blender_render_script_path, [jobs[idx] for idx in to_render], render_tier=render_tier)
+
+    for idx in to_render:
+        script_path, render_dir = jobs[idx]
+        if len(os.listdir(render_dir)) == 0:
+            print(f"The following bpy script didn't run correctly in blender:{script_path}")
+            outcomes[idx] = False
+        else:
+            if merge_all_renders:
+                merge_images_in_directory(render_dir, saved_to_local=True, merge_dir_into_image=merge_dir_into_image)
+            outcomes[idx] = True
+
+    return outcomes
+
 import sys
 import numpy as np
 from PIL import Image
@@ -225,6 +323,7 @@ from PIL import Image
 import torch
 from torchvision.transforms import Compose, Resize, CenterCrop, ToTensor, Normalize
 from transformers import CLIPProcessor, CLIPModel
+from system.utils.clip_scorer import get_clip_scorer
 
 
 
@@ -242,22 +341,14 @@ def clip_similarity(image1, image2):
     if image1.size != image2.size:
         image2 = image2.resize(image1.size)
 
-    # Load the CLIP model
-    model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-
-    # Load the CLIP processor
-    processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-
-    # Preprocess the images
-    images = [image1, image2]
-    inputs = processor(images=images, return_tensors="pt")
+    # The CLIP model is loaded once per process
+    scorer = get_clip_scorer("openai/clip-vit-base-patch32")
 
-    # Compute the features for the images
-    with torch.no_grad():
-        features = model.get_image_features(**inputs)
+    # Compute the normalized features for both images in one batch
+    features = scorer.embed_images([image1, image2])
 
     # Compute the cosine similarity between the image features
-    sim = torch.nn.functional.cosine_similarity(features[0], features[1], dim=-1)
+    sim = scorer.similarity(features[:1], features[1:])
 
     return sim.item()
 
@@ -304,24 +395,16 @@ def img2text_clip_similarity(image, text):
     float: The CLIP similarity between the image and the text.
     """
     
-    # Load the CLIP model
-    # model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-    model = CLIPModel.from_pretrained("openai/clip-vit-large-patch14")
+    # The CLIP model is loaded once per process
+    # scorer = get_clip_scorer("openai/clip-vit-base-patch32")
+    scorer = get_clip_scorer("openai/clip-vit-large-patch14")
 
-    # Load the CLIP processor
-    # processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-    processor = CLIPProcessor.from_pretrained("openai/clip-vit-large-patch14")
-
-    # Preprocess the image and text
-    inputs = processor(text=text, images=image, return_tensors="pt")
-
-    # Compute the features for the image and text
-    with torch.no_grad():
-        image_features = model.get_image_features(pixel_values=inputs.pixel_values)
-        text_features = model.get_text_features(input_ids=inputs.input_ids)
+    # Compute the normalized features for the image and text
+    image_features = scorer.embed_images([image])
+    text_features = scorer.embed_texts([text])
 
     # Compute the cosine similarity between the image and text features
-    sim = torch.nn.functional.cosine_similarity(image_features, text_features, dim=-1)
+    sim = scorer.similarity(image_features, text_features)
 
     return sim.item()
 
@@ -341,11 +424,9 @@ def img2img_clip_similarity(image1, image2):
     if image1.size != image2.size:
         image2 = image2.resize(image1.size)
 
-    # Load the CLIP model
-    model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-
-    # Load the CLIP processor
-    processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
+    # The CLIP model is loaded once per process
+    scorer = get_clip_scorer("openai/clip-vit-base-patch32")
+    model, processor = scorer.model, scorer.processor
 
     # # Preprocess the images
     images = [image1, image2]
@@ -361,7 +442,7 @@ def img2img_clip_similarity(image1, image2):
     # Stack into a batch (Assuming both images have the same size)
     images = torch.stack(images)  
 
-    inputs = processor(images=images, return_tensors="pt")
+    inputs = processor(images=images, return_tensors="pt").to(scorer.device)
 
     # Compute the features for the images
     with torch.no_grad():